@@ -407,23 +407,22 @@ class EmpiricalDistr(WideSenseDistr):
     def var(self):
         return self.var_n_minus_1 if self._use_n_minus_1_stats else self.var_n
 
+    def _weighted_scatter(self):
+        # The sum of the weighted outer products of the particles' deviations from the mean, as a single matrix product
+        deviations = self._particles - self.mean.T
+        return np.dot((deviations * self._weights).T, deviations)
+
     @property
     def cov_n(self):
         if self._cov_n is None:
-            self._cov_n = np.sum([self.weight(i) * np.dot(self.particle(i) - self.mean, (self.particle(i) - self.mean).T) for i in range(self.particle_count)], axis=0)
-            # The following is more efficient:
-            # self._cov_n = np.dot(self._particles.T - self.mean, self.particles - self.mean.T)
-            self._cov_n /= self.weight_sum
+            self._cov_n = self._weighted_scatter() / (self.weight_sum)
             npu.make_immutable(self._cov_n)
         return self._cov_n
 
     @property
     def cov_n_minus_1(self):
         if self._cov_n_minus_1 is None:
-            self._cov_n_minus_1 = np.sum([self.weight(i) * np.dot(self.particle(i) - self.mean, (self.particle(i) - self.mean).T) for i in range(self.particle_count)], axis=0)
-            # The following is more efficient:
-            # self._cov_n_minus_1 = np.dot(self._particles.T - self.mean, self.particles - self.mean.T)
-            self._cov_n_minus_1 /= self.weight_sum - 1.
+            self._cov_n_minus_1 = self._weighted_scatter() / (self.weight_sum - 1.)
             npu.make_immutable(self._cov_n_minus_1)
         return self._cov_n_minus_1
 
@@ -479,14 +478,9 @@ class EmpiricalDistr(WideSenseDistr):
 def multinomial_resample(empirical_distr, target_particle_count=None, random_state=None):
     if target_particle_count is None: target_particle_count = empirical_distr.particle_count
     if random_state is None: random_state = rnd.random_state()
-    counts = rnd.multinomial(target_particle_count, npu.to_ndim_1(empirical_distr.normalized_weights))
+    counts = rnd.multinomial(target_particle_count, npu.to_ndim_1(empirical_distr.normalized_weights), random_state=random_state)
     assert np.sum(counts) == target_particle_count
-    particle_idx = 0
-    resampled_particles = np.empty((target_particle_count, np.shape(empirical_distr.particles)[1]))
-    for i in range(empirical_distr.particle_count):
-        for _ in range(counts[i]):
-            resampled_particles[particle_idx,:] = npu.to_ndim_1(empirical_distr.particle(i))
-            particle_idx += 1
+    resampled_particles = np.take(empirical_distr.particles, np.repeat(np.arange(empirical_distr.particle_count), counts), axis=0)
     return EmpiricalDistr(particles=resampled_particles, weights=np.ones((target_particle_count,)))
 
 '''
@@ -188,6 +188,11 @@ class Observable(objects.Named):
     def observe(self, obs, time=None, true_value=None, predicted_obs=None):
         raise NotImplementedError()
     
+    def _run(self, obss, times, obs_covs, true_values, return_df):
+        # Observables that can process a whole series of observations given as arrays, without the per-step overhead of
+        # predict and observe, override this; None means that run should fall back to its generic loop
+        return None
+    
     def to_string_helper(self):
         if self._to_string_helper_Observable is None:
             self._to_string_helper_Observable = super().to_string_helper() \
@@ -311,10 +316,98 @@ class FilterPypeOptions(enum.Enum):
     OBS_RESULT = 3
     TRUE_VALUE = 4
 
+_RUN_COLUMNS = ('time', 'filter_name', 'filter_type', 'observable_name',
+                'accepted', 'obs_mean', 'obs_cov', 'predicted_obs_mean', 'predicted_obs_cov', 'cross_cov',
+                'innov_mean', 'innov_cov',
+                'prior_state_mean', 'prior_state_cov', 'posterior_state_mean', 'posterior_state_cov',
+                'true_value', 'log_likelihood', 'gain')
+
+# The numeric columns are stored as float arrays with one row per step: scalars as (T,), vectors as (T, d) and matrices as
+# (T, n, m). Rows for which there is no value (such as the observation in the row of the initial state) are NaN and are
+# marked in a separate mask of empty rows, so that they are not confused with values that are NaN
+_RUN_SCALAR_COLUMNS = frozenset(('log_likelihood',))
+_RUN_VECTOR_COLUMNS = frozenset(('obs_mean', 'predicted_obs_mean', 'innov_mean', 'prior_state_mean', 'posterior_state_mean',
+                                 'true_value'))
+_RUN_MATRIX_COLUMNS = frozenset(('obs_cov', 'predicted_obs_cov', 'cross_cov', 'innov_cov', 'prior_state_cov',
+                                 'posterior_state_cov', 'gain'))
+_RUN_ARRAY_COLUMNS = _RUN_SCALAR_COLUMNS | _RUN_VECTOR_COLUMNS | _RUN_MATRIX_COLUMNS
+
+def _run_row_value(column, value):
+    if value is None or column not in _RUN_ARRAY_COLUMNS: return value
+    try:
+        value = np.asarray(value, dtype=float)
+    except (TypeError, ValueError):
+        return value
+    if column in _RUN_SCALAR_COLUMNS: return np.reshape(value, ()) if np.size(value) == 1 else value
+    if column in _RUN_VECTOR_COLUMNS: return npu.to_ndim_1(value)
+    return npu.to_ndim_2(value, ndim_1_to_col=True)
+
+class _FilterRunRecorder(object):
+    def __init__(self, capacity=64):
+        self._capacity = capacity
+        self._count = 0
+        self._arrays = {}
+        self._empty_rows = {}
+        
+    def _allocate(self, column, value):
+        if checks.is_numpy_array(value) and value.dtype == float:
+            array = np.full((self._capacity,) + value.shape, np.nan)
+        else:
+            array = np.full((self._capacity,), None, dtype=object)
+        self._arrays[column] = array
+        self._empty_rows[column] = np.full((self._capacity,), True)
+        return array
+    
+    def _grow(self):
+        # Geometric growth keeps the amortized cost of appending a row constant when the length of the run is unknown
+        capacity = 2 * self._capacity
+        for column, array in self._arrays.items():
+            new_array = np.full((capacity,) + array.shape[1:], np.nan if array.dtype == float else None, dtype=array.dtype)
+            new_array[0:self._count] = array[0:self._count]
+            self._arrays[column] = new_array
+            new_empty_rows = np.full((capacity,), True)
+            new_empty_rows[0:self._count] = self._empty_rows[column][0:self._count]
+            self._empty_rows[column] = new_empty_rows
+        self._capacity = capacity
+        
+    def _to_object_column(self, column):
+        array = self._arrays[column]
+        empty_rows = self._empty_rows[column]
+        new_array = np.full((self._capacity,), None, dtype=object)
+        for i in range(self._count):
+            if not empty_rows[i]: new_array[i] = array[i]
+        self._arrays[column] = new_array
+        return new_array
+    
+    def append(self, **values):
+        if self._count == self._capacity: self._grow()
+        for column in _RUN_COLUMNS:
+            value = _run_row_value(column, values.get(column))
+            if value is None: continue
+            array = self._arrays.get(column)
+            if array is None: array = self._allocate(column, value)
+            if array.dtype == float and (not checks.is_numpy_array(value) or value.dtype != float or value.shape != array.shape[1:]):
+                # Rows of different shapes (such as observations from observables of different dimensions) are kept
+                # as objects
+                array = self._to_object_column(column)
+            array[self._count] = value
+            self._empty_rows[column][self._count] = False
+        self._count += 1
+        
+    def arrays(self):
+        return {column: self._arrays[column][0:self._count] if column in self._arrays else None for column in _RUN_COLUMNS}
+    
+    def empty_rows(self):
+        return {column: empty_rows[0:self._count] for column, empty_rows in self._empty_rows.items()}
+
 class FilterRunResult(object):
-    def __init__(self, last_obs_result, cumulative_log_likelihood, df):
+    # The steps of the run are given either as a DataFrame, df, or as the recorded arrays, from which the DataFrame is
+    # built when first requested. The optional empty_rows map columns to boolean masks of the rows that have no value
+    def __init__(self, last_obs_result, cumulative_log_likelihood, df=None, arrays=None, empty_rows=None):
         self._last_obs_result = last_obs_result
         self._cumulative_log_likelihood = cumulative_log_likelihood
+        self._arrays = arrays
+        self._empty_rows = {} if empty_rows is None else empty_rows
         self._df = df
         self._to_string_helper_FilterRunResult = None
         self._str_FilterRunResult = None
@@ -326,17 +419,48 @@ class FilterRunResult(object):
     @property
     def cumulative_log_likelihood(self):
         return self._cumulative_log_likelihood
+    
+    @property
+    def arrays(self):
+        return self._arrays
 
     @property
     def df(self):
+        if self._df is None: self._df = self.to_df()
         return self._df
+    
+    def to_df(self, wide=False):
+        # With wide=True, the vector and matrix columns are split into float columns per component, e.g.
+        # posterior_state_mean_0 and posterior_state_cov_0_1, instead of object columns holding arrays. Without the
+        # arrays, this is the DataFrame given to the constructor, if any
+        if self._arrays is None: return self._df
+        row_count = len(self._arrays['time'])
+        columns = {}
+        for column in _RUN_COLUMNS:
+            array = self._arrays[column]
+            if array is None:
+                columns[column] = [None] * row_count
+            elif array.dtype != float or column in _RUN_SCALAR_COLUMNS:
+                columns[column] = array
+            elif np.prod(array.shape[1:]) == 1:
+                columns[column] = np.reshape(array, (row_count,))
+            elif wide:
+                for idx in np.ndindex(*array.shape[1:]):
+                    columns['_'.join([column] + [str(i) for i in idx])] = array[(slice(None),) + idx]
+            else:
+                shape = (array.shape[1], 1) if column in _RUN_VECTOR_COLUMNS else array.shape[1:]
+                values = list(np.reshape(array, (row_count,) + shape))
+                if column in self._empty_rows:
+                    for i in np.flatnonzero(self._empty_rows[column]): values[i] = None
+                columns[column] = values
+        return pd.DataFrame(columns, columns=list(columns.keys()))
 
     def to_string_helper(self):
         if self._to_string_helper_FilterRunResult is None:
             self._to_string_helper_FilterRunResult = ToStringHelper(self) \
                     .add('last_obs_result', self._last_obs_result) \
                     .add('cumulative_log_likelihood', self._cumulative_log_likelihood) \
-                    .add('df', self._df)
+                    .add('df', self.df)
         return self._to_string_helper_FilterRunResult
     
     def __str__(self):
@@ -365,6 +489,10 @@ def run(observable, obss=None, times=None, obs_covs=None, true_values=None, df=N
             true_values = df[true_values].values
             
     checks.check_not_none(obss)
+    
+    if isinstance(observable, Observable) and fun is None:
+        run_result = observable._run(obss, times, obs_covs, true_values, return_df)
+        if run_result is not None: return run_result
 
     if not checks.is_iterable_not_string(observable): observable = utils.xconst(observable)
     if not checks.is_iterable_not_string(obss): obss = [obss]
@@ -375,26 +503,7 @@ def run(observable, obss=None, times=None, obs_covs=None, true_values=None, df=N
     obs_result = None
     cumulative_log_likelihood = 0.
     
-    if return_df:
-        time = []
-        filter_name = []
-        filter_type = []
-        observable_name = []
-        accepted = []
-        obs_mean = []
-        obs_cov = []
-        predicted_obs_mean = []
-        predicted_obs_cov = []
-        cross_cov = []
-        innov_mean = []
-        innov_cov = []
-        prior_state_mean = []
-        prior_state_cov = []
-        posterior_state_mean = []
-        posterior_state_cov = []
-        true_value = []
-        log_likelihood = []
-        gain = []
+    recorder = _FilterRunRecorder() if return_df else None
 
     last_time = None
         
@@ -411,87 +520,46 @@ def run(observable, obss=None, times=None, obs_covs=None, true_values=None, df=N
                 raise ValueError('An observation covariance is provided while the observation is given by a distribution --- conflicting arguments')
             an_obs = distrs.NormalDistr(an_obs, an_obs_cov)
         
-        if return_df and len(time) == 0:
-            an_initial_state_mean = an_observable.filter.state.state_distr.mean
-            an_initial_state_cov = an_observable.filter.state.state_distr.cov
-            time.append(an_observable.filter.time)
-            filter_name.append(an_observable.filter.name)
-            filter_type.append(type(an_observable.filter))
-            observable_name.append(None)
-            accepted.append(None)
-            obs_mean.append(None)
-            obs_cov.append(None)
-            predicted_obs_mean.append(None)
-            predicted_obs_cov.append(None)
-            cross_cov.append(None)
-            innov_mean.append(None)
-            innov_cov.append(None)
-            prior_state_mean.append(npu.to_scalar(an_initial_state_mean, raise_value_error=False))
-            prior_state_cov.append(npu.to_scalar(an_initial_state_cov, raise_value_error=False))
-            posterior_state_mean.append(npu.to_scalar(an_initial_state_mean, raise_value_error=False))
-            posterior_state_cov.append(npu.to_scalar(an_initial_state_cov, raise_value_error=False))
-            true_value.append(None)
-            log_likelihood.append(None)
-            gain.append(None)
+        if return_df and recorder._count == 0:
+            an_initial_state_distr = an_observable.filter.state.state_distr
+            recorder.append(time=an_observable.filter.time,
+                            filter_name=an_observable.filter.name,
+                            filter_type=type(an_observable.filter),
+                            prior_state_mean=an_initial_state_distr.mean,
+                            prior_state_cov=an_initial_state_distr.cov,
+                            posterior_state_mean=an_initial_state_distr.mean,
+                            posterior_state_cov=an_initial_state_distr.cov)
         
         if isinstance(an_obs, Obs):
             a_time, _ = _time_and_obs_distr(an_obs, a_time, an_observable.filter.time)
             
         predicted_obs = an_observable.predict(time=a_time, true_value=a_true_value)
-        a_prior_state_mean = an_observable.filter.state.state_distr.mean
-        a_prior_state_cov = an_observable.filter.state.state_distr.cov
+        # The states are only read if they are recorded, as reading them may take work (e.g. for an information filter)
+        if return_df: a_prior_state_distr = an_observable.filter.state.state_distr
         obs_result = an_observable.observe(obs=an_obs, time=a_time, true_value=a_true_value, predicted_obs=predicted_obs)
         if obs_result.accepted: cumulative_log_likelihood += obs_result.log_likelihood
-        a_posterior_state_mean = an_observable.filter.state.state_distr.mean
-        a_posterior_state_cov = an_observable.filter.state.state_distr.cov
         
         if return_df:
-            time.append(obs_result.obs.time)
-            filter_name.append(an_observable.filter.name)
-            filter_type.append(type(an_observable.filter))
-            observable_name.append(an_observable.name)
-            accepted.append(obs_result.accepted)
-            obs_mean.append(npu.to_scalar(obs_result.obs.distr.mean, raise_value_error=False))
-            obs_cov.append(npu.to_scalar(obs_result.obs.distr.cov, raise_value_error=False))
-            predicted_obs_mean.append(npu.to_scalar(obs_result.predicted_obs.distr.mean, raise_value_error=False))
-            predicted_obs_cov.append(npu.to_scalar(obs_result.predicted_obs.distr.cov, raise_value_error=False))
-            cross_cov.append(npu.to_scalar(obs_result.predicted_obs.cross_cov, raise_value_error=False))
-            innov_mean.append(npu.to_scalar(obs_result.innov_distr.mean, raise_value_error=False))
-            innov_cov.append(npu.to_scalar(obs_result.innov_distr.cov, raise_value_error=False))
-            prior_state_mean.append(npu.to_scalar(a_prior_state_mean, raise_value_error=False))
-            prior_state_cov.append(npu.to_scalar(a_prior_state_cov, raise_value_error=False))
-            posterior_state_mean.append(npu.to_scalar(a_posterior_state_mean, raise_value_error=False))
-            posterior_state_cov.append(npu.to_scalar(a_posterior_state_cov, raise_value_error=False))
-            true_value.append(npu.to_scalar(a_true_value, raise_value_error=False))
-            log_likelihood.append(npu.to_scalar(obs_result.log_likelihood, raise_value_error=False))
-            gain.append(obs_result.gain if hasattr(obs_result, 'gain') else None)
-    
-    df = None
-    if return_df:
-        df = pd.DataFrame({
-            'time': time,
-            'filter_name': filter_name,
-            'filter_type': filter_type,
-            'observable_name': observable_name,
-            'accepted': accepted,
-            'obs_mean': obs_mean,
-            'obs_cov': obs_cov,
-            'predicted_obs_mean': predicted_obs_mean,
-            'predicted_obs_cov': predicted_obs_cov,
-            'cross_cov': cross_cov,
-            'innov_mean': innov_mean,
-            'innov_cov': innov_cov,
-            'prior_state_mean': prior_state_mean,
-            'prior_state_cov': prior_state_cov,
-            'posterior_state_mean': prior_state_mean,
-            'posterior_state_cov': prior_state_cov,
-            'true_value': true_value,
-            'log_likelihood': log_likelihood,
-            'gain': gain},
-            columns=('time', 'filter_name', 'filter_type', 'observable_name',
-                     'accepted', 'obs_mean', 'obs_cov', 'predicted_obs_mean', 'predicted_obs_cov', 'cross_cov',
-                     'innov_mean', 'innov_cov',
-                     'prior_state_mean', 'prior_state_cov', 'posterior_state_mean', 'posterior_state_cov',
-                     'true_value', 'log_likelihood', 'gain'))
-
-    return FilterRunResult(obs_result, cumulative_log_likelihood, df)
+            a_posterior_state_distr = an_observable.filter.state.state_distr
+            recorder.append(time=obs_result.obs.time,
+                            filter_name=an_observable.filter.name,
+                            filter_type=type(an_observable.filter),
+                            observable_name=an_observable.name,
+                            accepted=obs_result.accepted,
+                            obs_mean=obs_result.obs.distr.mean,
+                            obs_cov=obs_result.obs.distr.cov,
+                            predicted_obs_mean=obs_result.predicted_obs.distr.mean,
+                            predicted_obs_cov=obs_result.predicted_obs.distr.cov,
+                            cross_cov=obs_result.predicted_obs.cross_cov,
+                            innov_mean=obs_result.innov_distr.mean,
+                            innov_cov=obs_result.innov_distr.cov,
+                            prior_state_mean=a_prior_state_distr.mean,
+                            prior_state_cov=a_prior_state_distr.cov,
+                            posterior_state_mean=a_posterior_state_distr.mean,
+                            posterior_state_cov=a_posterior_state_distr.cov,
+                            true_value=a_true_value,
+                            log_likelihood=obs_result.log_likelihood,
+                            gain=obs_result.gain if hasattr(obs_result, 'gain') else None)
+    
+    if not return_df: return FilterRunResult(obs_result, cumulative_log_likelihood)
+    return FilterRunResult(obs_result, cumulative_log_likelihood, arrays=recorder.arrays(), empty_rows=recorder.empty_rows())
@@ -0,0 +1,155 @@
+import datetime as dt
+
+import numpy as np
+
+import thalesians.tsa.checks as checks
+from thalesians.tsa.distrs import EmpiricalDistr
+from thalesians.tsa.distrs import NormalDistr as N
+import thalesians.tsa.filtering.kalman as kalman
+import thalesians.tsa.filtering.particle as particle
+
+# Checkpointing of filters' states as fixed-layout binary records, i.e. elements of NumPy structured arrays, rather than
+# as pickled object graphs. The layout of a record depends only on the filter's type and dimensions, so that the states
+# of many like filters (e.g. of a universe of instruments) form a single array, which save_states writes to and
+# load_states reads from a memory-mapped .npy file. A Kalman filter's record holds the time, whether the state is
+# posterior, and the state mean and covariance; a particle filter's also holds the particles, the weights, the
+# cumulative log-likelihood and the state of the random number generator, so that it resumes exactly where it stopped.
+# Any filter whose state is a kalman.KalmanFilterState (Kalman, extended, unscented and information filters) is saved
+# as a Kalman filter; so is each filter of a kalman.KalmanFilterBank, all at once
+
+# The layout of the state of numpy.random.RandomState's Mersenne Twister
+_MT19937_KEY_SIZE = 624
+
+def _time_dtype(time):
+    if isinstance(time, (dt.datetime, np.datetime64)): return np.dtype('datetime64[us]')
+    return np.dtype(float)
+
+def _from_record_time(time):
+    if isinstance(time, np.datetime64): return time.astype('datetime64[us]').item()
+    return float(time)
+
+def kalman_filter_state_dtype(state_dim, time_dtype=float):
+    return np.dtype([
+            ('time', time_dtype),
+            ('is_posterior', np.bool_),
+            ('state_mean', np.float64, (state_dim,)),
+            ('state_cov', np.float64, (state_dim, state_dim))])
+
+def particle_filter_state_dtype(particle_count, state_dim, time_dtype=float):
+    return np.dtype([
+            ('time', time_dtype),
+            ('prior_particles', np.float64, (particle_count, state_dim)),
+            ('resampled_particles', np.float64, (particle_count, state_dim)),
+            ('resampled_particles_uptodate', np.bool_),
+            ('log_unnormalized_weights', np.float64, (particle_count,)),
+            ('log_weights', np.float64, (particle_count,)),
+            ('weights', np.float64, (particle_count,)),
+            ('log_likelihood', np.float64),
+            ('effective_sample_size', np.float64),
+            ('resample_count', np.int64),
+            ('random_state_key', np.uint32, (_MT19937_KEY_SIZE,)),
+            ('random_state_pos', np.int64),
+            ('random_state_has_gauss', np.int64),
+            ('random_state_cached_gaussian', np.float64)])
+
+def state_dtype(filter):  # @ReservedAssignment
+    # The dtype of the records of the filter's state
+    if isinstance(filter, kalman.KalmanFilterBank):
+        time_dtype = filter.times.dtype if np.issubdtype(filter.times.dtype, np.datetime64) else _time_dtype(filter.times[0])
+        return kalman_filter_state_dtype(filter.state_dim, time_dtype)
+    if isinstance(filter, particle.ParticleFilter):
+        return particle_filter_state_dtype(filter.particle_count, filter._state_dim, _time_dtype(filter.time))
+    state = filter.state
+    if isinstance(state, kalman.KalmanFilterState):
+        return kalman_filter_state_dtype(state.state_distr.dim, _time_dtype(state.time))
+    raise ValueError('Unsupported filter type: %s' % type(filter))
+
+def save_state(filter, record=None):  # @ReservedAssignment
+    # Writes the filter's state to the record, e.g. an element of a (memory-mapped) structured array, and returns it; a
+    # new record is created if none is given
+    if record is None: record = np.zeros((), dtype=state_dtype(filter))[()]
+    if isinstance(filter, particle.ParticleFilter):
+        record['time'] = filter.time
+        record['prior_particles'] = filter._prior_particles
+        record['resampled_particles'] = filter._resampled_particles
+        record['resampled_particles_uptodate'] = filter._resampled_particles_uptodate
+        record['log_unnormalized_weights'] = filter._log_unnormalized_weights
+        record['log_weights'] = filter._log_weights
+        record['weights'] = filter._weights
+        record['log_likelihood'] = filter.log_likelihood
+        record['effective_sample_size'] = filter.effective_sample_size
+        record['resample_count'] = filter.resample_count
+        algorithm, key, pos, has_gauss, cached_gaussian = filter._random_state.get_state()
+        checks.check(algorithm == 'MT19937', 'Unsupported random number generator: %s' % algorithm)
+        record['random_state_key'] = key
+        record['random_state_pos'] = pos
+        record['random_state_has_gauss'] = has_gauss
+        record['random_state_cached_gaussian'] = cached_gaussian
+    else:
+        state = filter.state
+        checks.check_instance(state, kalman.KalmanFilterState)
+        record['time'] = state.time
+        record['is_posterior'] = state.is_posterior
+        record['state_mean'] = np.ravel(state.state_distr.mean)
+        record['state_cov'] = state.state_distr.cov
+    return record
+
+def load_state(filter, record):  # @ReservedAssignment
+    # Restores the filter's state from the record
+    if isinstance(filter, particle.ParticleFilter):
+        filter._time = _from_record_time(record['time'])
+        # The filter's buffers, which may be shared with worker processes (see filtering.parallel), are written in place
+        filter._prior_particles[:] = record['prior_particles']
+        filter._resampled_particles[:] = record['resampled_particles']
+        filter._resampled_particles_uptodate = bool(record['resampled_particles_uptodate'])
+        filter._log_unnormalized_weights[:] = record['log_unnormalized_weights']
+        filter._log_weights[:] = record['log_weights']
+        filter._weights[:] = record['weights']
+        filter.log_likelihood = float(record['log_likelihood'])
+        filter.effective_sample_size = float(record['effective_sample_size'])
+        filter._resample_count = int(record['resample_count'])
+        filter._random_state.set_state(('MT19937', np.array(record['random_state_key']), int(record['random_state_pos']),
+                int(record['random_state_has_gauss']), float(record['random_state_cached_gaussian'])))
+        filter._cached_prior_mean = filter._cached_prior_var = None
+        filter._cached_posterior_mean = filter._cached_posterior_var = None
+        filter._cached_resampled_mean = filter._cached_resampled_var = None
+        filter._state_distr = EmpiricalDistr(particles=filter._resampled_particles) if filter._resampled_particles_uptodate \
+                else EmpiricalDistr(particles=filter._prior_particles, weights=filter._weights)
+    else:
+        state_distr = N(mean=np.array(record['state_mean'])[:, np.newaxis], cov=np.array(record['state_cov']), copy=False)
+        filter.state = kalman.KalmanFilterState(filter, _from_record_time(record['time']), bool(record['is_posterior']), state_distr)
+
+def save_states(filters, path):
+    # Writes the states of the filters, which must have the same layout, or of the filters of a KalmanFilterBank to a
+    # memory-mapped .npy file, and returns the (memory-mapped) records
+    is_bank = isinstance(filters, kalman.KalmanFilterBank)
+    if not is_bank: filters = list(filters)
+    dtype = state_dtype(filters if is_bank else filters[0])
+    records = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=(filters.filter_count if is_bank else len(filters),))
+    if is_bank:
+        records['time'] = filters.times
+        records['state_mean'] = filters.state_means[:, :, 0]
+        records['state_cov'] = filters.state_covs
+    else:
+        for f, i in zip(filters, range(len(filters))):
+            checks.check(state_dtype(f) == dtype, 'The filters\' states have different layouts')
+            save_state(f, records[i])
+    records.flush()
+    return records
+
+def load_states(filters, path):
+    # Restores the states of the filters, or of the filters of a KalmanFilterBank, from a .npy file written by
+    # save_states, which is memory-mapped; returns its records
+    records = np.load(path, mmap_mode='r')
+    is_bank = isinstance(filters, kalman.KalmanFilterBank)
+    if not is_bank: filters = list(filters)
+    checks.check(len(records) == (filters.filter_count if is_bank else len(filters)), 'The number of records does not match the number of filters')
+    checks.check(records.dtype == state_dtype(filters if is_bank else filters[0]), 'The records\' layout does not match the filters\'')
+    if is_bank:
+        filters._times = np.array(records['time']).astype(filters._times.dtype)
+        filters._state_means = np.array(records['state_mean'])[:, :, np.newaxis]
+        filters._state_covs = np.array(records['state_cov'])
+    else:
+        for f, i in zip(filters, range(len(filters))):
+            load_state(f, records[i])
+    return records
@@ -0,0 +1,241 @@
+import numpy as np
+import scipy.linalg as la
+
+import thalesians.tsa.checks as checks
+from thalesians.tsa.distrs import NormalDistr as N
+import thalesians.tsa.filtering as filtering
+import thalesians.tsa.filtering.kalman as kalman
+import thalesians.tsa.numpyutils as npu
+import thalesians.tsa.objects as objects
+import thalesians.tsa.processes as proc
+import thalesians.tsa.randomness as rnd
+
+def gaspari_cohn(distance, half_width):
+    # The compactly supported fifth-order correlation function of Gaspari and Cohn (1999), which vanishes beyond
+    # 2 * half_width; used to build localization tapers from the distances between state components and observations
+    z = np.abs(np.asarray(distance, dtype=float)) / half_width
+    taper = np.zeros(np.shape(z))
+    near = z <= 1.
+    far = (z > 1.) & (z < 2.)
+    zn = z[near]
+    taper[near] = -.25 * zn**5 + .5 * zn**4 + .625 * zn**3 - 5. / 3. * zn**2 + 1.
+    zf = z[far]
+    taper[far] = zf**5 / 12. - .5 * zf**4 + .625 * zf**3 + 5. / 3. * zf**2 - 5. * zf + 4. - 2. / (3. * zf)
+    return taper
+
+class EnsembleKalmanFilterState(filtering.FilterState):
+    def __init__(self, filter, time, is_posterior, members, filter_name=None):  # @ReservedAssignment
+        super().__init__(filter, time, is_posterior, filter_name)
+        self._members = members
+        self._state_distr = None
+        self._to_string_helper_EnsembleKalmanFilterState = None
+        self._str_EnsembleKalmanFilterState = None
+
+    def __getstate__(self):
+        state = {
+                '_members': self._members,
+                '_state_distr': None,
+                '_to_string_helper_EnsembleKalmanFilterState': None,
+                '_str_EnsembleKalmanFilterState': None
+            }
+        state.update(super().__getstate__())
+        return state
+
+    @property
+    def members(self):
+        return self._members
+
+    @property
+    def state_distr(self):
+        # The Normal distribution with the ensemble mean and covariance; the latter is d x d and is only formed here
+        if self._state_distr is None:
+            self._state_distr = N(mean=npu.col(*np.mean(self._members, axis=0)), cov=np.cov(self._members, rowvar=False, ddof=1), copy=False)
+        return self._state_distr
+
+    def to_string_helper(self):
+        if self._to_string_helper_EnsembleKalmanFilterState is None:
+            self._to_string_helper_EnsembleKalmanFilterState = super().to_string_helper() \
+                    .set_type(self) \
+                    .add('member_count', len(self._members))
+        return self._to_string_helper_EnsembleKalmanFilterState
+
+    def __str__(self):
+        if self._str_EnsembleKalmanFilterState is None: self._str_EnsembleKalmanFilterState = self.to_string_helper().to_string()
+        return self._str_EnsembleKalmanFilterState
+
+class EnsembleKalmanFilter(objects.Named):
+    # The (stochastic, perturbed-observation) ensemble Kalman filter. The state is an (member_count, d) ensemble, which
+    # the processes propagate in a single call each if their propagate is vectorized (see npu.vectorized). The update
+    # uses the ensemble cross-covariance between the state and the observation (d x m) and the ensemble covariance of
+    # the observation (m x m), so that neither the time nor the memory scales with d^2. An observable may be localized
+    # by Schur (elementwise) products of these with tapers, e.g. built with gaspari_cohn
+    LN_2PI = np.log(2. * np.pi)
+
+    def __init__(self, time, state_distr, process, member_count=100, random_state=None,
+                 name=None, pype=None, pype_options=frozenset(filtering.FilterPypeOptions)):
+        super().__init__(name)
+        self._pype = pype
+        self._pype_options = frozenset() if (pype_options is None or pype is None) else frozenset(pype_options)
+        if not checks.is_iterable(process): process = (process,)
+        checks.check_instance(state_distr, N)
+        process = checks.check_iterable_over_instances(process, proc.SolvedItoProcess)
+        self._time = time
+        self._is_posterior = False
+        self._processes = tuple(process)
+        self._process_slices = []
+        row = 0
+        for p in self._processes:
+            self._process_slices.append(slice(row, row + p.process_dim))
+            row += p.process_dim
+        self._member_count = checks.check_int(member_count)
+        checks.check(member_count > 1, 'The ensemble must have more than one member')
+        self._random_state = rnd.random_state() if random_state is None else random_state
+        self._members = np.reshape(state_distr.sample(size=member_count, random_state=self._random_state), (member_count, row))
+        self._to_string_helper_EnsembleKalmanFilter = None
+        self._str_EnsembleKalmanFilter = None
+        if filtering.FilterPypeOptions.PRIOR_STATE in self._pype_options: self._pype.send(self.state)
+
+    @property
+    def time(self):
+        return self._time
+
+    @property
+    def member_count(self):
+        return self._member_count
+
+    @property
+    def members(self):
+        return self._members
+
+    @property
+    def state(self):
+        return EnsembleKalmanFilterState(self, self._time, self._is_posterior, self._members)
+
+    @state.setter
+    def state(self, state):
+        self._time = state.time
+        self._is_posterior = state.is_posterior
+        self._members = np.array(state.members, dtype=float)
+        self._member_count = len(self._members)
+
+    class EnsembleObservable(filtering.Observable):
+        def __init__(self, filter, name, obs_model, observed_processes, localization=None, *args, **kwargs):  # @ReservedAssignment
+            super().__init__(filter, name)
+            if not checks.is_iterable(observed_processes): observed_processes = [observed_processes]
+            observed_processes = tuple(checks.check_iterable_over_instances(observed_processes, proc.MarkovProcess))
+            if obs_model is None:
+                obs_model = kalman.LinearGaussianObsModel.create(
+                    np.eye(sum([p.process_dim for p in observed_processes])))
+            checks.check_instance(obs_model, (kalman.LinearGaussianObsModel, kalman.NonlinearObsModel))
+            self._obs_model = obs_model
+            state_idxs = []
+            for op in observed_processes:
+                matched = False
+                for ap, s in zip(self.filter._processes, self.filter._process_slices):
+                    if op is ap:
+                        matched = True
+                        state_idxs.append(np.arange(s.start, s.stop))
+                if not matched: raise ValueError('Each observed process must match an ensemble Kalman filter\'s process')
+            self._state_idxs = np.concatenate(state_idxs)
+            # The tapers of the state-observation (d x m) and observation-observation (m x m, or None) covariances
+            if localization is None: localization = (None, None)
+            self._state_obs_taper, self._obs_obs_taper = localization
+            # The observation members of the last prediction, together with the state members that they are of
+            self._predicted_obs_members = None
+
+        @property
+        def localization(self):
+            return self._state_obs_taper, self._obs_obs_taper
+
+        def _obs_members(self, members):
+            if self._predicted_obs_members is None or self._predicted_obs_members[0] is not members:
+                sub_members = members[:, self._state_idxs]
+                if isinstance(self._obs_model, kalman.LinearGaussianObsModel):
+                    obs_members = np.dot(sub_members, self._obs_model.obs_matrix.T)
+                else:
+                    obs_members = kalman._apply_to_rows(self._obs_model.obs_function, sub_members)
+                self._predicted_obs_members = (members, obs_members)
+            return self._predicted_obs_members[1]
+
+        def predict(self, time, true_value=None):
+            self.filter.predict(time, true_value)
+            members = self.filter._members
+            obs_members = self._obs_members(members)
+            member_count = len(members)
+            state_deviations = members - np.mean(members, axis=0)
+            obs_mean = np.mean(obs_members, axis=0)
+            obs_deviations = obs_members - obs_mean
+            obs_cov = np.dot(obs_deviations.T, obs_deviations) / (member_count - 1)
+            cross_cov = np.dot(obs_deviations.T, state_deviations) / (member_count - 1)
+            if self._state_obs_taper is not None: cross_cov *= np.transpose(self._state_obs_taper)
+            if self._obs_obs_taper is not None: obs_cov *= self._obs_obs_taper
+            return filtering.PredictedObs(self, time, N(mean=npu.col(*obs_mean), cov=obs_cov, copy=False), cross_cov)
+
+        def observe(self, obs, time=None, true_value=None, predicted_obs=None):
+            time, obs_distr = filtering._time_and_obs_distr(obs, time, self.filter.time)
+            if true_value is not None: true_value = npu.to_ndim_2(true_value)
+            if predicted_obs is None: predicted_obs = self.predict(time, true_value)
+            return self.filter.observe(obs_distr, predicted_obs, true_value)
+
+    def create_observable(self, obs_model, *args, localization=None):
+        return EnsembleKalmanFilter.EnsembleObservable(self, None, obs_model, args, localization)
+
+    def create_identity_observable(self, *args, localization=None):
+        return EnsembleKalmanFilter.EnsembleObservable(self, None, None, args, localization)
+
+    def create_named_observable(self, name, obs_model, *args, localization=None):
+        return EnsembleKalmanFilter.EnsembleObservable(self, name, obs_model, args, localization)
+
+    def create_named_identity_observable(self, name, *args, localization=None):
+        return EnsembleKalmanFilter.EnsembleObservable(self, name, None, args, localization)
+
+    def predict(self, time, true_value=None):
+        if time < self._time:
+            raise ValueError('Predicting the past (current time=%s, prediction time=%s)' % (self._time, time))
+        if true_value is not None and filtering.FilterPypeOptions.TRUE_VALUE in self._pype_options:
+            self._pype.send(filtering.TrueValue(self, self._time, true_value))
+        if time == self._time: return
+        members = np.empty_like(self._members)
+        for p, s in zip(self._processes, self._process_slices):
+            variates = self._random_state.normal(size=(self._member_count, p.noise_dim))
+            members[:, s] = kalman._propagate_rows(p, self._time, self._members[:, s], time, variates)
+        self._members = members
+        self._is_posterior = False
+        self._time = time
+        if filtering.FilterPypeOptions.PRIOR_STATE in self._pype_options: self._pype.send(self.state)
+
+    def observe(self, obs_distr, predicted_obs, true_value):
+        if true_value is not None and filtering.FilterPypeOptions.TRUE_VALUE in self._pype_options:
+            self._pype.send(filtering.TrueValue(self, self._time, true_value))
+        obs_members = predicted_obs.observable._obs_members(self._members)
+        innov = obs_distr.mean - predicted_obs.distr.mean
+        innov_cov = predicted_obs.distr.cov + obs_distr.cov
+        chol = la.cho_factor(innov_cov, lower=True, check_finite=False)
+        gain = la.cho_solve(chol, predicted_obs.cross_cov, check_finite=False).T
+        # Each member is moved towards its own perturbation of the observation, so that the posterior ensemble has the
+        # posterior covariance in expectation
+        obs_noise = np.dot(self._random_state.normal(size=(self._member_count, obs_distr.dim)), np.transpose(obs_distr.vol)) \
+                if np.any(obs_distr.cov) else 0.
+        self._members = self._members + np.dot(npu.to_ndim_1(obs_distr.mean) + obs_noise - obs_members, gain.T)
+        self._is_posterior = True
+        if filtering.FilterPypeOptions.POSTERIOR_STATE in self._pype_options: self._pype.send(self.state)
+
+        whitened_innov = la.solve_triangular(chol[0], innov, lower=True, check_finite=False)
+        log_det = 2. * np.sum(np.log(np.diag(chol[0])))
+        log_likelihood = -.5 * (obs_distr.dim * EnsembleKalmanFilter.LN_2PI + log_det + np.dot(whitened_innov.T, whitened_innov))
+        obs = filtering.Obs(predicted_obs.observable, self._time, obs_distr)
+        obs_result = kalman.KalmanObsResult(True, obs, predicted_obs, N(mean=innov, cov=innov_cov, copy=False), log_likelihood, gain)
+        if filtering.FilterPypeOptions.OBS_RESULT in self._pype_options: self._pype.send(obs_result)
+        return obs_result
+
+    def to_string_helper(self):
+        if self._to_string_helper_EnsembleKalmanFilter is None:
+            self._to_string_helper_EnsembleKalmanFilter = super().to_string_helper() \
+                    .set_type(self) \
+                    .add('time', self._time) \
+                    .add('member_count', self._member_count)
+        return self._to_string_helper_EnsembleKalmanFilter
+
+    def __str__(self):
+        if self._str_EnsembleKalmanFilter is None: self._str_EnsembleKalmanFilter = self.to_string_helper().to_string()
+        return self._str_EnsembleKalmanFilter
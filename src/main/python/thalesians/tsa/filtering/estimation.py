@@ -0,0 +1,259 @@
+import numpy as np
+import scipy.optimize
+
+import thalesians.tsa.checks as checks
+import thalesians.tsa.filtering.kalman as kalman
+import thalesians.tsa.numpyutils as npu
+
+# Maximum-likelihood estimation of the parameters of linear-Gaussian state-space models. A model is given by a function
+# create_model(params) -> (observable, obs_cov) that builds a Kalman filter from the parameter vector params and returns
+# a KalmanObservable of it with a LinearGaussianObsModel and the observation noise covariance R (or None, in which
+# case the obs_covs passed with the observations are used). The log-likelihood and its gradient, the score, are then
+# computed in a single pass over the observations by differentiating the Kalman filter recursion. Once the filter is in
+# its steady state (for regularly spaced observations with a constant R) the recursion is a linear time-invariant
+# system in the state mean and its derivatives, which is solved for all the remaining observations at once
+
+LN_2PI = np.log(2. * np.pi)
+
+def _regimes(time_deltas, times):
+    # Groups the time deltas into regimes of equal time deltas: for floating-point times the differences carry rounding
+    # errors of the order of the machine epsilon times the magnitude of the times, so that nominally equal time deltas
+    # are those whose sorted values do not differ by more than a multiple of this. Returns the index of the regime of
+    # each time delta and the index of the first time delta of each regime
+    unique_time_deltas, inverse = np.unique(time_deltas, return_inverse=True)
+    if np.issubdtype(time_deltas.dtype, np.floating) and len(unique_time_deltas) > 1:
+        resolution = 64. * np.finfo(float).eps * np.max(np.abs(times))
+        groups = np.concatenate(([0], np.cumsum(np.diff(unique_time_deltas) > resolution)))
+    else:
+        groups = np.arange(len(unique_time_deltas))
+    regimes = groups[inverse]
+    return regimes, np.unique(regimes, return_index=True)[1]
+
+def _prepare(kf, obss, times, obs_covs):
+    obss = np.asarray(obss, dtype=float)
+    count = len(obss)
+    checks.check(count > 0, 'There must be at least one observation')
+    obss = np.reshape(obss, (count, -1))
+    if times is None: times = np.arange(count)
+    times = np.asarray(times)
+    checks.check(len(times) == count, 'The numbers of times and of observations differ')
+    time0s = np.empty_like(times)
+    time0s[0] = kf.time
+    time0s[1:] = times[:-1]
+    time_deltas = times - time0s
+    if np.any(time_deltas < time_deltas.dtype.type(0)): raise ValueError('The times must not decrease')
+    regimes, first_idxs = _regimes(time_deltas, times)
+    time_pairs = [(time0s[i], times[i]) for i in first_idxs]
+    if obs_covs is not None:
+        obs_dim = npu.ncol(obss)
+        obs_covs = np.asarray(obs_covs, dtype=float)
+        obs_covs = np.reshape(obs_covs, (count, obs_dim, obs_dim)) if np.size(obs_covs) == count * obs_dim * obs_dim \
+                else np.reshape(obs_covs, (1, obs_dim, obs_dim))
+    # The observations from regular_from on are in a single regime, i.e. have the same time delta and R
+    irregular = regimes != regimes[-1]
+    if obs_covs is not None and len(obs_covs) > 1: irregular |= np.any(obs_covs != obs_covs[-1], axis=(1, 2))
+    irregular_idxs = np.flatnonzero(irregular)
+    regular_from = irregular_idxs[-1] + 1 if len(irregular_idxs) > 0 else 0
+    return obss, time_pairs, regimes, obs_covs, regular_from
+
+def _system(create_model, params, time_pairs):
+    # The initial state mean and covariance and, for each time delta, the transition matrix, offset and noise covariance,
+    # as well as the observation matrix and R (or None)
+    observable, obs_cov = create_model(params)
+    checks.check_instance(observable, kalman.KalmanFilter.KalmanObservable)
+    checks.check_instance(observable._obs_model, kalman.LinearGaussianObsModel)
+    kf = observable.filter
+    transitions = [kalman._linear_transition(kf._processes, time0, time) for time0, time in time_pairs]
+    obs_matrix = observable._full_obs_matrix()
+    if obs_cov is not None: obs_cov = npu.to_ndim_2(obs_cov)
+    return (npu.to_ndim_1(kf._state_distr.mean), np.asarray(kf._state_distr.cov, dtype=float),
+            np.array([t[0] for t in transitions]), np.array([t[1][:, 0] for t in transitions]), np.array([t[2] for t in transitions]),
+            np.asarray(obs_matrix, dtype=float), obs_cov)
+
+def _systems(create_model, params_batch, time_pairs, param_step, with_derivatives):
+    # The systems of the parameter vectors stacked along a leading axis and, if with_derivatives, their derivatives with
+    # respect to the parameters, by central differences, stacked along the second axis. These depend on the parameters
+    # and the distinct time deltas only, so that the recursion over the observations remains exact
+    systems, derivatives = [], []
+    for params in params_batch:
+        params = np.asarray(params, dtype=float)
+        system = _system(create_model, params, time_pairs)
+        systems.append(system)
+        if with_derivatives:
+            steps = param_step * np.maximum(1., np.abs(params))
+            param_derivatives = []
+            for i in range(len(params)):
+                step = np.zeros(len(params))
+                step[i] = steps[i]
+                system_up = _system(create_model, params + step, time_pairs)
+                system_down = _system(create_model, params - step, time_pairs)
+                param_derivatives.append([None if u is None else (u - d) / (2. * steps[i]) for u, d in zip(system_up, system_down)])
+            derivatives.append([np.array([pd[k] for pd in param_derivatives]) if len(params) > 0 and param_derivatives[0][k] is not None else None
+                    for k in range(len(system))])
+    stacked = [np.array(system) for system in list(zip(*systems))[:6]]
+    stacked.append(None if any(s[6] is None for s in systems) else np.array([s[6] for s in systems]))
+    if with_derivatives:
+        stacked_derivatives = [None if derivatives[0][k] is None else np.array([d[k] for d in derivatives]) for k in range(len(stacked))]
+    else:
+        stacked_derivatives = None
+    return stacked, stacked_derivatives
+
+def _scan(transitions, drivers):
+    # x_t = A x_{t-1} + u_t for all t at once, with x_{-1} = 0, by doubling: after the pass with step s, drivers[:, t]
+    # holds the sum over the last 2 s terms. transitions is (batch, d, d) and drivers (batch, time, d, k). For a stable A
+    # the passes stop once A^s is negligible
+    power = transitions
+    step = 1
+    count = drivers.shape[1]
+    while step < count and np.max(np.abs(power)) > np.finfo(float).eps:
+        drivers[:, step:] += np.matmul(power[:, np.newaxis], drivers[:, :-step])
+        power = np.matmul(power, power)
+        step *= 2
+    return drivers
+
+def _filter(systems, derivatives, obss, regimes, obs_covs, regular_from, steady_state_tol):
+    # The log-likelihoods (batch,) and, if derivatives are given, the scores (batch, param_count)
+    state_means0, state_covs0, transitions, offsets, noise_covs, obs_matrices, model_obs_covs = systems
+    batch_size, state_dim = state_means0.shape
+    count, obs_dim = obss.shape
+    with_derivatives = derivatives is not None
+    if with_derivatives:
+        d_state_means0, d_state_covs0, d_transitions, d_offsets, d_noise_covs, d_obs_matrices, d_model_obs_covs = derivatives
+        param_count = d_transitions.shape[1]
+    else:
+        param_count = 0
+    zeros = lambda *shape: np.zeros((batch_size, param_count) + shape)
+    if not with_derivatives:
+        d_state_means0, d_state_covs0 = zeros(state_dim), zeros(state_dim, state_dim)
+        d_transitions, d_offsets, d_noise_covs = zeros(len(transitions[0]), state_dim, state_dim), zeros(len(transitions[0]), state_dim), \
+                zeros(len(transitions[0]), state_dim, state_dim)
+        d_obs_matrices = zeros(obs_dim, state_dim)
+        d_model_obs_covs = None
+    # Bring the regimes (time deltas) to the front: (regime, batch, ...)
+    transitions, offsets, noise_covs = np.swapaxes(transitions, 0, 1), np.swapaxes(offsets, 0, 1)[..., np.newaxis], np.swapaxes(noise_covs, 0, 1)
+    d_transitions, d_offsets, d_noise_covs = np.moveaxis(d_transitions, 2, 0), np.moveaxis(d_offsets, 2, 0)[..., np.newaxis], \
+            np.moveaxis(d_noise_covs, 2, 0)
+    if model_obs_covs is not None:
+        obs_cov, d_obs_cov = model_obs_covs, (zeros(obs_dim, obs_dim) if d_model_obs_covs is None else d_model_obs_covs)
+    elif obs_covs is not None:
+        obs_cov, d_obs_cov = obs_covs[0], zeros(obs_dim, obs_dim)
+    else:
+        obs_cov, d_obs_cov = np.zeros((obs_dim, obs_dim)), zeros(obs_dim, obs_dim)
+    per_step_obs_covs = model_obs_covs is None and obs_covs is not None and len(obs_covs) > 1
+    obs_matrix, d_obs_matrix = obs_matrices, d_obs_matrices
+    obs_matrix_t = np.swapaxes(obs_matrix, -1, -2)[:, np.newaxis]
+
+    state_mean, state_cov = state_means0[..., np.newaxis], state_covs0
+    d_state_mean, d_state_cov = d_state_means0[..., np.newaxis], d_state_covs0
+    log_likelihoods = np.zeros(batch_size)
+    scores = np.zeros((batch_size, param_count))
+    prior_state_cov, d_prior_state_cov = None, None
+    ys = obss[:, :, np.newaxis]
+
+    t = 0
+    while t < count:
+        regime = regimes[t]
+        transition, d_transition = transitions[regime], d_transitions[regime]
+        if per_step_obs_covs: obs_cov = obs_covs[t]
+        # Predict
+        last_prior_state_cov, last_d_prior_state_cov = prior_state_cov, d_prior_state_cov
+        prior_state_mean = np.matmul(transition, state_mean) + offsets[regime]
+        d_prior_state_mean = np.matmul(d_transition, state_mean[:, np.newaxis]) + np.matmul(transition[:, np.newaxis], d_state_mean) + d_offsets[regime]
+        prior_state_cov = np.matmul(np.matmul(transition, state_cov), np.swapaxes(transition, -1, -2)) + noise_covs[regime]
+        x = np.matmul(np.matmul(d_transition, state_cov[:, np.newaxis]), np.swapaxes(transition, -1, -2)[:, np.newaxis])
+        d_prior_state_cov = x + np.swapaxes(x, -1, -2) + \
+                np.matmul(np.matmul(transition[:, np.newaxis], d_state_cov), np.swapaxes(transition, -1, -2)[:, np.newaxis]) + d_noise_covs[regime]
+        # Update
+        cross_cov = np.matmul(obs_matrix, prior_state_cov)
+        innov_cov = np.matmul(cross_cov, np.swapaxes(obs_matrix, -1, -2)) + obs_cov
+        x = np.matmul(d_obs_matrix, np.matmul(prior_state_cov, np.swapaxes(obs_matrix, -1, -2))[:, np.newaxis])
+        d_innov_cov = x + np.swapaxes(x, -1, -2) + np.matmul(np.matmul(obs_matrix[:, np.newaxis], d_prior_state_cov), obs_matrix_t) + d_obs_cov
+        innov_cov_chol = np.linalg.cholesky(innov_cov)
+        log_det = 2. * np.sum(np.log(np.diagonal(innov_cov_chol, axis1=-2, axis2=-1)), axis=-1)
+        innov_cov_inv = np.linalg.inv(innov_cov)
+        gain = np.matmul(np.swapaxes(cross_cov, -1, -2), innov_cov_inv)
+        d_gain = np.matmul(np.matmul(d_prior_state_cov, obs_matrix_t) + np.matmul(prior_state_cov[:, np.newaxis], np.swapaxes(d_obs_matrix, -1, -2)) -
+                np.matmul(gain[:, np.newaxis], d_innov_cov), innov_cov_inv[:, np.newaxis])
+
+        if t >= regular_from and last_prior_state_cov is not None and t > 0 and regimes[t - 1] == regime and \
+                np.allclose(prior_state_cov, last_prior_state_cov, rtol=steady_state_tol, atol=steady_state_tol) and \
+                np.allclose(d_prior_state_cov, last_d_prior_state_cov, rtol=steady_state_tol, atol=steady_state_tol):
+            break
+
+        innov = ys[t] - np.matmul(obs_matrix, prior_state_mean)
+        d_innov = -np.matmul(d_obs_matrix, prior_state_mean[:, np.newaxis]) - np.matmul(obs_matrix[:, np.newaxis], d_prior_state_mean)
+        weighted_innov = np.matmul(innov_cov_inv, innov)
+        log_likelihoods += -.5 * (obs_dim * LN_2PI + log_det + np.sum(innov * weighted_innov, axis=(1, 2)))
+        scores += -.5 * (np.einsum('bij,bpji->bp', innov_cov_inv, d_innov_cov) +
+                2. * np.sum(d_innov * weighted_innov[:, np.newaxis], axis=(2, 3)) -
+                np.sum(np.matmul(d_innov_cov, weighted_innov[:, np.newaxis]) * weighted_innov[:, np.newaxis], axis=(2, 3)))
+        state_mean = prior_state_mean + np.matmul(gain, innov)
+        d_state_mean = d_prior_state_mean + np.matmul(d_gain, innov[:, np.newaxis]) + np.matmul(gain[:, np.newaxis], d_innov)
+        x = np.matmul(d_gain, cross_cov[:, np.newaxis])
+        state_cov = prior_state_cov - np.matmul(gain, cross_cov)
+        state_cov = .5 * (state_cov + np.swapaxes(state_cov, -1, -2))
+        d_state_cov = d_prior_state_cov - x - np.swapaxes(x, -1, -2) - \
+                np.matmul(np.matmul(gain[:, np.newaxis], d_innov_cov), np.swapaxes(gain, -1, -2)[:, np.newaxis])
+        t += 1
+
+    if t < count:
+        # The steady state: with the constant gain K and the constant innovation covariance S, the posterior means follow
+        # m_t = (I - K H) (F m_{t-1} + c) + K y_t and their derivatives are driven by the means
+        ys = obss[t:]
+        offset = offsets[regime][..., 0]
+        d_offset = d_offsets[regime][..., 0]
+        i_minus_gain_obs = np.eye(state_dim) - np.matmul(gain, obs_matrix)
+        mean_transition = np.matmul(i_minus_gain_obs, transition)
+        drivers = np.einsum('bij,bj->bi', i_minus_gain_obs, offset)[:, np.newaxis] + np.einsum('bij,tj->bti', gain, ys)
+        drivers[:, 0] += np.matmul(mean_transition, state_mean)[..., 0]
+        state_means = _scan(mean_transition, drivers[..., np.newaxis])[..., 0]
+        last_state_means = np.concatenate((state_mean[:, np.newaxis, :, 0], state_means[:, :-1]), axis=1)
+        prior_state_means = np.einsum('bij,btj->bti', transition, last_state_means) + offset[:, np.newaxis]
+        innovs = ys - np.einsum('bij,btj->bti', obs_matrix, prior_state_means)
+        weighted_innovs = np.einsum('bij,btj->bti', innov_cov_inv, innovs)
+        log_likelihoods += -.5 * ((count - t) * (obs_dim * LN_2PI + log_det) + np.sum(innovs * weighted_innovs, axis=(1, 2)))
+        if param_count > 0:
+            gain_derivative = np.matmul(d_gain, obs_matrix[:, np.newaxis]) + np.matmul(gain[:, np.newaxis], d_obs_matrix)
+            i_minus_gain_obs_d_transition = np.matmul(i_minus_gain_obs[:, np.newaxis], d_transition)
+            d_drivers = -np.einsum('bpij,btj->btip', gain_derivative, prior_state_means) + \
+                    np.einsum('bpij,btj->btip', i_minus_gain_obs_d_transition, last_state_means) + \
+                    np.einsum('bij,bpj->bip', i_minus_gain_obs, d_offset)[:, np.newaxis] + \
+                    np.einsum('bpij,tj->btip', d_gain, ys)
+            d_drivers[:, 0] += np.matmul(mean_transition, np.swapaxes(d_state_mean[..., 0], -1, -2))
+            d_state_means = _scan(mean_transition, d_drivers)
+            last_d_state_means = np.concatenate((np.swapaxes(d_state_mean[..., 0], -1, -2)[:, np.newaxis], d_state_means[:, :-1]), axis=1)
+            d_prior_state_means = np.einsum('bpij,btj->btip', d_transition, last_state_means) + \
+                    np.matmul(transition[:, np.newaxis], last_d_state_means) + np.swapaxes(d_offset, -1, -2)[:, np.newaxis]
+            d_innovs = -np.einsum('bpij,btj->btip', d_obs_matrix, prior_state_means) - np.matmul(obs_matrix[:, np.newaxis], d_prior_state_means)
+            scores += -.5 * ((count - t) * np.einsum('bij,bpji->bp', innov_cov_inv, d_innov_cov) +
+                    2. * np.einsum('btip,bti->bp', d_innovs, weighted_innovs) -
+                    np.einsum('bij,bpij->bp', np.einsum('bti,btj->bij', weighted_innovs, weighted_innovs), d_innov_cov))
+
+    return log_likelihoods, scores
+
+def log_likelihood_and_score(create_model, params, obss, times=None, obs_covs=None, steady_state_tol=1e-10, param_step=1e-5):
+    # The log-likelihood of the observations and its gradient with respect to params
+    params = np.asarray(params, dtype=float)
+    observable, _ = create_model(params)
+    obss, time_pairs, regimes, obs_covs, regular_from = _prepare(observable.filter, obss, times, obs_covs)
+    systems, derivatives = _systems(create_model, (params,), time_pairs, param_step, True)
+    log_likelihoods, scores = _filter(systems, derivatives, obss, regimes, obs_covs, regular_from, steady_state_tol)
+    return log_likelihoods[0], scores[0]
+
+def log_likelihoods(create_model, params_batch, obss, times=None, obs_covs=None, steady_state_tol=1e-10):
+    # The log-likelihoods of the observations for each parameter vector (row) of params_batch, whose Kalman filters are
+    # run together as a bank, in stacked arrays
+    params_batch = npu.to_ndim_2(np.asarray(params_batch, dtype=float))
+    observable, _ = create_model(params_batch[0])
+    obss, time_pairs, regimes, obs_covs, regular_from = _prepare(observable.filter, obss, times, obs_covs)
+    systems, _ = _systems(create_model, params_batch, time_pairs, None, False)
+    return _filter(systems, None, obss, regimes, obs_covs, regular_from, steady_state_tol)[0]
+
+def fit(create_model, initial_params, obss, times=None, obs_covs=None, method='L-BFGS-B', bounds=None,
+        steady_state_tol=1e-10, param_step=1e-5, **kwargs):
+    # Maximizes the log-likelihood over the parameters with scipy.optimize.minimize, given the score as the gradient;
+    # returns its OptimizeResult, whose fun is the negated maximum log-likelihood
+    def objective(params):
+        log_likelihood, score = log_likelihood_and_score(create_model, params, obss, times, obs_covs, steady_state_tol, param_step)
+        return -log_likelihood, -score
+    return scipy.optimize.minimize(objective, np.asarray(initial_params, dtype=float), jac=True, method=method, bounds=bounds, **kwargs)
@@ -0,0 +1,69 @@
+import numpy as np
+
+from thalesians.tsa.distrs import NormalDistr as N
+import thalesians.tsa.filtering as filtering
+import thalesians.tsa.filtering.kalman as kalman
+import thalesians.tsa.numpyutils as npu
+
+def _linearize(process, time0, value0, time):
+    # The propagated value f(x, w) of the process from x = value0 with the variate w = 0 of its noise, and the Jacobians
+    # df/dx (the transition matrix) and df/dw, whose product with its transpose is the noise covariance. The 2 (d + q)
+    # points for the central differences are propagated at once
+    process_dim = process.process_dim
+    noise_dim = process.noise_dim
+    value0 = npu.to_ndim_1(value0)
+    value = kalman._propagate_rows(process, time0, value0[np.newaxis, :], time, np.zeros((1, noise_dim)))[0]
+    func = npu.vectorized(lambda z: kalman._propagate_rows(process, time0, z[:, 0:process_dim], time, z[:, process_dim:]))
+    jacobian = kalman._jacobian(func, np.concatenate((value0, np.zeros(noise_dim))))
+    return value, jacobian[:, 0:process_dim], jacobian[:, process_dim:]
+
+class ExtendedKalmanFilter(kalman.KalmanFilter):
+    # A Kalman filter for nonlinear processes and observation models (such as kalman.NonlinearObsModel), linearized
+    # about the state mean. Processes that provide their transition matrix, offset and noise covariance are propagated
+    # exactly, as in kalman.KalmanFilter; the others are linearized through their propagate method
+    def __init__(self, time, state_distr, process, update_method=kalman.KalmanFilterUpdateMethod.CHOLESKY,
+                 name=None, pype=None, pype_options=frozenset(filtering.FilterPypeOptions)):
+        super().__init__(time, state_distr, process, update_method=update_method, name=name, pype=pype, pype_options=pype_options)
+        self._to_string_helper_ExtendedKalmanFilter = None
+        self._str_ExtendedKalmanFilter = None
+
+    def predict(self, time, true_value=None):
+        if time < self._time:
+            raise ValueError('Predicting the past (current time=%s, prediction time=%s)' % (self._time, time))
+        if true_value is not None and filtering.FilterPypeOptions.TRUE_VALUE in self._pype_options:
+            self._pype.send(filtering.TrueValue(self, self._time, true_value))
+        if time == self._time: return
+        self._time_delta = time - self._time
+        state_mean = np.array(self._state_distr.mean, dtype=float)
+        state_cov = np.array(self._state_distr.cov, dtype=float)
+        for i, (p, s) in enumerate(zip(self._processes, self._process_slices)):
+            transition = None
+            if self._is_affine[i]:
+                try:
+                    transition = p.transition_matrix(self._time, time)
+                    value = np.dot(transition, state_mean[s]) + p.transition_offset(self._time, time)
+                    noise_cov = p.noise_cov(self._time, time)
+                except NotImplementedError:
+                    transition = None
+                    self._is_affine[i] = False
+            if transition is None:
+                value, transition, noise_vol = _linearize(p, self._time, state_mean[s], time)
+                value = npu.to_ndim_2(value, ndim_1_to_col=True)
+                noise_cov = np.dot(noise_vol, noise_vol.T)
+            state_mean[s] = value
+            state_cov[s, :] = np.dot(transition, state_cov[s, :])
+            state_cov[:, s] = np.dot(state_cov[:, s], transition.T)
+            state_cov[s, s] += noise_cov
+        self._state_distr = N(mean=state_mean, cov=state_cov, copy=False)
+        self._is_posterior = False
+        self._time = time
+        if filtering.FilterPypeOptions.PRIOR_STATE in self._pype_options: self._pype.send(self.state)
+
+    def to_string_helper(self):
+        if self._to_string_helper_ExtendedKalmanFilter is None:
+            self._to_string_helper_ExtendedKalmanFilter = super().to_string_helper().set_type(self)
+        return self._to_string_helper_ExtendedKalmanFilter
+
+    def __str__(self):
+        if self._str_ExtendedKalmanFilter is None: self._str_ExtendedKalmanFilter = self.to_string_helper().to_string()
+        return self._str_ExtendedKalmanFilter
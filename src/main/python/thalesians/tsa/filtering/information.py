@@ -0,0 +1,261 @@
+import numpy as np
+import scipy.linalg as la
+
+import thalesians.tsa.checks as checks
+import thalesians.tsa.distrs as distrs
+from thalesians.tsa.distrs import NormalDistr as N
+import thalesians.tsa.filtering as filtering
+import thalesians.tsa.filtering.kalman as kalman
+import thalesians.tsa.numpyutils as npu
+import thalesians.tsa.objects as objects
+import thalesians.tsa.processes as proc
+import thalesians.tsa.stats as stats
+
+class _LazyNormalDistr(N):
+    # A Normal distribution whose covariance is computed by cov_func only when it is first used; as for DiracDeltaDistr,
+    # the covariance is not passed to the constructor
+    def __init__(self, mean, cov_func):
+        distrs.Distr.__init__(self)
+        self._mean = npu.make_immutable(npu.to_ndim_2(mean, ndim_1_to_col=True, copy=True))
+        self._dim = npu.nrow(self._mean)
+        self._cov_func = cov_func
+        self._cov = None
+        self._vol = None
+        self._to_string_helper_WideSenseDistr = None
+        self._str_WideSenseDistr = None
+
+    @property
+    def cov(self):
+        if self._cov is None:
+            self._cov = npu.make_immutable(self._cov_func())
+            self._cov_func = None
+        return self._cov
+
+    @property
+    def vol(self):
+        if self._vol is None: self._vol = stats.cov_to_vol(self.cov)
+        return self._vol
+
+class InformationFilter(objects.Named):
+    # A Kalman filter in information form: the state is kept as the information matrix P^{-1} and the information vector
+    # P^{-1} m. An observation y = H x + noise(R) then adds H^T R^{-1} H and H^T R^{-1} y to these, without forming or
+    # inverting the innovation covariance, which is worthwhile when the observation is much larger than the state. The
+    # predicted observation and the innovation carry only their means; their (m x m) covariances are computed if they are
+    # read, e.g. when the observation results are recorded or published. The moment form, which the prediction needs, is
+    # likewise computed only when it is used, e.g. when the state is read
+    LN_2PI = np.log(2. * np.pi)
+
+    def __init__(self, time, state_distr, process, name=None, pype=None, pype_options=frozenset(filtering.FilterPypeOptions)):
+        super().__init__(name)
+        self._pype = pype
+        self._pype_options = frozenset() if (pype_options is None or pype is None) else frozenset(pype_options)
+        if not checks.is_iterable(process): process = (process,)
+        checks.check_instance(state_distr, N)
+        process = checks.check_iterable_over_instances(process, proc.MarkovProcess)
+        self._time = time
+        self._is_posterior = False
+        self._processes = tuple(process)
+        self._process_slices = []
+        row = 0
+        for p in self._processes:
+            self._process_slices.append(slice(row, row + p.process_dim))
+            row += p.process_dim
+        self._state_dim = row
+        # Either form may be stale (None); at least one of them is current. The Cholesky factor of the information
+        # matrix is kept along with it
+        self._state_distr = state_distr
+        self._info_matrix = None
+        self._info_vector = None
+        self._info_matrix_chol = None
+        self._to_string_helper_InformationFilter = None
+        self._str_InformationFilter = None
+        if filtering.FilterPypeOptions.PRIOR_STATE in self._pype_options: self._pype.send(self.state)
+
+    @property
+    def time(self):
+        return self._time
+
+    @property
+    def info_matrix(self):
+        self._to_information_form()
+        return self._info_matrix
+
+    @property
+    def info_vector(self):
+        self._to_information_form()
+        return self._info_vector
+
+    @property
+    def state(self):
+        return kalman.KalmanFilterState(self, self._time, self._is_posterior, self._to_moment_form())
+
+    @state.setter
+    def state(self, state):
+        self._time = state.time
+        self._is_posterior = state.is_posterior
+        self._state_distr = state.state_distr
+        self._info_matrix = None
+        self._info_vector = None
+        self._info_matrix_chol = None
+
+    def _to_information_form(self):
+        if self._info_matrix is None:
+            state_cov_chol = la.cho_factor(self._state_distr.cov, lower=True, check_finite=False)
+            info_matrix = la.cho_solve(state_cov_chol, np.eye(self._state_dim), check_finite=False)
+            self._info_matrix = .5 * (info_matrix + info_matrix.T)
+            self._info_vector = la.cho_solve(state_cov_chol, self._state_distr.mean, check_finite=False)
+            self._info_matrix_chol = None
+        return self._info_matrix, self._info_vector
+
+    def _info_matrix_cholesky(self):
+        if self._info_matrix_chol is None:
+            self._info_matrix_chol = la.cho_factor(self._to_information_form()[0], lower=True, check_finite=False)
+        return self._info_matrix_chol
+
+    def _state_mean(self):
+        # The state mean, which, in information form, takes a single solve rather than the full moment form
+        if self._state_distr is not None: return self._state_distr.mean
+        return la.cho_solve(self._info_matrix_cholesky(), self._info_vector, check_finite=False)
+
+    def _state_cov_func(self):
+        # A function computing the current state covariance, even if it is called after the state has changed
+        state_distr = self._state_distr
+        if state_distr is not None: return lambda: state_distr.cov
+        info_matrix_chol = self._info_matrix_cholesky()
+        return lambda: la.cho_solve(info_matrix_chol, np.eye(self._state_dim), check_finite=False)
+
+    def _to_moment_form(self):
+        if self._state_distr is None:
+            info_matrix_chol = self._info_matrix_cholesky()
+            state_cov = la.cho_solve(info_matrix_chol, np.eye(self._state_dim), check_finite=False)
+            state_mean = la.cho_solve(info_matrix_chol, self._info_vector, check_finite=False)
+            self._state_distr = N(mean=state_mean, cov=.5 * (state_cov + state_cov.T), copy=False)
+        return self._state_distr
+
+    class InformationObservable(filtering.Observable):
+        def __init__(self, filter, name, obs_model, observed_processes, *args, **kwargs):  # @ReservedAssignment
+            super().__init__(filter, name)
+            if not checks.is_iterable(observed_processes): observed_processes = [observed_processes]
+            observed_processes = tuple(checks.check_iterable_over_instances(observed_processes, proc.MarkovProcess))
+            if obs_model is None:
+                obs_model = kalman.LinearGaussianObsModel.create(
+                    np.eye(sum([p.process_dim for p in observed_processes])))
+            self._obs_model = checks.check_instance(obs_model, kalman.LinearGaussianObsModel)
+            state_idxs = []
+            for op in observed_processes:
+                matched = False
+                for ap, s in zip(self.filter._processes, self.filter._process_slices):
+                    if op is ap:
+                        matched = True
+                        state_idxs.append(np.arange(s.start, s.stop))
+                if not matched: raise ValueError('Each observed process must match an information filter\'s process')
+            obs_matrix = obs_model.obs_matrix
+            full_obs_matrix = np.zeros((npu.nrow(obs_matrix), self.filter._state_dim))
+            full_obs_matrix[:, np.concatenate(state_idxs)] = obs_matrix
+            self._obs_matrix = npu.make_immutable(full_obs_matrix)
+
+        @property
+        def obs_matrix(self):
+            return self._obs_matrix
+
+        def predict(self, time, true_value=None):
+            # The predicted observation's covariance, H P H^T, is computed only if it is read; the cross-covariance, which
+            # the update does not need, is not computed
+            self.filter.predict(time, true_value)
+            obs_matrix = self._obs_matrix
+            state_cov_func = self.filter._state_cov_func()
+            obs_distr = _LazyNormalDistr(np.dot(obs_matrix, self.filter._state_mean()),
+                    lambda: np.dot(np.dot(obs_matrix, state_cov_func()), obs_matrix.T))
+            return filtering.PredictedObs(self, time, obs_distr, None)
+
+        def observe(self, obs, time=None, true_value=None, predicted_obs=None):
+            time, obs_distr = filtering._time_and_obs_distr(obs, time, self.filter.time)
+            if true_value is not None: true_value = npu.to_ndim_2(true_value)
+            if predicted_obs is None: predicted_obs = self.predict(time, true_value)
+            return self.filter.observe(obs_distr, predicted_obs, true_value)
+
+    def create_observable(self, obs_model, *args):
+        return InformationFilter.InformationObservable(self, None, obs_model, args)
+
+    def create_identity_observable(self, *args):
+        return InformationFilter.InformationObservable(self, None, None, args)
+
+    def create_named_observable(self, name, obs_model, *args):
+        return InformationFilter.InformationObservable(self, name, obs_model, args)
+
+    def create_named_identity_observable(self, name, *args):
+        return InformationFilter.InformationObservable(self, name, None, args)
+
+    def predict(self, time, true_value=None):
+        if time < self._time:
+            raise ValueError('Predicting the past (current time=%s, prediction time=%s)' % (self._time, time))
+        if true_value is not None and filtering.FilterPypeOptions.TRUE_VALUE in self._pype_options:
+            self._pype.send(filtering.TrueValue(self, self._time, true_value))
+        if time == self._time: return
+        state_distr = self._to_moment_form()
+        transition, offset, noise_cov = kalman._linear_transition(self._processes, self._time, time)
+        state_mean = np.dot(transition, state_distr.mean) + offset
+        state_cov = np.dot(np.dot(transition, state_distr.cov), transition.T) + noise_cov
+        self._state_distr = N(mean=state_mean, cov=state_cov, copy=False)
+        self._info_matrix = None
+        self._info_vector = None
+        self._info_matrix_chol = None
+        self._is_posterior = False
+        self._time = time
+        if filtering.FilterPypeOptions.PRIOR_STATE in self._pype_options: self._pype.send(self.state)
+
+    def observe(self, obs_distr, predicted_obs, true_value):
+        if true_value is not None and filtering.FilterPypeOptions.TRUE_VALUE in self._pype_options:
+            self._pype.send(filtering.TrueValue(self, self._time, true_value))
+        obs_matrix = predicted_obs.observable.obs_matrix
+        obs_cov = obs_distr.cov
+        # H^T R^{-1}, by scaling if R is diagonal and otherwise with a Cholesky factorization of R (only)
+        obs_cov_chol = None
+        if kalman._is_diagonal(obs_cov):
+            obs_vars = np.diagonal(obs_cov)
+            weighted_obs_matrix_t = obs_matrix.T / obs_vars
+            log_det_obs_cov = np.sum(np.log(obs_vars))
+        else:
+            obs_cov_chol = la.cho_factor(obs_cov, lower=True, check_finite=False)
+            weighted_obs_matrix_t = la.cho_solve(obs_cov_chol, obs_matrix, check_finite=False).T
+            log_det_obs_cov = 2. * np.sum(np.log(np.diag(obs_cov_chol[0])))
+        info_matrix, info_vector = self._to_information_form()
+        prior_log_det_info_matrix = 2. * np.sum(np.log(np.diag(self._info_matrix_cholesky()[0])))
+        innov = obs_distr.mean - predicted_obs.distr.mean
+        self._info_matrix = info_matrix + np.dot(weighted_obs_matrix_t, obs_matrix)
+        self._info_vector = info_vector + np.dot(weighted_obs_matrix_t, obs_distr.mean)
+        self._info_matrix_chol = None
+        self._state_distr = None
+        info_matrix_chol = self._info_matrix_cholesky()
+        # The log-likelihood of the innovation v ~ N(0, S), S = H P H^T + R, follows without S^{-1} from the matrix
+        # determinant lemma, ln |S| = ln |R| + ln |P_+^{-1}| - ln |P^{-1}|, and the Woodbury identity,
+        # v^T S^{-1} v = v^T R^{-1} v - u^T P_+ u with u = H^T R^{-1} v
+        weighted_innov = np.dot(weighted_obs_matrix_t, innov)
+        log_det = log_det_obs_cov + 2. * np.sum(np.log(np.diag(info_matrix_chol[0]))) - prior_log_det_info_matrix
+        if obs_cov_chol is None: whitened_innov_sq = np.dot(innov.T, innov / npu.col(*obs_vars))
+        else: whitened_innov_sq = np.dot(innov.T, la.cho_solve(obs_cov_chol, innov, check_finite=False))
+        mahalanobis_sq = whitened_innov_sq - np.dot(weighted_innov.T, la.cho_solve(info_matrix_chol, weighted_innov, check_finite=False))
+        log_likelihood = -.5 * (obs_distr.dim * InformationFilter.LN_2PI + log_det + mahalanobis_sq)
+        # The gain, P_+ H^T R^{-1}
+        gain = la.cho_solve(info_matrix_chol, weighted_obs_matrix_t, check_finite=False)
+        self._is_posterior = True
+        if filtering.FilterPypeOptions.POSTERIOR_STATE in self._pype_options: self._pype.send(self.state)
+
+        obs = filtering.Obs(predicted_obs.observable, self._time, obs_distr)
+        predicted_obs_distr = predicted_obs.distr
+        innov_distr = _LazyNormalDistr(innov, lambda: predicted_obs_distr.cov + obs_cov)
+        obs_result = kalman.KalmanObsResult(True, obs, predicted_obs, innov_distr, log_likelihood, gain)
+        if filtering.FilterPypeOptions.OBS_RESULT in self._pype_options: self._pype.send(obs_result)
+        return obs_result
+
+    def to_string_helper(self):
+        if self._to_string_helper_InformationFilter is None:
+            self._to_string_helper_InformationFilter = super().to_string_helper() \
+                    .set_type(self) \
+                    .add('time', self._time) \
+                    .add('state_distr', self._to_moment_form())
+        return self._to_string_helper_InformationFilter
+
+    def __str__(self):
+        if self._str_InformationFilter is None: self._str_InformationFilter = self.to_string_helper().to_string()
+        return self._str_InformationFilter
@@ -1,12 +1,17 @@
+import enum
+
 import numpy as np
+import scipy.linalg as la
 from scipy.linalg import block_diag
 
 import thalesians.tsa.checks as checks
+import thalesians.tsa.distrs as distrs
 from thalesians.tsa.distrs import NormalDistr as N
 import thalesians.tsa.filtering as filtering
 import thalesians.tsa.numpyutils as npu
 import thalesians.tsa.objects as objects
 import thalesians.tsa.processes as proc
+from thalesians.tsa.strings import ToStringHelper
 
 class KalmanObsResult(filtering.ObsResult):
     def __init__(self, accepted, obs, predicted_obs, innov_distr, log_likelihood, gain):
@@ -85,6 +90,76 @@ class LinearGaussianObsModel(KalmanFilterObsModel):
         if self._str_LinearGaussianObsModel is None: self._str_LinearGaussianObsModel = self.to_string_helper().to_string()
         return self._str_LinearGaussianObsModel
 
+def _apply_to_rows(func, rows):
+    # Applies the function to each row, in a single call if it is vectorized (see npu.vectorized) and otherwise to each
+    # row in turn as a column; the results are returned as rows
+    if npu.is_vectorized(func): return np.reshape(func(rows), (npu.nrow(rows), -1))
+    return np.vstack([npu.to_ndim_1(func(npu.col(*row))) for row in rows])
+
+def _propagate_rows(process, time0, values0, time, variates):
+    # Propagates the values (rows) of the process with the given variates (rows) of its noise, in a single call if the
+    # process's propagate is vectorized (see npu.vectorized)
+    if npu.is_vectorized(process.propagate):
+        return np.reshape(process.propagate(time0, values0, time, variate=variates), np.shape(values0))
+    return np.vstack([npu.to_ndim_1(process.propagate(time0, npu.col(*v), time, variate=npu.col(*w))) for v, w in zip(values0, variates)])
+
+def _jacobian(func, x, step=None):
+    # The Jacobian of the function at x (a column) by central differences, evaluating the function at all the 2 * dim(x)
+    # points at once
+    x = npu.to_ndim_1(x)
+    dim = len(x)
+    if step is None: step = np.cbrt(np.finfo(float).eps)
+    steps = step * np.maximum(1., np.abs(x))
+    points = np.vstack((x + np.diag(steps), x - np.diag(steps)))
+    values = _apply_to_rows(func, points)
+    return ((values[0:dim] - values[dim:]) / (2. * steps[:, np.newaxis])).T
+
+class NonlinearObsModel(KalmanFilterObsModel):
+    # The observation is obs_function(x) plus the (Normal) observation noise, where x is the state of the observed
+    # processes. The obs_function (and obs_jacobian, if given) take x as a column or, if vectorized (see npu.vectorized),
+    # several states as rows; without obs_jacobian the Jacobian is computed by central differences
+    def __init__(self, obs_function, obs_jacobian=None):
+        super().__init__()
+        self._obs_function = checks.check_callable(obs_function)
+        self._obs_jacobian = obs_jacobian
+        self._to_string_helper_NonlinearObsModel = None
+        self._str_NonlinearObsModel = None
+    
+    @staticmethod
+    def create(obs_function, obs_jacobian=None):
+        return NonlinearObsModel(obs_function, obs_jacobian)
+    
+    @property
+    def obs_function(self):
+        return self._obs_function
+    
+    @property
+    def obs_jacobian(self):
+        return self._obs_jacobian
+    
+    def obs_matrix_at(self, state_mean):
+        if self._obs_jacobian is not None: return npu.to_ndim_2(self._obs_jacobian(state_mean), ndim_1_to_col=False)
+        return _jacobian(self._obs_function, state_mean)
+    
+    def predict_obs(self, time, state_distr, observable=None):
+        # Linearized about the state mean, as in the extended Kalman filter
+        obs_mean = _apply_to_rows(self._obs_function, state_distr.mean.T).T
+        obs_matrix = self.obs_matrix_at(state_distr.mean)
+        cross_cov = np.dot(obs_matrix, state_distr.cov)
+        obs_cov = np.dot(cross_cov, obs_matrix.T)
+        return filtering.PredictedObs(observable, time, N(mean=obs_mean, cov=obs_cov), cross_cov)
+    
+    def to_string_helper(self):
+        if self._to_string_helper_NonlinearObsModel is None:
+            self._to_string_helper_NonlinearObsModel = super().to_string_helper() \
+                    .set_type(self) \
+                    .add('obs_function', self._obs_function)
+        return self._to_string_helper_NonlinearObsModel
+    
+    def __str__(self):
+        if self._str_NonlinearObsModel is None: self._str_NonlinearObsModel = self.to_string_helper().to_string()
+        return self._str_NonlinearObsModel
+
 class KalmanFilterState(filtering.FilterState):
     def __init__(self, filter, time, is_posterior, state_distr, filter_name=None):  # @ReservedAssignment
         super().__init__(filter, time, is_posterior, filter_name)
@@ -116,10 +191,230 @@ class KalmanFilterState(filtering.FilterState):
         if self._str_KalmanFilterState is None: self._str_KalmanFilterState = self.to_string_helper().to_string()
         return self._str_KalmanFilterState
 
+def _affine_transition(processes, time0, time):
+    # For a linear-Gaussian process the propagated mean is affine in the initial mean, so the transition matrix, offset
+    # and noise covariance can be read off from process_dim + 1 propagations of degenerate distributions
+    state_dim = sum([p.process_dim for p in processes])
+    transition = np.zeros((state_dim, state_dim))
+    offset = np.zeros((state_dim, 1))
+    noise_cov = np.zeros((state_dim, state_dim))
+    row = 0
+    for p in processes:
+        process_dim = p.process_dim
+        zero_cov = np.zeros((process_dim, process_dim))
+        distr = p.propagate_distr(time0, N(mean=npu.col_of(process_dim, 0.), cov=zero_cov), time)
+        if not isinstance(distr, N):
+            raise ValueError('The propagated state distribution is not Normal; only linear-Gaussian processes have an affine transition')
+        offset[row:row+process_dim, :] = distr.mean
+        noise_cov[row:row+process_dim, row:row+process_dim] = distr.cov
+        for j in range(process_dim):
+            basis_distr = p.propagate_distr(time0, N(mean=np.eye(process_dim)[:, j:j+1], cov=zero_cov), time)
+            transition[row:row+process_dim, row+j:row+j+1] = basis_distr.mean - distr.mean
+        row += process_dim
+    return transition, offset, noise_cov
+
+def _run_linear_gaussian(observable, obss, times, obs_covs, true_values, return_df):
+    # The whole-array counterpart of filtering.run for a single KalmanObservable with a LinearGaussianObsModel: a tight
+    # loop over preallocated arrays that does not create per-step distributions, observations and results. Returns None
+    # if the arguments are not all numeric arrays, in which case the generic loop is used
+    kf = observable.filter
+    if kf._pype_options: return None
+    if not checks.is_numpy_array(obss) or not np.issubdtype(obss.dtype, np.number) or len(obss) == 0: return None
+    for arg in (times, obs_covs, true_values):
+        if arg is not None and not checks.is_numpy_array(arg): return None
+    if times is not None and (not (np.issubdtype(times.dtype, np.number) or np.issubdtype(times.dtype, np.datetime64)) \
+            or len(times) != len(obss)): return None
+    if obs_covs is not None and (not np.issubdtype(obs_covs.dtype, np.number) or len(obs_covs) != len(obss)): return None
+    if true_values is not None and len(true_values) != len(obss): return None
+    
+    obs_matrix = observable._full_obs_matrix()
+    obs_dim, state_dim = obs_matrix.shape
+    count = len(obss)
+    if np.size(obss) != count * obs_dim: return None
+    obss = np.reshape(obss.astype(float), (count, obs_dim))
+    if obs_covs is not None:
+        if np.size(obs_covs) != count * obs_dim * obs_dim: return None
+        obs_covs = np.reshape(obs_covs.astype(float), (count, obs_dim, obs_dim))
+    if times is None: times = np.arange(count)
+    
+    time = kf._time
+    initial_time, initial_state_distr = time, kf._state_distr
+    state_mean = npu.to_ndim_1(initial_state_distr.mean, copy=True).astype(float)
+    state_cov = np.array(initial_state_distr.cov, dtype=float)
+    # Cache the transitions by time delta: regularly spaced series need a single one. They are read from the processes'
+    # own (cached) transition matrices, as in KalmanFilter.predict
+    transitions = {}
+    zero_obs_cov = np.zeros((obs_dim, obs_dim))
+    
+    cumulative_log_likelihood = 0.
+    if return_df:
+        # One row per step plus the row of the initial state, as recorded by filtering.run
+        prior_state_means = np.empty((count + 1, state_dim))
+        prior_state_covs = np.empty((count + 1, state_dim, state_dim))
+        posterior_state_means = np.empty((count + 1, state_dim))
+        posterior_state_covs = np.empty((count + 1, state_dim, state_dim))
+        prior_state_means[0] = posterior_state_means[0] = state_mean
+        prior_state_covs[0] = posterior_state_covs[0] = state_cov
+        predicted_obs_means = np.full((count + 1, obs_dim), np.nan)
+        predicted_obs_covs = np.full((count + 1, obs_dim, obs_dim), np.nan)
+        cross_covs = np.full((count + 1, obs_dim, state_dim), np.nan)
+        innov_means = np.full((count + 1, obs_dim), np.nan)
+        innov_covs = np.full((count + 1, obs_dim, obs_dim), np.nan)
+        log_likelihoods = np.full((count + 1,), np.nan)
+        gains = np.full((count + 1, state_dim, obs_dim), np.nan)
+    
+    for i in range(1, count + 1):
+        a_time = times[i - 1]
+        if a_time < time:
+            raise ValueError('Predicting the past (current time=%s, prediction time=%s)' % (time, a_time))
+        if a_time != time:
+            time_delta = a_time - time
+            transition = transitions.get(time_delta)
+            if transition is None:
+                try:
+                    transition = _linear_transition(kf._processes, time, a_time)
+                except ValueError:
+                    # Only the first transition can fail, as the result depends on the processes and not on the delta
+                    if i == 1: return None
+                    raise
+                transitions[time_delta] = transition
+            transition_matrix, offset, noise_cov = transition
+            state_mean = np.dot(transition_matrix, state_mean) + offset[:, 0]
+            state_cov = np.dot(np.dot(transition_matrix, state_cov), transition_matrix.T) + noise_cov
+            time = a_time
+        if return_df:
+            prior_state_means[i] = state_mean
+            prior_state_covs[i] = state_cov
+        
+        predicted_obs_mean = np.dot(obs_matrix, state_mean)
+        cross_cov = np.dot(obs_matrix, state_cov)
+        predicted_obs_cov = np.dot(cross_cov, obs_matrix.T)
+        innov = obss[i - 1] - predicted_obs_mean
+        innov_cov = predicted_obs_cov + (zero_obs_cov if obs_covs is None else obs_covs[i - 1])
+        # The inverse L^{-1} of the Cholesky factor of the (small) innovation covariance whitens the innovation and the
+        # cross-covariance; this avoids the per-call overhead of the general triangular solvers. The explicit inverse
+        # of the INVERSE update method does not need the innovation covariance to be positive definite, so in that case
+        # the generic loop is left to handle it (the filter's state has not been changed yet)
+        try:
+            if obs_dim == 1:
+                if not innov_cov[0, 0] > 0.: raise np.linalg.LinAlgError('Matrix is not positive definite')
+                chol_inv = 1. / np.sqrt(innov_cov)
+            else:
+                chol_inv = np.linalg.inv(np.linalg.cholesky(innov_cov))
+        except np.linalg.LinAlgError:
+            if kf.update_method == KalmanFilterUpdateMethod.INVERSE: return None
+            raise
+        whitened_innov = np.dot(chol_inv, innov)
+        whitened_cross_cov = np.dot(chol_inv, cross_cov)
+        gain = np.dot(whitened_cross_cov.T, chol_inv)
+        state_mean = state_mean + np.dot(whitened_cross_cov.T, whitened_innov)
+        state_cov = state_cov - np.dot(whitened_cross_cov.T, whitened_cross_cov)
+        log_likelihood = -.5 * (obs_dim * KalmanFilter.LN_2PI - 2. * np.sum(np.log(np.diag(chol_inv))) + \
+                np.dot(whitened_innov, whitened_innov))
+        cumulative_log_likelihood += log_likelihood
+        
+        if return_df:
+            posterior_state_means[i] = state_mean
+            posterior_state_covs[i] = state_cov
+            predicted_obs_means[i] = predicted_obs_mean
+            predicted_obs_covs[i] = predicted_obs_cov
+            cross_covs[i] = cross_cov
+            innov_means[i] = innov
+            innov_covs[i] = innov_cov
+            log_likelihoods[i] = log_likelihood
+            gains[i] = gain
+        
+    kf.state = KalmanFilterState(kf, time, True, N(mean=npu.col(*state_mean), cov=state_cov, copy=False))
+    
+    last_obs_distr = distrs.DiracDeltaDistr(npu.col(*obss[-1])) if obs_covs is None \
+            else N(mean=npu.col(*obss[-1]), cov=obs_covs[-1], copy=False)
+    last_obs_result = KalmanObsResult(True,
+            filtering.Obs(observable, time, last_obs_distr),
+            filtering.PredictedObs(observable, time, N(mean=npu.col(*predicted_obs_mean), cov=predicted_obs_cov, copy=False), cross_cov),
+            N(mean=npu.col(*innov), cov=innov_cov, copy=False),
+            npu.to_ndim_2(log_likelihood), gain)
+    # As accumulated by filtering.run from the results' log-likelihoods, a 1x1 matrix
+    cumulative_log_likelihood = npu.to_ndim_2(cumulative_log_likelihood)
+    
+    if not return_df: return filtering.FilterRunResult(last_obs_result, cumulative_log_likelihood)
+    
+    time_column = np.empty((count + 1,), dtype=object)
+    time_column[0] = initial_time
+    time_column[1:] = list(times)
+    obs_means = np.vstack((np.full((1, obs_dim), np.nan), obss))
+    obs_cov_column = np.concatenate((np.full((1, obs_dim, obs_dim), np.nan), np.zeros((count, obs_dim, obs_dim)) if obs_covs is None else obs_covs))
+    if true_values is not None:
+        try:
+            true_values = np.vstack((np.full((1, np.size(true_values) // count), np.nan), np.reshape(true_values.astype(float), (count, -1))))
+        except (TypeError, ValueError):
+            true_values = np.concatenate(([None], true_values))
+    accepted = np.full((count + 1,), True, dtype=object)
+    accepted[0] = None
+    observable_names = np.full((count + 1,), observable.name, dtype=object)
+    observable_names[0] = None
+    
+    arrays = {
+            'time': time_column,
+            'filter_name': np.full((count + 1,), kf.name, dtype=object),
+            'filter_type': np.full((count + 1,), type(kf), dtype=object),
+            'observable_name': observable_names,
+            'accepted': accepted,
+            'obs_mean': obs_means,
+            'obs_cov': obs_cov_column,
+            'predicted_obs_mean': predicted_obs_means,
+            'predicted_obs_cov': predicted_obs_covs,
+            'cross_cov': cross_covs,
+            'innov_mean': innov_means,
+            'innov_cov': innov_covs,
+            'prior_state_mean': prior_state_means,
+            'prior_state_cov': prior_state_covs,
+            'posterior_state_mean': posterior_state_means,
+            'posterior_state_cov': posterior_state_covs,
+            'true_value': true_values,
+            'log_likelihood': log_likelihoods,
+            'gain': gains}
+    
+    # The row of the initial state has no observation
+    initial_row = np.zeros((count + 1,), dtype=bool)
+    initial_row[0] = True
+    empty_rows = {column: initial_row for column in ('obs_mean', 'obs_cov', 'predicted_obs_mean', 'predicted_obs_cov',
+                                                     'cross_cov', 'innov_mean', 'innov_cov', 'log_likelihood', 'gain')}
+    if true_values is not None and true_values.dtype == float: empty_rows['true_value'] = initial_row
+    
+    return filtering.FilterRunResult(last_obs_result, cumulative_log_likelihood, arrays=arrays, empty_rows=empty_rows)
+
+def _linear_transition(processes, time0, time):
+    # The transition matrix, offset and noise covariance of the compound process, x -> F x + c + noise(Q)
+    transitions, offsets, noise_covs = [], [], []
+    for p in processes:
+        try:
+            transition, offset, noise_cov = p.transition_matrix(time0, time), p.transition_offset(time0, time), p.noise_cov(time0, time)
+        except NotImplementedError:
+            transition, offset, noise_cov = _affine_transition((p,), time0, time)
+        transitions.append(transition)
+        offsets.append(npu.to_ndim_2(offset, ndim_1_to_col=True, copy=False))
+        noise_covs.append(noise_cov)
+    return block_diag(*transitions), np.vstack(offsets), block_diag(*noise_covs)
+
+def _is_diagonal(matrix):
+    return np.count_nonzero(matrix) == np.count_nonzero(np.diagonal(matrix))
+
+class KalmanFilterUpdateMethod(enum.Enum):
+    # Explicit inverse and determinant of the innovation covariance
+    INVERSE = 1
+    # A single Cholesky factorization of the innovation covariance and triangular solves
+    CHOLESKY = 2
+    # Square-root (covariance factor) update via a QR decomposition of the pre-array
+    SQUARE_ROOT = 3
+    # Scalar updates, one observation component at a time, for linear-Gaussian observation models with diagonal
+    # observation noise (detected); missing (NaN) components are skipped. Otherwise as CHOLESKY
+    SEQUENTIAL = 4
+
 class KalmanFilter(objects.Named):
     LN_2PI = np.log(2. * np.pi)
     
     def __init__(self, time, state_distr, process, approximate_distr=False,
+                 update_method=KalmanFilterUpdateMethod.INVERSE, steady_state_tol=None,
                  name=None, pype=None, pype_options=frozenset(filtering.FilterPypeOptions)):
         super().__init__(name)
         self._pype = pype
@@ -131,7 +426,29 @@ class KalmanFilter(objects.Named):
         self._state_distr = state_distr
         self._is_posterior = False
         self._processes = tuple(process)
+        # The rows (and columns) of each process's block in the state mean (and covariance)
+        self._process_slices = []
+        row = 0
+        for p in self._processes:
+            self._process_slices.append(slice(row, row + p.process_dim))
+            row += p.process_dim
+        # Whether each process is known to provide its transition matrix, offset and noise covariance
+        self._is_affine = [True] * len(self._processes)
         self._approximate_distr = approximate_distr
+        self._update_method = checks.check_instance(update_method, KalmanFilterUpdateMethod)
+        self._steady_state_tol = steady_state_tol
+        # The time delta of the last (non-trivial) prediction
+        self._time_delta = None
+        # The regime (time delta, observable, observation covariance), gain and posterior covariance of the last update
+        self._last_update = None
+        # The frozen regime, gain, posterior covariance, innovation covariance factor, innovation covariance, prior
+        # covariance and cross-covariance, once converged (or solved for)
+        self._steady_state = None
+        # Whether the frozen steady state was solved for, in which case it applies to every update in its regime, rather
+        # than detected, in which case it applies only while the state covariance is the frozen posterior covariance
+        self._is_steady_state_solved = False
+        # Whether the current state covariance is the frozen posterior covariance
+        self._is_steady_state = False
         self._to_string_helper_KalmanFilter = None
         self._str_KalmanFilter = None
         if filtering.FilterPypeOptions.PRIOR_STATE in self._pype_options: self._pype.send(self.state)
@@ -140,6 +457,18 @@ class KalmanFilter(objects.Named):
     def time(self):
         return self._time
     
+    @property
+    def update_method(self):
+        return self._update_method
+    
+    @property
+    def steady_state_tol(self):
+        return self._steady_state_tol
+    
+    @property
+    def is_steady_state(self):
+        return self._is_steady_state
+    
     @property
     def state(self):
         return KalmanFilterState(self, self._time, self._is_posterior, self._state_distr)
@@ -149,6 +478,9 @@ class KalmanFilter(objects.Named):
         self._time = state.time
         self._is_posterior = state.is_posterior
         self._state_distr = state._state_distr
+        self._time_delta = None
+        self._last_update = None
+        self._is_steady_state = False
 
     class KalmanObservable(filtering.Observable):
         def __init__(self, filter, name, obs_model, observed_processes, *args, **kwargs):  # @ReservedAssignment
@@ -156,66 +488,86 @@ class KalmanFilter(objects.Named):
             if not checks.is_iterable(observed_processes): observed_processes = [observed_processes]
             observed_processes = tuple(checks.check_iterable_over_instances(observed_processes, proc.MarkovProcess))
             if obs_model is None:
-                obs_model = KalmanFilterObsModel.create(
+                obs_model = LinearGaussianObsModel.create(
                     np.eye(sum([p.process_dim for p in observed_processes])))
             self._obs_model = obs_model
-            self._state_mean_rects = []
-            self._state_cov_diag_rects = []
+            state_idxs = []
             for op in observed_processes:
                 matched = False
-                row = 0
-                for ap in self.filter._processes:
-                    process_dim = ap.process_dim
+                for ap, s in zip(self.filter._processes, self.filter._process_slices):
                     if op is ap:
                         matched = True
-                        self._state_mean_rects.append(np.s_[row:row+process_dim, 0:1])
-                        self._state_cov_diag_rects.append(np.s_[row:row+process_dim, row:row+process_dim])
-                    row += process_dim
+                        state_idxs.append(np.arange(s.start, s.stop))
                 if not matched: raise ValueError('Each observed process must match a Kalman filter\'s process')
-            self._state_cov_rects = []
-            for r in self._state_cov_diag_rects:
-                startrow = r[0].start
-                stoprow = r[0].stop
-                rects = []
-                for r1 in self._state_cov_diag_rects:
-                    startcol = r1[1].start
-                    stopcol = r1[1].stop
-                    rects.append(np.s_[startrow:stoprow, startcol:stopcol])
-                self._state_cov_rects.append(rects)
+            # Fancy indices of the observed processes' components in the state mean and covariance, computed once
+            self._state_idxs = np.concatenate(state_idxs)
+            self._state_cov_idxs = np.ix_(self._state_idxs, self._state_idxs)
+            self._full_obs_matrix_cache = None
                 
         def _sub_state_mean(self, state_mean):
-            return np.vstack([state_mean[r] for r in self._state_mean_rects])
+            return state_mean[self._state_idxs]
         
         def _sub_state_cov(self, state_cov):
-            return np.vstack([np.hstack([state_cov[r] for r in rs]) for rs in self._state_cov_rects])
+            return state_cov[self._state_cov_idxs]
         
         def _sub_state_distr(self, state_distr):
             return N(mean=self._sub_state_mean(state_distr.mean), cov=self._sub_state_cov(state_distr.cov), copy=False)
         
+        def _full_obs_matrix(self):
+            if self._full_obs_matrix_cache is None:
+                obs_matrix = self._obs_model.obs_matrix
+                full_obs_matrix = np.zeros((npu.nrow(obs_matrix), self.filter._state_distr.dim))
+                full_obs_matrix[:, self._state_idxs] = obs_matrix
+                self._full_obs_matrix_cache = npu.make_immutable(full_obs_matrix)
+            return self._full_obs_matrix_cache
+        
         def predict(self, time, true_value=None):
             self.filter.predict(time, true_value)
-            predicted_obs = self._obs_model.predict_obs(time, self._sub_state_distr(self.filter._state_distr), self)
+            return self._predict_obs(time)
+        
+        def _predict_obs(self, time):
+            predicted_obs = self.filter._predict_obs(self._obs_model, time, self._sub_state_distr(self.filter._state_distr), self)
             
             cc = predicted_obs.cross_cov
             
             # While cc is the cross-covariance between the "observed" processes and the observation, we need the
-            # cross-covariance between the full compound process and the observation. Therefore we enlarge this matrix
-            # by inserting columns of zeros at appropriate indices
-            cc_nrow = npu.nrow(cc)
-            cross_cov = np.zeros((cc_nrow, self.filter._state_distr.dim))
-            col = 0
-            for r in self._state_mean_rects:
-                size = r[0].stop - r[0].start
-                cross_cov[0:cc_nrow, r[0].start:r[0].start+size] = cc[0:cc_nrow, col:col+size]
-                col += size
+            # cross-covariance between the full compound process and the observation. The processes that are not
+            # observed are correlated with the observation through their cross-covariances with the observed ones: for
+            # a linear observation model this is H P[idxs, :]; otherwise we regress them on the observed processes
+            if len(self._state_idxs) == self.filter._state_distr.dim:
+                cross_cov = np.empty((npu.nrow(cc), self.filter._state_distr.dim))
+                cross_cov[:, self._state_idxs] = cc
+            else:
+                state_cov = self.filter._state_distr.cov
+                if isinstance(self._obs_model, LinearGaussianObsModel):
+                    cross_cov = np.dot(self._obs_model.obs_matrix, state_cov[self._state_idxs, :])
+                else:
+                    cross_cov = np.dot(cc, np.linalg.lstsq(self._sub_state_cov(state_cov), state_cov[self._state_idxs, :], rcond=None)[0])
             
             return filtering.PredictedObs(self, time, predicted_obs.distr, cross_cov)
         
         def observe(self, obs, time=None, true_value=None, predicted_obs=None):
             time, obs_distr = filtering._time_and_obs_distr(obs, time, self.filter.time)
             if true_value is not None: true_value = npu.to_ndim_2(true_value)
-            if predicted_obs is None: predicted_obs = self.predict(time, true_value)
+            if predicted_obs is None:
+                self.filter.predict(time, true_value)
+                # The sequential update predicts each component itself, in O(d^2), and in the steady state the
+                # covariances are frozen, so in either case the (joint) prediction is not formed
+                if self.filter._is_sequential_update(self, obs_distr):
+                    return self.filter._observe_sequential(self, obs_distr, true_value)
+                if isinstance(self._obs_model, LinearGaussianObsModel) and \
+                        self.filter._is_steady_state_regime(self.filter._steady_state_regime(self, obs_distr)):
+                    return self.filter._observe_steady_state(self, obs_distr, true_value)
+                predicted_obs = self._predict_obs(time)
             return self.filter.observe(obs_distr, predicted_obs, true_value)
+        
+        def _run(self, obss, times, obs_covs, true_values, return_df):
+            # The sequential updates skip missing components, which the whole-array path does not; the latter also
+            # assumes the linear prediction of this class, not that of a subclass
+            if not isinstance(self._obs_model, LinearGaussianObsModel) or \
+                    self.filter.update_method == KalmanFilterUpdateMethod.SEQUENTIAL or \
+                    type(self.filter).predict is not KalmanFilter.predict: return None
+            return _run_linear_gaussian(self, obss, times, obs_covs, true_values, return_df)
     
     def create_observable(self, obs_model, *args):
         return KalmanFilter.KalmanObservable(self, None, obs_model, args)
@@ -229,51 +581,385 @@ class KalmanFilter(objects.Named):
     def create_named_identity_observable(self, name, *args):
         return KalmanFilter.KalmanObservable(self, name, None, args)
     
+    def _predict_obs(self, obs_model, time, state_distr, observable):
+        return obs_model.predict_obs(time, state_distr, observable)
+    
     def predict(self, time, true_value=None):
         if time < self._time:
             raise ValueError('Predicting the past (current time=%s, prediction time=%s)' % (self._time, time))
         if true_value is not None and filtering.FilterPypeOptions.TRUE_VALUE in self._pype_options:
             self._pype.send(filtering.TrueValue(self, self._time, true_value))
         if time == self._time: return
-        state_distrs = []
-        row = 0
-        for p in self._processes:
-            process_dim = p.process_dim
-            m = self._state_distr.mean[row:row+process_dim, 0:1]
-            c = self._state_distr.cov[row:row+process_dim, row:row+process_dim]
-            state_distr = p.propagate_distr(self._time, N(mean=m, cov=c), time, assume_distr=self._approximate_distr)
-            if not isinstance(state_distr, N):
-                if self._approximate_distr: state_distr = N.approximate(state_distr, copy=False)
-                else: raise ValueError('The propagated state distribution is not Normal; to approximate with a Normal distribution, set the approximate_distr parameter to True (currently False)')
-            state_distrs.append(state_distr)
-            row += process_dim
-        state_mean = np.vstack([d.mean for d in state_distrs])
-        state_cov = block_diag(*[d.cov for d in state_distrs])
+        self._time_delta = time - self._time
+        if not self._is_posterior:
+            # The steady-state regime is defined by a single prediction step from a posterior
+            self._last_update = None
+            self._is_steady_state = False
+        if self._is_steady_state and KalmanFilter._is_same_time_delta(self._time_delta, self._steady_state[0][0]):
+            # In the steady state the prior covariance is the frozen one, so only the mean is propagated
+            state_mean = self._propagate_mean(time)
+            if state_mean is not None:
+                self._state_distr = N(mean=state_mean, cov=self._steady_state[5], copy=False)
+                self._is_posterior = False
+                self._time = time
+                if filtering.FilterPypeOptions.PRIOR_STATE in self._pype_options: self._pype.send(self.state)
+                return
+        # The state is updated block by block in place, as F P F^T + Q with a block-diagonal F and Q. Multiplying the
+        # rows and columns of a process's block by its transition matrix carries the cross-covariances with the other
+        # processes; processes whose transitions are the identity are not touched
+        state_mean = np.array(self._state_distr.mean, dtype=float)
+        state_cov = np.array(self._state_distr.cov, dtype=float)
+        propagated_state_distrs = []
+        for i, (p, s) in enumerate(zip(self._processes, self._process_slices)):
+            transition = None
+            if self._is_affine[i]:
+                try:
+                    transition = p.transition_matrix(self._time, time)
+                    offset = p.transition_offset(self._time, time)
+                    noise_cov = p.noise_cov(self._time, time)
+                except NotImplementedError:
+                    self._is_affine[i] = False
+            if transition is None:
+                # The process propagates the distribution itself, which loses the cross-covariances unless the
+                # transition can be inferred
+                state_distr = p.propagate_distr(self._time, N(mean=state_mean[s], cov=state_cov[s, s]), time, assume_distr=self._approximate_distr)
+                if not isinstance(state_distr, N):
+                    if self._approximate_distr: state_distr = N.approximate(state_distr, copy=False)
+                    else: raise ValueError('The propagated state distribution is not Normal; to approximate with a Normal distribution, set the approximate_distr parameter to True (currently False)')
+                propagated_state_distrs.append((s, state_distr))
+                if len(self._processes) > 1:
+                    try:
+                        transition = _affine_transition((p,), self._time, time)[0]
+                    except ValueError:
+                        state_cov[s, :] = 0.
+                        state_cov[:, s] = 0.
+                        continue
+                else:
+                    continue
+                offset = None
+            if not np.array_equal(transition, np.eye(p.process_dim)):
+                state_mean[s] = np.dot(transition, state_mean[s])
+                state_cov[s, :] = np.dot(transition, state_cov[s, :])
+                state_cov[:, s] = np.dot(state_cov[:, s], transition.T)
+            if offset is not None:
+                state_mean[s] += offset
+                state_cov[s, s] += noise_cov
+        for s, state_distr in propagated_state_distrs:
+            state_mean[s] = state_distr.mean
+            state_cov[s, s] = state_distr.cov
         self._state_distr = N(mean=state_mean, cov=state_cov, copy=False)
         self._is_posterior = False
         self._time = time
         if filtering.FilterPypeOptions.PRIOR_STATE in self._pype_options: self._pype.send(self.state)
         
+    def _propagate_mean(self, time):
+        # The propagated state mean, if all the processes provide their transitions (otherwise None)
+        state_mean = np.array(self._state_distr.mean, dtype=float)
+        for i, (p, s) in enumerate(zip(self._processes, self._process_slices)):
+            if not self._is_affine[i]: return None
+            try:
+                transition, offset = p.transition_matrix(self._time, time), p.transition_offset(self._time, time)
+            except NotImplementedError:
+                self._is_affine[i] = False
+                return None
+            state_mean[s] = np.dot(transition, state_mean[s]) + offset
+        return state_mean
+    
+    @staticmethod
+    def _is_same_time_delta(time_delta1, time_delta2):
+        if checks.is_some_number(time_delta1) and checks.is_some_number(time_delta2):
+            # Differences of floating-point times that are nominally equally spaced differ in the last few bits
+            return abs(time_delta1 - time_delta2) <= 1e-9 * abs(time_delta2)
+        return time_delta1 == time_delta2
+    
+    @staticmethod
+    def _is_same_regime(regime1, regime2):
+        return KalmanFilter._is_same_time_delta(regime1[0], regime2[0]) and regime1[1] is regime2[1] and \
+                (regime1[2] is regime2[2] or np.array_equal(regime1[2], regime2[2]))
+    
+    def _steady_state_regime(self, observable, obs_distr):
+        # The regime of an update of the current state, if the steady-state mode is enabled and the state is a prior
+        if self._steady_state_tol is None or self._is_posterior: return None
+        return (self._time_delta, observable, obs_distr.cov)
+    
+    def _is_steady_state_regime(self, regime):
+        return regime is not None and (self._is_steady_state or self._is_steady_state_solved) and \
+                KalmanFilter._is_same_regime(regime, self._steady_state[0])
+    
+    def _detect_steady_state(self, regime, gain, posterior_state_cov, innov_cov, prior_state_cov, cross_cov):
+        # Two consecutive updates in the same regime whose gains and posterior covariances agree to within the tolerance
+        # mean that the Riccati recursion has converged; from then on the gain and covariances are frozen
+        last_update = self._last_update
+        self._last_update = (regime, gain, posterior_state_cov)
+        if last_update is None or not KalmanFilter._is_same_regime(regime, last_update[0]): return
+        tol = self._steady_state_tol
+        if np.max(np.abs(gain - last_update[1])) <= tol * np.max(np.abs(gain)) and \
+                np.max(np.abs(posterior_state_cov - last_update[2])) <= tol * np.max(np.abs(posterior_state_cov)):
+            self._freeze_steady_state(regime, gain, posterior_state_cov, innov_cov, prior_state_cov, cross_cov)
+            self._is_steady_state_solved = False
+            self._is_steady_state = True
+    
+    def _freeze_steady_state(self, regime, gain, posterior_state_cov, innov_cov, prior_state_cov, cross_cov):
+        self._steady_state = (regime, gain, npu.immutable_copy_of(posterior_state_cov), np.linalg.cholesky(innov_cov),
+                              npu.immutable_copy_of(innov_cov), npu.immutable_copy_of(prior_state_cov), npu.immutable_copy_of(cross_cov))
+    
+    def _steady_state_update(self, innov):
+        _, gain, posterior_state_cov, innov_vol, _, _, _ = self._steady_state
+        m = self._state_distr.mean + np.dot(gain, innov)
+        whitened_innov = la.solve_triangular(innov_vol, innov, lower=True, check_finite=False)
+        log_det = 2. * np.sum(np.log(np.diag(innov_vol)))
+        return N(mean=m, cov=posterior_state_cov, copy=False), gain, log_det, np.dot(whitened_innov.T, whitened_innov)
+    
+    def solve_steady_state(self, time_delta, observable, obs_cov):
+        # Solves the discrete algebraic Riccati equation for the prior covariance up front. The resulting gain and
+        # posterior covariance are frozen and applied by every update in the given regime from the next one onwards, as
+        # in a steady-state Kalman filter, without waiting for the recursion to converge. The current state is left as
+        # it is
+        checks.check(self._steady_state_tol is not None, 'The steady-state mode is not enabled (steady_state_tol is None)')
+        transition, _, noise_cov = _affine_transition(self._processes, self._time, self._time + time_delta)
+        obs_matrix = observable._full_obs_matrix()
+        obs_cov = npu.to_ndim_2(obs_cov, ndim_1_to_col=True, copy=False)
+        prior_state_cov = la.solve_discrete_are(transition.T, obs_matrix.T, noise_cov, obs_cov)
+        cross_cov = np.dot(obs_matrix, prior_state_cov)
+        innov_cov = np.dot(cross_cov, obs_matrix.T) + obs_cov
+        gain = la.solve(innov_cov, cross_cov, assume_a='pos').T
+        posterior_state_cov = prior_state_cov - np.dot(gain, cross_cov)
+        self._freeze_steady_state((time_delta, observable, obs_cov), gain, posterior_state_cov, innov_cov, prior_state_cov, cross_cov)
+        self._is_steady_state_solved = True
+    
+    def _inverse_update(self, innov, innov_cov, cross_cov):
+        innov_cov_inv = np.linalg.inv(innov_cov)
+        gain = np.dot(cross_cov.T, innov_cov_inv)
+        m = self._state_distr.mean + np.dot(gain, innov)
+        c = self._state_distr.cov - np.dot(gain, cross_cov)
+        return N(mean=m, cov=c, copy=False), gain, np.log(np.linalg.det(innov_cov)), np.dot(np.dot(innov.T, innov_cov_inv), innov)
+    
+    def _cholesky_update(self, innov, innov_cov, cross_cov):
+        # With innov_cov = L L^T, whiten the innovation and the cross-covariance in one triangular solve; the posterior
+        # covariance then follows as P - (L^{-1} H P)^T (L^{-1} H P), which is symmetric by construction
+        chol = np.linalg.cholesky(innov_cov)
+        whitened = la.solve_triangular(chol, np.hstack((innov, cross_cov)), lower=True, check_finite=False)
+        whitened_innov = whitened[:, 0:1]
+        whitened_cross_cov = whitened[:, 1:]
+        gain = la.solve_triangular(chol, whitened_cross_cov, lower=True, trans='T', check_finite=False).T
+        m = self._state_distr.mean + np.dot(whitened_cross_cov.T, whitened_innov)
+        c = self._state_distr.cov - np.dot(whitened_cross_cov.T, whitened_cross_cov)
+        log_det = 2. * np.sum(np.log(np.diag(chol)))
+        return N(mean=m, cov=c, copy=False), gain, log_det, np.dot(whitened_innov.T, whitened_innov)
+    
+    def _square_root_update(self, innov, obs_distr, cross_cov):
+        # The covariance factor S (P = S S^T) is updated directly. The lower-triangular factor of the post-array of
+        #
+        #     [ R^{1/2}  H S ]
+        #     [ 0        S   ]
+        #
+        # is [[W, 0], [K W, S+]], where W W^T is the innovation covariance and S+ is the posterior covariance factor
+        state_vol = self._state_distr.vol
+        obs_dim = obs_distr.dim
+        state_dim = self._state_distr.dim
+        obs_vol = obs_distr.vol if np.any(obs_distr.cov) else np.zeros((obs_dim, obs_dim))
+        pre_array = np.zeros((obs_dim + state_dim, obs_dim + state_dim))
+        pre_array[0:obs_dim, 0:obs_dim] = obs_vol
+        # H S = (H P) S^{-T}
+        pre_array[0:obs_dim, obs_dim:] = la.solve_triangular(state_vol, cross_cov.T, lower=True, check_finite=False).T
+        pre_array[obs_dim:, obs_dim:] = state_vol
+        post_array = np.linalg.qr(pre_array.T, mode='r').T
+        innov_vol = post_array[0:obs_dim, 0:obs_dim]
+        scaled_gain = post_array[obs_dim:, 0:obs_dim]
+        posterior_state_vol = post_array[obs_dim:, obs_dim:]
+        whitened_innov = la.solve_triangular(innov_vol, innov, lower=True, check_finite=False)
+        gain = la.solve_triangular(innov_vol, scaled_gain.T, lower=True, trans='T', check_finite=False).T
+        m = self._state_distr.mean + np.dot(scaled_gain, whitened_innov)
+        state_distr = N(mean=m, cov=np.dot(posterior_state_vol, posterior_state_vol.T), vol=posterior_state_vol, copy=False)
+        log_det = 2. * np.sum(np.log(np.abs(np.diag(innov_vol))))
+        return state_distr, gain, log_det, np.dot(whitened_innov.T, whitened_innov)
+        
+    def _sequential_update(self, obs_matrix, obs_distr):
+        # With a diagonal observation noise covariance, the components of the observation are conditionally independent
+        # given the state and can be processed one at a time: each is a scalar update with the corresponding row h of the
+        # observation matrix, costing O(d^2), with no matrix to invert. The innovations are those of each component given
+        # the preceding ones, so that their variances are the diagonal of the innovation covariance and the gains are
+        # the columns of the gain, whose product with the innovation is the update of the mean; for the skipped
+        # components these are NaN and zero. The predictions of the components and their cross-covariances with the
+        # state are likewise those given the preceding components, so that the joint prediction (H P H^T, O(m^2 d)) is
+        # never formed
+        state_mean = np.array(self._state_distr.mean[:, 0], dtype=float)
+        state_cov = np.array(self._state_distr.cov, dtype=float)
+        obs_mean = obs_distr.mean[:, 0]
+        obs_vars = np.diagonal(obs_distr.cov)
+        obs_dim = len(obs_mean)
+        innovs = np.full((obs_dim,), np.nan)
+        innov_vars = np.full((obs_dim,), np.nan)
+        predicted_obs_means = np.full((obs_dim,), np.nan)
+        predicted_obs_vars = np.full((obs_dim,), np.nan)
+        cross_covs = np.zeros((obs_dim, len(state_mean)))
+        gain = np.zeros((len(state_mean), obs_dim))
+        log_likelihood = 0.
+        for k in range(obs_dim):
+            if np.isnan(obs_mean[k]): continue
+            h = obs_matrix[k]
+            cross_cov = np.dot(state_cov, h)
+            predicted_obs_mean = np.dot(h, state_mean)
+            predicted_obs_var = np.dot(h, cross_cov)
+            innov_var = predicted_obs_var + obs_vars[k]
+            innov = obs_mean[k] - predicted_obs_mean
+            component_gain = cross_cov / innov_var
+            state_mean += component_gain * innov
+            state_cov -= np.outer(component_gain, cross_cov)
+            innovs[k], innov_vars[k], gain[:, k] = innov, innov_var, component_gain
+            predicted_obs_means[k], predicted_obs_vars[k], cross_covs[k] = predicted_obs_mean, predicted_obs_var, cross_cov
+            log_likelihood += -.5 * (KalmanFilter.LN_2PI + np.log(innov_var) + innov * innov / innov_var)
+        return N(mean=npu.col(*state_mean), cov=state_cov, copy=False), gain, npu.to_ndim_2(log_likelihood), \
+                N(mean=npu.col(*innovs), cov=np.diag(innov_vars), copy=False), \
+                N(mean=npu.col(*predicted_obs_means), cov=np.diag(predicted_obs_vars), copy=False), cross_covs
+    
+    def _update(self, innov, innov_cov, obs_distr, cross_cov):
+        if self._update_method == KalmanFilterUpdateMethod.INVERSE:
+            return self._inverse_update(innov, innov_cov, cross_cov)
+        elif self._update_method == KalmanFilterUpdateMethod.SQUARE_ROOT:
+            return self._square_root_update(innov, obs_distr, cross_cov)
+        else:
+            return self._cholesky_update(innov, innov_cov, cross_cov)
+        
+    def _is_sequential_update(self, observable, obs_distr):
+        return self._update_method == KalmanFilterUpdateMethod.SEQUENTIAL and \
+                isinstance(getattr(observable, '_obs_model', None), LinearGaussianObsModel) and _is_diagonal(obs_distr.cov)
+    
+    def _observe_sequential(self, observable, obs_distr, true_value):
+        # As observe, for an observation to which the sequential update applies, with the predictions of its components
+        # formed by the update itself rather than given
+        if true_value is not None and filtering.FilterPypeOptions.TRUE_VALUE in self._pype_options:
+            self._pype.send(filtering.TrueValue(self, self._time, true_value))
+        state_distr, gain, log_likelihood, innov_distr, predicted_obs_distr, cross_cov = \
+                self._sequential_update(observable._full_obs_matrix(), obs_distr)
+        self._is_steady_state = False
+        self._last_update = None
+        predicted_obs = filtering.PredictedObs(observable, self._time, predicted_obs_distr, cross_cov)
+        return self._observed(observable, obs_distr, predicted_obs, state_distr, innov_distr, log_likelihood, gain)
+        
+    def _observe_steady_state(self, observable, obs_distr, true_value):
+        # As observe, for a linear observation in the steady-state regime: the frozen innovation covariance,
+        # cross-covariance and gain are reported, and only the means are computed
+        if true_value is not None and filtering.FilterPypeOptions.TRUE_VALUE in self._pype_options:
+            self._pype.send(filtering.TrueValue(self, self._time, true_value))
+        innov_cov, cross_cov = self._steady_state[4], self._steady_state[6]
+        predicted_obs_mean = np.dot(observable._full_obs_matrix(), self._state_distr.mean)
+        predicted_obs = filtering.PredictedObs(observable, self._time, N(mean=predicted_obs_mean, cov=innov_cov - obs_distr.cov, copy=False), cross_cov)
+        innov = obs_distr.mean - predicted_obs_mean
+        state_distr, gain, log_det, mahalanobis_sq = self._steady_state_update(innov)
+        self._is_steady_state = True
+        log_likelihood = -.5 * (obs_distr.dim * KalmanFilter.LN_2PI + log_det + mahalanobis_sq)
+        return self._observed(observable, obs_distr, predicted_obs, state_distr, N(mean=innov, cov=innov_cov, copy=False), log_likelihood, gain)
+        
     def observe(self, obs_distr, predicted_obs, true_value):
         if true_value is not None and filtering.FilterPypeOptions.TRUE_VALUE in self._pype_options:
             self._pype.send(filtering.TrueValue(self, self._time, true_value))
-        innov = obs_distr.mean - predicted_obs.distr.mean
-        innov_cov = predicted_obs.distr.cov + obs_distr.cov
-        innov_cov_inv = np.linalg.inv(innov_cov)
-        gain = np.dot(predicted_obs.cross_cov.T, innov_cov_inv)
-        m = self._state_distr.mean + np.dot(gain, innov)
-        c = self._state_distr.cov - np.dot(gain, predicted_obs.cross_cov)
-        self._state_distr = N(mean=m, cov=c, copy=False)
+        observable = predicted_obs.observable
+        if self._is_sequential_update(observable, obs_distr):
+            state_distr, gain, log_likelihood, innov_distr, _, _ = self._sequential_update(observable._full_obs_matrix(), obs_distr)
+            self._is_steady_state = False
+            self._last_update = None
+        else:
+            innov = obs_distr.mean - predicted_obs.distr.mean
+            regime = self._steady_state_regime(observable, obs_distr)
+            if self._is_steady_state_regime(regime):
+                state_distr, gain, log_det, mahalanobis_sq = self._steady_state_update(innov)
+                innov_cov = self._steady_state[4]
+                self._is_steady_state = True
+            else:
+                innov_cov = predicted_obs.distr.cov + obs_distr.cov
+                state_distr, gain, log_det, mahalanobis_sq = self._update(innov, innov_cov, obs_distr, predicted_obs.cross_cov)
+                self._is_steady_state = False
+                if regime is not None:
+                    self._detect_steady_state(regime, gain, state_distr.cov, innov_cov, self._state_distr.cov, predicted_obs.cross_cov)
+                else: self._last_update = None
+            log_likelihood = -.5 * (obs_distr.dim * KalmanFilter.LN_2PI + log_det + mahalanobis_sq)
+            innov_distr = N(mean=innov, cov=innov_cov, copy=False)
+        return self._observed(observable, obs_distr, predicted_obs, state_distr, innov_distr, log_likelihood, gain)
+    
+    def _observed(self, observable, obs_distr, predicted_obs, state_distr, innov_distr, log_likelihood, gain):
+        self._state_distr = state_distr
         self._is_posterior = True
         if filtering.FilterPypeOptions.POSTERIOR_STATE in self._pype_options: self._pype.send(self.state)
 
-        log_likelihood = -.5 * (obs_distr.dim * KalmanFilter.LN_2PI + np.log(np.linalg.det(innov_cov)) + \
-                np.dot(np.dot(innov.T, innov_cov_inv), innov))
-        obs = filtering.Obs(predicted_obs.observable, self._time, obs_distr)
-        obs_result = KalmanObsResult(True, obs, predicted_obs, N(mean=innov, cov=innov_cov, copy=False), log_likelihood, gain)
+        obs = filtering.Obs(observable, self._time, obs_distr)
+        obs_result = KalmanObsResult(True, obs, predicted_obs, innov_distr, log_likelihood, gain)
         if filtering.FilterPypeOptions.OBS_RESULT in self._pype_options: self._pype.send(obs_result)
         return obs_result
         
+    def observe_batch(self, observables_and_obss, time=None, true_value=None, sequential=False):
+        # Observes several observables of this filter at a single time in one update, with a single posterior, a single
+        # (joint) log-likelihood and a single set of pype messages. If all the observation models are linear-Gaussian,
+        # the observation matrices and noise covariances are stacked into a joint update; otherwise (or if sequential
+        # is True) the observations, whose noises are independent, are processed one after another. In the result the
+        # observations, predictions and innovations are stacked. In the sequential case (and with the SEQUENTIAL update
+        # method) the predictions and innovations are those of each observation given the preceding ones, and the gains
+        # are stacked column-wise, so that the posterior mean is the prior mean plus the product of the gain and the
+        # innovation in both cases
+        observables_and_obss = list(observables_and_obss)
+        checks.check(len(observables_and_obss) > 0, 'No observations are given')
+        observables = []
+        obs_distrs = []
+        for observable, obs in observables_and_obss:
+            checks.check(observable.filter is self, 'Each observable must belong to this Kalman filter')
+            if isinstance(obs, filtering.Obs): obs_time, obs_distr = obs.time, obs.distr
+            else: obs_time, obs_distr = filtering._time_and_obs_distr(obs, time, self._time)
+            if time is None: time = obs_time
+            elif obs_time != time: raise ValueError('The observations in a batch must share a single time (%s and %s)' % (time, obs_time))
+            observables.append(observable)
+            obs_distrs.append(obs_distr)
+        if true_value is not None: true_value = npu.to_ndim_2(true_value)
+        self.predict(time, true_value)
+        
+        obs_distr = N(mean=np.vstack([d.mean for d in obs_distrs]), cov=block_diag(*[d.cov for d in obs_distrs]), copy=False)
+        if not sequential and all([isinstance(o._obs_model, LinearGaussianObsModel) for o in observables]):
+            obs_matrix = np.vstack([o._full_obs_matrix() for o in observables])
+            if self._update_method == KalmanFilterUpdateMethod.SEQUENTIAL and _is_diagonal(obs_distr.cov):
+                state_distr, gain, log_likelihood, innov_distr, predicted_obs_distr, cross_cov = self._sequential_update(obs_matrix, obs_distr)
+                innov, innov_cov = innov_distr.mean, innov_distr.cov
+            else:
+                cross_cov = np.dot(obs_matrix, self._state_distr.cov)
+                predicted_obs_distr = N(mean=np.dot(obs_matrix, self._state_distr.mean), cov=np.dot(cross_cov, obs_matrix.T), copy=False)
+                innov = obs_distr.mean - predicted_obs_distr.mean
+                innov_cov = predicted_obs_distr.cov + obs_distr.cov
+                state_distr, gain, log_det, mahalanobis_sq = self._update(innov, innov_cov, obs_distr, cross_cov)
+                log_likelihood = -.5 * (obs_distr.dim * KalmanFilter.LN_2PI + log_det + mahalanobis_sq)
+            self._state_distr = state_distr
+        else:
+            predicted_obs_means, predicted_obs_covs, cross_covs, innovs, innov_covs, gains = [], [], [], [], [], []
+            log_likelihood = 0.
+            for observable, an_obs_distr in zip(observables, obs_distrs):
+                # The prediction's cross-covariance is with the whole state (see KalmanObservable.predict), so that the
+                # processes that are not observed are updated through their correlations with the observed ones
+                predicted_obs = observable.predict(time)
+                innov = an_obs_distr.mean - predicted_obs.distr.mean
+                innov_cov = predicted_obs.distr.cov + an_obs_distr.cov
+                state_distr, gain, log_det, mahalanobis_sq = self._update(innov, innov_cov, an_obs_distr, predicted_obs.cross_cov)
+                log_likelihood += -.5 * (an_obs_distr.dim * KalmanFilter.LN_2PI + log_det + mahalanobis_sq)
+                self._state_distr = state_distr
+                predicted_obs_means.append(predicted_obs.distr.mean)
+                predicted_obs_covs.append(predicted_obs.distr.cov)
+                cross_covs.append(predicted_obs.cross_cov)
+                innovs.append(innov)
+                innov_covs.append(innov_cov)
+                gains.append(gain)
+            predicted_obs_distr = N(mean=np.vstack(predicted_obs_means), cov=block_diag(*predicted_obs_covs), copy=False)
+            cross_cov = np.vstack(cross_covs)
+            innov = np.vstack(innovs)
+            innov_cov = block_diag(*innov_covs)
+            gain = np.hstack(gains)
+        self._is_posterior = True
+        self._last_update = None
+        self._is_steady_state = False
+        if filtering.FilterPypeOptions.POSTERIOR_STATE in self._pype_options: self._pype.send(self.state)
+        
+        observable_name = tuple([o.name for o in observables])
+        obs = filtering.Obs(None, time, obs_distr, observable_name)
+        predicted_obs = filtering.PredictedObs(None, time, predicted_obs_distr, cross_cov, observable_name)
+        obs_result = KalmanObsResult(True, obs, predicted_obs, N(mean=innov, cov=innov_cov, copy=False), log_likelihood, gain)
+        if filtering.FilterPypeOptions.OBS_RESULT in self._pype_options: self._pype.send(obs_result)
+        return obs_result
+    
     def to_string_helper(self):
         if self._to_string_helper_KalmanFilter is None:
             self._to_string_helper_KalmanFilter = super().to_string_helper() \
@@ -285,3 +971,180 @@ class KalmanFilter(objects.Named):
     def __str__(self):
         if self._str_KalmanFilter is None: self._str_KalmanFilter = self.to_string_helper().to_string()
         return self._str_KalmanFilter
+
+class KalmanFilterBankObsResult(object):
+    def __init__(self, time, filter_idxs, innov_mean, innov_cov, log_likelihood, gain):
+        self._time = time
+        self._filter_idxs = filter_idxs
+        self._innov_mean = innov_mean
+        self._innov_cov = innov_cov
+        self._log_likelihood = log_likelihood
+        self._gain = gain
+        self._to_string_helper_KalmanFilterBankObsResult = None
+        self._str_KalmanFilterBankObsResult = None
+
+    @property
+    def time(self):
+        return self._time
+
+    @property
+    def filter_idxs(self):
+        return self._filter_idxs
+
+    @property
+    def innov_mean(self):
+        return self._innov_mean
+
+    @property
+    def innov_cov(self):
+        return self._innov_cov
+
+    @property
+    def log_likelihood(self):
+        return self._log_likelihood
+
+    @property
+    def gain(self):
+        return self._gain
+
+    def to_string_helper(self):
+        if self._to_string_helper_KalmanFilterBankObsResult is None:
+            self._to_string_helper_KalmanFilterBankObsResult = ToStringHelper(self) \
+                    .add('time', self._time) \
+                    .add('filter_idxs', self._filter_idxs) \
+                    .add('log_likelihood', self._log_likelihood)
+        return self._to_string_helper_KalmanFilterBankObsResult
+
+    def __str__(self):
+        if self._str_KalmanFilterBankObsResult is None: self._str_KalmanFilterBankObsResult = self.to_string_helper().to_string()
+        return self._str_KalmanFilterBankObsResult
+
+    def __repr__(self):
+        return str(self)
+
+def _read_only_view(arg):
+    view = arg.view()
+    view.flags.writeable = False
+    return view
+
+class KalmanFilterBank(objects.Named):
+    def __init__(self, time, state_distr, process, filter_count=None, name=None):
+        super().__init__(name)
+        if not checks.is_iterable(process): process = (process,)
+        process = checks.check_iterable_over_instances(process, proc.MarkovProcess)
+        self._processes = tuple(process)
+        self._state_dim = sum([p.process_dim for p in self._processes])
+        if isinstance(state_distr, N): 
+            if filter_count is None: filter_count = 1
+            state_distr = [state_distr] * filter_count
+        state_distr = list(checks.check_iterable_over_instances(state_distr, N))
+        if filter_count is None: filter_count = len(state_distr)
+        checks.check(len(state_distr) == filter_count, 'The number of state distributions does not match the filter count')
+        self._filter_count = filter_count
+        self._state_means = np.array([npu.to_ndim_2(d.mean, ndim_1_to_col=True) for d in state_distr], dtype=float)
+        self._state_covs = np.array([npu.to_ndim_2(d.cov, ndim_1_to_col=True) for d in state_distr], dtype=float)
+        checks.check(self._state_means.shape == (filter_count, self._state_dim, 1), 'The state distributions are inconsistent with the processes')
+        if checks.is_iterable(time) and not checks.is_string(time):
+            self._times = np.array(time)
+            checks.check(len(self._times) == filter_count, 'The number of times does not match the filter count')
+        else:
+            self._times = np.array([time] * filter_count)
+        self._to_string_helper_KalmanFilterBank = None
+        self._str_KalmanFilterBank = None
+        
+    @property
+    def filter_count(self):
+        return self._filter_count
+    
+    @property
+    def state_dim(self):
+        return self._state_dim
+    
+    @property
+    def times(self):
+        return _read_only_view(self._times)
+    
+    @property
+    def state_means(self):
+        return _read_only_view(self._state_means)
+    
+    @property
+    def state_covs(self):
+        return _read_only_view(self._state_covs)
+    
+    def state_distr(self, filter_idx):
+        return N(mean=self._state_means[filter_idx], cov=self._state_covs[filter_idx])
+    
+    def _filter_idxs(self, mask):
+        if mask is None: return np.arange(self._filter_count)
+        mask = np.asarray(mask)
+        if mask.dtype == bool: return np.flatnonzero(mask)
+        return mask.astype(int)
+    
+    def predict(self, time, mask=None):
+        idxs = self._filter_idxs(mask)
+        times0 = self._times[idxs]
+        if np.any(times0 > time):
+            raise ValueError('Predicting the past (prediction time=%s)' % time)
+        # Filters that last ticked at the same time share the transition, so there are as many transitions to look up
+        # (in the processes' caches) as there are distinct times among the selected filters
+        unique_times0, inverse = np.unique(times0, return_inverse=True)
+        for k, time0 in enumerate(unique_times0):
+            if time0 == time: continue
+            group_idxs = idxs[inverse == k]
+            transition, offset, noise_cov = _linear_transition(self._processes, time0, time)
+            self._state_means[group_idxs] = np.matmul(transition, self._state_means[group_idxs]) + offset
+            self._state_covs[group_idxs] = np.matmul(np.matmul(transition, self._state_covs[group_idxs]), transition.T) + noise_cov
+        self._times[idxs] = time
+    
+    def observe(self, obss, obs_model, obs_covs=None, time=None, mask=None):
+        idxs = self._filter_idxs(mask)
+        if time is not None: self.predict(time, idxs)
+        obs_matrix = obs_model.obs_matrix
+        checks.check(npu.ncol(obs_matrix) == self._state_dim, 'The observation matrix is inconsistent with the state dimension')
+        obs_dim = npu.nrow(obs_matrix)
+        obss = np.reshape(np.asarray(obss, dtype=float), (len(idxs), obs_dim, 1))
+        if obs_covs is None: obs_covs = np.zeros((obs_dim, obs_dim))
+        obs_covs = np.asarray(obs_covs, dtype=float)
+        if np.ndim(obs_covs) < 3: obs_covs = np.reshape(obs_covs, (obs_dim, obs_dim))
+        
+        state_means = self._state_means[idxs]
+        state_covs = self._state_covs[idxs]
+        innov_means = obss - np.matmul(obs_matrix, state_means)
+        cross_covs = np.matmul(obs_matrix, state_covs)
+        innov_covs = np.matmul(cross_covs, obs_matrix.T) + obs_covs
+        # A single Cholesky factorization per filter, S = L L^T, serves both the gains and the log-likelihoods. The
+        # solves against the stacked factors are batched; scipy's triangular solvers are not, and a loop over the filters
+        # would cost far more in per-call overhead than the triangular structure saves
+        chol_innov_covs = np.linalg.cholesky(innov_covs)
+        whitened = np.linalg.solve(chol_innov_covs, np.concatenate((innov_means, cross_covs), axis=2))
+        whitened_innovs = whitened[:, :, 0:1]
+        gains = np.swapaxes(np.linalg.solve(np.swapaxes(chol_innov_covs, 1, 2), whitened[:, :, 1:]), 1, 2)
+        self._state_means[idxs] = state_means + np.matmul(gains, innov_means)
+        self._state_covs[idxs] = state_covs - np.matmul(gains, cross_covs)
+        
+        log_dets = 2. * np.sum(np.log(np.diagonal(chol_innov_covs, axis1=1, axis2=2)), axis=1)
+        log_likelihoods = -.5 * (obs_dim * KalmanFilter.LN_2PI + log_dets + np.sum(whitened_innovs**2, axis=(1, 2)))
+        
+        return KalmanFilterBankObsResult(time, idxs, innov_means, innov_covs, log_likelihoods, gains)
+    
+    def resample(self, idxs):
+        # Replaces the filters with copies of those with the given indices, which may repeat (as when the particles that
+        # carry the filters in a Rao-Blackwellized particle filter are resampled)
+        idxs = np.asarray(idxs, dtype=int)
+        checks.check(len(idxs) == self._filter_count, 'The number of indices does not match the filter count')
+        self._times = self._times[idxs]
+        self._state_means = self._state_means[idxs]
+        self._state_covs = self._state_covs[idxs]
+    
+    def to_string_helper(self):
+        if self._to_string_helper_KalmanFilterBank is None:
+            self._to_string_helper_KalmanFilterBank = super().to_string_helper() \
+                    .set_type(self) \
+                    .add('filter_count', self._filter_count) \
+                    .add('state_dim', self._state_dim)
+        return self._to_string_helper_KalmanFilterBank
+    
+    def __str__(self):
+        if self._str_KalmanFilterBank is None: self._str_KalmanFilterBank = self.to_string_helper().to_string()
+        return self._str_KalmanFilterBank
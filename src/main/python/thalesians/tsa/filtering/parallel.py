@@ -0,0 +1,226 @@
+import multiprocessing
+from multiprocessing import shared_memory
+import os
+import weakref
+
+import numpy as np
+
+import thalesians.tsa.checks as checks
+import thalesians.tsa.filtering as filtering
+import thalesians.tsa.filtering.particle as particle
+import thalesians.tsa.numpyutils as npu
+
+# A particle filter whose particles and weights are placed in shared memory and are propagated, weighted and resampled
+# by a persistent pool of worker processes, each of which owns a contiguous chunk of the particles. Each chunk has its
+# own random number generator, spawned from the filter's random state, so that the results are reproducible for a given
+# random state and worker count (though they differ from a ParticleFilter's). The weights are normalized with a
+# two-pass parallel log-sum-exp, which also yields their cumulative sums (a parallel prefix sum), so that multinomial,
+# systematic and stratified resampling are parallel too; the other resampling schemes run in the parent process, on the
+# shared buffers. The weighting function is called on each chunk with None in place of the filter, so it must not depend
+# on all the particles; the exception is the default KDEWeightingFunction, whose kernel, which does, is computed from all
+# the weighted particles in the parent and sent to the workers, so that the weights are those of a ParticleFilter with
+# the same particles whatever the worker count. A checkpoint (see filtering.checkpoint) saves the parent's random state
+# but not the workers'
+
+def _start_method():
+    # Forked workers inherit the processes and the weighting function, which need not then be picklable
+    return 'fork' if 'fork' in multiprocessing.get_all_start_methods() else None
+
+def _chunk_bounds(particle_count, worker_count):
+    return [(i * particle_count // worker_count, (i + 1) * particle_count // worker_count) for i in range(worker_count)]
+
+class _Worker(object):
+    def __init__(self, buffer_specs, processes, weighting_func, start, stop, seed_sequence):
+        self._shared_memories = [shared_memory.SharedMemory(name=name) for name, _ in buffer_specs]
+        buffers = [np.ndarray(shape, buffer=m.buf) for m, (_, shape) in zip(self._shared_memories, buffer_specs)]
+        self._particle_buffers = buffers[0:2]
+        self._log_unnormalized_weights, self._log_weights, self._weights, self._cumulative_weights = buffers[2:]
+        self._processes = processes
+        self._process_slices = []
+        row = 0
+        for p in processes:
+            self._process_slices.append(slice(row, row + p.process_dim))
+            row += p.process_dim
+        self._weighting_func = weighting_func
+        self._start, self._stop = start, stop
+        self._random_state = np.random.RandomState(np.random.MT19937(seed_sequence))
+
+    def predict(self, time0, time, source, target):
+        chunk = slice(self._start, self._stop)
+        for p, s in zip(self._processes, self._process_slices):
+            values0 = self._particle_buffers[source][chunk, s]
+            if npu.is_vectorized(p.propagate):
+                self._particle_buffers[target][chunk, s] = p.propagate(time0, values0, time, random_state=self._random_state)
+            else:
+                for i in range(len(values0)):
+                    self._particle_buffers[target][self._start + i, s] = npu.to_ndim_1(p.propagate(time0, values0[i], time, random_state=self._random_state))
+
+    def weight(self, observation, source, kernel_cov=None):
+        # Returns the maximum of the chunk's log-weights and the sum of their exponentials relative to it. The kernel
+        # covariance, if given, is that of the KDEWeightingFunction, computed from all the particles
+        chunk = slice(self._start, self._stop)
+        log_unnormalized_weights = self._log_unnormalized_weights[chunk]
+        weighting_func = self._weighting_func if kernel_cov is None else \
+                particle.GaussianWeightingFunction(kernel_cov, self._weighting_func.obs_function)
+        if npu.is_vectorized(weighting_func):
+            log_unnormalized_weights[:] = npu.to_ndim_1(weighting_func(observation, self._particle_buffers[source][chunk], None))
+        else:
+            for i, p in enumerate(self._particle_buffers[source][chunk]):
+                log_unnormalized_weights[i] = npu.to_scalar(weighting_func(observation, p, None))
+        log_unnormalized_weights += self._log_weights[chunk]
+        max_log_weight = np.max(log_unnormalized_weights)
+        if not np.isfinite(max_log_weight): return max_log_weight, 0.
+        return max_log_weight, np.sum(np.exp(log_unnormalized_weights - max_log_weight))
+
+    def normalize(self, log_weight_sum, cumulative_weight_offset):
+        # Normalizes the chunk's weights and writes their cumulative sums, offset by those of the preceding chunks;
+        # returns the sum of the squares of the weights
+        chunk = slice(self._start, self._stop)
+        np.subtract(self._log_unnormalized_weights[chunk], log_weight_sum, out=self._log_weights[chunk])
+        np.exp(self._log_weights[chunk], out=self._weights[chunk])
+        np.cumsum(self._weights[chunk], out=self._cumulative_weights[chunk])
+        self._cumulative_weights[chunk] += cumulative_weight_offset
+        return np.sum(np.square(self._weights[chunk]))
+
+    def resample(self, resampling, uniform, source, target):
+        # Draws the resampled particles of the chunk by inverting the cumulative weights of all the particles
+        particle_count = len(self._weights)
+        idxs = np.arange(self._start, self._stop)
+        if isinstance(resampling, particle.SystematicResampling): uniforms = (uniform + idxs) / particle_count
+        elif isinstance(resampling, particle.StratifiedResampling): uniforms = (self._random_state.uniform(size=len(idxs)) + idxs) / particle_count
+        else: uniforms = self._random_state.uniform(size=len(idxs))
+        # The last cumulative weight may fall short of 1 due to rounding
+        idxs = np.minimum(np.searchsorted(self._cumulative_weights, uniforms * self._cumulative_weights[-1], side='right'), particle_count - 1)
+        np.take(self._particle_buffers[source], idxs, axis=0, out=self._particle_buffers[target][self._start:self._stop], mode='clip')
+
+    def close(self):
+        self._particle_buffers = self._log_unnormalized_weights = self._log_weights = self._weights = self._cumulative_weights = None
+        for m in self._shared_memories: m.close()
+
+def _work(connection, *args):
+    worker = _Worker(*args)
+    while True:
+        command, command_args = connection.recv()
+        if command is None: break
+        try:
+            connection.send((True, getattr(worker, command)(*command_args)))
+        except Exception as e:
+            connection.send((False, e))
+    worker.close()
+    connection.close()
+
+def _shut_down(connections, workers, shared_memories):
+    for c in connections:
+        try:
+            c.send((None, None))
+            c.close()
+        except (OSError, ValueError):
+            pass
+    for w in workers: w.join()
+    for m in shared_memories:
+        try:
+            m.close()
+        except BufferError:
+            # Views of the buffer are still referenced; it is released with them
+            pass
+        m.unlink()
+
+class ParallelParticleFilter(particle.ParticleFilter):
+    def __init__(self, time, state_distr, process,
+                 weighting_func=None,
+                 particle_count=1000, observation_dim=1,
+                 random_state=None,
+                 predicted_observation_sampler=None, outlier_threshold=None,
+                 resampling=None, resampling_threshold=None,
+                 worker_count=None,
+                 name=None, pype=None, pype_options=frozenset(filtering.FilterPypeOptions)):
+        if worker_count is None: worker_count = os.cpu_count()
+        self._worker_count = checks.check_int(worker_count)
+        checks.check(0 < worker_count <= particle_count, 'The worker count must be positive and at most the particle count')
+        self._shared_memories = []
+        super().__init__(time, state_distr, process, weighting_func, particle_count, observation_dim, random_state,
+                predicted_observation_sampler, outlier_threshold, resampling, resampling_threshold, name, pype, pype_options)
+        self._cumulative_weights = self._allocate((self._particle_count,))
+        self._particle_buffers = (self._prior_particles, self._resampled_particles)
+
+        context = multiprocessing.get_context(_start_method())
+        buffer_specs = [(m.name, b.shape) for m, b in zip(self._shared_memories,
+                self._particle_buffers + (self._log_unnormalized_weights, self._log_weights, self._weights, self._cumulative_weights))]
+        seed_sequences = np.random.SeedSequence(self._random_state.randint(2**32, size=4, dtype=np.uint64)).spawn(self._worker_count)
+        self._connections = []
+        self._workers = []
+        for (start, stop), seed_sequence in zip(_chunk_bounds(self._particle_count, self._worker_count), seed_sequences):
+            connection, worker_connection = context.Pipe()
+            worker = context.Process(target=_work, args=(worker_connection, buffer_specs, self._processes, self._weighting_func,
+                    start, stop, seed_sequence), daemon=True)
+            worker.start()
+            worker_connection.close()
+            self._connections.append(connection)
+            self._workers.append(worker)
+        self._finalizer = weakref.finalize(self, _shut_down, self._connections, self._workers, self._shared_memories)
+
+    @property
+    def worker_count(self):
+        return self._worker_count
+
+    def _allocate(self, shape):
+        m = shared_memory.SharedMemory(create=True, size=max(1, int(np.prod(shape)) * np.dtype(float).itemsize))
+        self._shared_memories.append(m)
+        return np.ndarray(shape, buffer=m.buf)
+
+    def _run(self, command, *args):
+        # Runs the command on all the workers, with the same arguments or, where they are lists, with the respective
+        # elements, and returns their results
+        for i, c in enumerate(self._connections):
+            c.send((command, tuple([a[i] if isinstance(a, list) else a for a in args])))
+        results = [c.recv() for c in self._connections]
+        for ok, result in results:
+            if not ok: raise result
+        return [result for _, result in results]
+
+    def _buffer_idx(self, buffer):
+        return 0 if buffer is self._particle_buffers[0] else 1
+
+    def _propagate(self, time):
+        if not self._finalizer.alive: return super()._propagate(time)
+        self._run('predict', self._time, time, self._buffer_idx(self._resampled_particles), self._buffer_idx(self._prior_particles))
+
+    def _update_weights(self, observation):
+        if not self._finalizer.alive: return super()._update_weights(observation)
+        kernel_cov = self._weighting_func.kernel_cov(self._prior_particles, self._weights) \
+                if isinstance(self._weighting_func, particle.KDEWeightingFunction) else None
+        max_log_weights, weight_sums = zip(*self._run('weight', observation, self._buffer_idx(self._prior_particles), kernel_cov))
+        max_log_weight = np.max(max_log_weights)
+        if not np.isfinite(max_log_weight): return None
+        # The chunks' sums of the exponentials of the log-weights relative to the overall maximum
+        weight_sums = np.array(weight_sums) * np.exp(np.array(max_log_weights) - max_log_weight)
+        weight_sum = np.sum(weight_sums)
+        log_weight_sum = max_log_weight + np.log(weight_sum)
+        cumulative_weight_offsets = np.concatenate(([0.], np.cumsum(weight_sums)[:-1])) / weight_sum
+        self.effective_sample_size = 1. / np.sum(self._run('normalize', log_weight_sum, list(cumulative_weight_offsets)))
+        return log_weight_sum
+
+    def _resample(self):
+        if not self._finalizer.alive or not isinstance(self._resampling,
+                (particle.MultinomialResampling, particle.SystematicResampling, particle.StratifiedResampling)):
+            return super()._resample()
+        self._run('resample', self._resampling, self._random_state.uniform(),
+                self._buffer_idx(self._prior_particles), self._buffer_idx(self._resampled_particles))
+        self._state_distr = self._particles_distr(self._resampled_particles)
+
+        self._resampled_particles_uptodate = True
+        self._cached_resampled_mean = None
+        self._cached_resampled_var = None
+
+    def close(self):
+        # Stops the workers and releases the shared memory; the filter then runs in this process, on copies of the buffers
+        if not self._finalizer.alive: return
+        self._prior_particles, self._resampled_particles = np.array(self._prior_particles), np.array(self._resampled_particles)
+        self._particle_buffers = (self._prior_particles, self._resampled_particles)
+        self._log_unnormalized_weights = np.array(self._log_unnormalized_weights)
+        self._log_weights = np.array(self._log_weights)
+        self._weights = np.array(self._weights)
+        self._cumulative_weights = None
+        self._state_distr = self._particles_distr(self._resampled_particles) if self._resampled_particles_uptodate \
+                else self._particles_distr(self._prior_particles, self._weights)
+        self._finalizer()
@@ -2,17 +2,22 @@ from collections import OrderedDict
 import warnings
 
 import numpy as np
+import scipy.linalg as la
+import scipy.special as special
 import statsmodels.api as sm
 
 import thalesians.tsa.checks as checks
 from thalesians.tsa.distrs import EmpiricalDistr
 from thalesians.tsa.distrs import NormalDistr as N
 import thalesians.tsa.filtering as filtering
+import thalesians.tsa.filtering.kalman as kalman
+import thalesians.tsa.kde as kde
 import thalesians.tsa.objects as objects
 import thalesians.tsa.outliers as outliers
 import thalesians.tsa.processes as proc
 import thalesians.tsa.numpyutils as npu
 import thalesians.tsa.randomness as rnd
+from thalesians.tsa.strings import ToStringHelper
 
 class ParticleObsResult(filtering.ObsResult):
     def __init__(self, accepted, obs, predicted_obs, innov_distr, log_likelihood):
@@ -28,15 +33,82 @@ class ParticleObsResult(filtering.ObsResult):
         if self._str_ParticleObsResult is None: self._str_ParticleObsResult = self.to_string_helper().to_string()
         return self._str_ParticleObsResult
 
+# A weighting function returns the log-weights, i.e. the log-likelihoods of the observation given the particles, up to
+# an additive constant. If it is vectorized (see npu.vectorized), it is called once with all the particles, as an
+# (particle_count, state_dim) array, and returns an array of particle_count log-weights
+
+def _obs_particles(obs_function, particles):
+    if obs_function is None: return particles
+    if npu.is_vectorized(obs_function): return np.reshape(obs_function(particles), (npu.nrow(particles), -1))
+    return np.array([npu.to_ndim_1(obs_function(p)) for p in particles])
+
+class GaussianWeightingFunction(object):
+    # The log-density of the observation under the Normal distribution with the covariance obs_cov around the
+    # observation function of each particle (by default, the particle itself)
+    LN_2PI = np.log(2. * np.pi)
+    
+    def __init__(self, obs_cov, obs_function=None):
+        self._obs_cov = npu.to_ndim_2(obs_cov, copy=True)
+        self._obs_function = obs_function
+        self._obs_cov_chol = np.linalg.cholesky(self._obs_cov)
+        self._log_norm_factor = -.5 * npu.nrow(self._obs_cov) * GaussianWeightingFunction.LN_2PI - np.sum(np.log(np.diag(self._obs_cov_chol)))
+    
+    @property
+    def obs_cov(self):
+        return self._obs_cov
+    
+    def _mahalanobis_sq(self, obs, particles):
+        obs_particles = _obs_particles(self._obs_function, particles)
+        # A single observation for all the particles or (as from a ParticleFilterBank) one row for each of them
+        obs = np.asarray(obs, dtype=float)
+        if np.shape(obs) != np.shape(obs_particles): obs = npu.to_ndim_1(obs)
+        residuals = obs - obs_particles
+        whitened_residuals = la.solve_triangular(self._obs_cov_chol, residuals.T, lower=True, check_finite=False)
+        return np.sum(whitened_residuals * whitened_residuals, axis=0)
+    
+    @npu.vectorized
+    def __call__(self, obs, particles, filter=None):  # @ReservedAssignment
+        return self._log_norm_factor - .5 * self._mahalanobis_sq(obs, particles)
+
+class StudentTWeightingFunction(GaussianWeightingFunction):
+    # The log-density of the observation under the multivariate Student t-distribution with the scale matrix obs_cov and
+    # dof degrees of freedom around the observation function of each particle, which is robust to outlying observations
+    def __init__(self, obs_cov, dof, obs_function=None):
+        super().__init__(obs_cov, obs_function)
+        self._dof = dof
+        obs_dim = npu.nrow(self._obs_cov)
+        self._log_norm_factor = special.gammaln(.5 * (dof + obs_dim)) - special.gammaln(.5 * dof) - .5 * obs_dim * np.log(dof * np.pi) - \
+                np.sum(np.log(np.diag(self._obs_cov_chol)))
+    
+    @property
+    def dof(self):
+        return self._dof
+    
+    @npu.vectorized
+    def __call__(self, obs, particles, filter=None):  # @ReservedAssignment
+        return self._log_norm_factor - .5 * (self._dof + npu.nrow(self._obs_cov)) * np.log1p(self._mahalanobis_sq(obs, particles) / self._dof)
+
 class KDEWeightingFunction(object):
-    def __init__(self, obs_function=None):
-        if obs_function is None: obs_function = lambda x: x
+    # The log-density of the observation under the Gaussian kernel around the observation function of each particle,
+    # with the bandwidth of the kernel density estimate (see kde.GaussianKDEDistr) of the observation functions of the
+    # particles
+    def __init__(self, obs_function=None, bw_method=None):
         self._obs_function = obs_function
+        self._bw_method = bw_method
+
+    @property
+    def obs_function(self):
+        return self._obs_function
+
+    def kernel_cov(self, particles, weights=None):
+        # The covariance of the kernel, which depends on all the (weighted) particles
+        obs_particles = _obs_particles(self._obs_function, particles)
+        return kde.GaussianKDEDistr(EmpiricalDistr(particles=obs_particles.view(), weights=weights, copy=False), bw_method=self._bw_method).cov
 
-    def __call__(self, obs, particles):
-        obs_particles = [self._obs_function(p) for p in particles]
-        obs_particles_kde = sm.nonparametric.KDEMultivariate(obs_particles)
-        return obs_particles_kde.pdf(obs)
+    @npu.vectorized
+    def __call__(self, obs, particles, filter=None):  # @ReservedAssignment
+        weights = None if filter is None else filter._weights
+        return GaussianWeightingFunction(self.kernel_cov(particles, weights), self._obs_function)(obs, particles)
 
 class ParticleFilterObsModel(object):
     def __init__(self, weighting_function):
@@ -67,9 +139,105 @@ class ParticleFilterObsModel(object):
         if self._str_ParticleFilterObsModel is None: self._str_ParticleFilterObsModel = self.to_string_helper().to_string()
         return self._str_ParticleFilterObsModel
 
-class ParticleFilter(objects.Named):
-    MIN_WEIGHT_SUM = np.finfo(float).eps
+class Resampling(object):
+    # A resampling scheme: draws len(out) particles from the weighted particles and writes them to out
+    def __call__(self, particles, weights, random_state, out):
+        raise NotImplementedError()
+
+class IndexResampling(Resampling):
+    # A resampling scheme that draws the indices of the resampled particles, which are then gathered in a single pass
+    def indices(self, weights, count, random_state):
+        raise NotImplementedError()
+    
+    def __call__(self, particles, weights, random_state, out):
+        # With mode='clip', take writes to out directly rather than through a temporary buffer
+        return np.take(particles, self.indices(weights, len(out), random_state), axis=0, out=out, mode='clip')
+
+def _inverse_cdf(weights, uniforms):
+    # The indices of the particles whose cumulative weight intervals contain the (sorted) uniforms; the last cumulative
+    # weight may fall short of 1 due to rounding
+    return np.minimum(np.searchsorted(np.cumsum(weights), uniforms, side='right'), len(weights) - 1)
+
+class MultinomialResampling(IndexResampling):
+    def indices(self, weights, count, random_state):
+        return np.repeat(np.arange(len(weights)), random_state.multinomial(count, weights))
+
+class SystematicResampling(IndexResampling):
+    # A single uniform offsets count evenly spaced points
+    def indices(self, weights, count, random_state):
+        return _inverse_cdf(weights, (random_state.uniform() + np.arange(count)) / count)
 
+class StratifiedResampling(IndexResampling):
+    # One uniform in each of count equal strata
+    def indices(self, weights, count, random_state):
+        return _inverse_cdf(weights, (random_state.uniform(size=count) + np.arange(count)) / count)
+
+class ResidualResampling(IndexResampling):
+    # Each particle is copied floor(count * weight) times; the remaining particles are drawn multinomially from the
+    # residual weights
+    def indices(self, weights, count, random_state):
+        scaled_weights = count * np.asarray(weights)
+        counts = np.floor(scaled_weights).astype(int)
+        residual_count = count - np.sum(counts)
+        if residual_count > 0:
+            residual_weights = scaled_weights - counts
+            counts += random_state.multinomial(residual_count, residual_weights / np.sum(residual_weights))
+        return np.repeat(np.arange(len(weights)), counts)
+
+class SmoothResampling(Resampling):
+    # Draws from the piecewise linear approximation of the weighted particles' distribution function, interpolating
+    # between consecutive particles in the order of their (first) components
+    def __call__(self, particles, weights, random_state, out):
+        count = len(out)
+        particle_count = len(weights)
+        order = np.argsort(particles[:, 0], kind='stable')
+        particles, weights = particles[order], weights[order]
+        new_weights = np.empty((particle_count+1,))
+        new_weights[0] = .5*weights[0]
+        new_weights[particle_count] = .5*weights[particle_count-1]
+        new_weights[1:particle_count] = .5*(weights[1:] + weights[:-1])
+        
+        uniforms = random_state.uniform(size=count)
+        uniforms.sort()
+        cumulative_weights = np.cumsum(new_weights)
+        regions = np.minimum(np.searchsorted(cumulative_weights, uniforms, side='left'), particle_count)
+        new_uniforms = (uniforms - (cumulative_weights[regions] - new_weights[regions])) / new_weights[regions]
+        
+        # The first and the last regions are those of the first and the last particles
+        lower_idxs = np.maximum(regions - 1, 0)
+        upper_idxs = np.minimum(regions, particle_count - 1)
+        np.subtract(particles[upper_idxs], particles[lower_idxs], out=out)
+        out *= new_uniforms[:, np.newaxis]
+        out += particles[lower_idxs]
+        return out
+
+class RegularizedResampling(Resampling):
+    # Resamples with the given scheme (by default, multinomial) and jitters the resampled particles with the kernel of
+    # the weighted particles' kernel density estimate, i.e. with the Normal distribution whose covariance is that of the
+    # weighted particles scaled by the square of the bandwidth factor of bw_method (see kde.GaussianKDEDistr)
+    def __init__(self, resampling=None, bw_method=None):
+        if resampling is None: resampling = MultinomialResampling()
+        self._resampling = checks.check_instance(resampling, Resampling)
+        self._bw_method = bw_method
+    
+    @property
+    def resampling(self):
+        return self._resampling
+    
+    def __call__(self, particles, weights, random_state, out):
+        distr = EmpiricalDistr(particles=particles.view(), weights=weights[:, np.newaxis], copy=False)
+        bw_factor = kde.GaussianKDEDistr(distr, bw_method=self._bw_method).covariance_factor()
+        try:
+            vol = np.linalg.cholesky(distr.cov)
+        except np.linalg.LinAlgError:
+            # The particles are degenerate in some directions, in which they are not jittered
+            eigenvalues, eigenvectors = np.linalg.eigh(distr.cov)
+            vol = eigenvectors * np.sqrt(np.maximum(eigenvalues, 0.))
+        self._resampling(particles, weights, random_state, out=out)
+        out += np.dot(random_state.normal(size=np.shape(out)), bw_factor * vol.T)
+        return out
+
+class ParticleFilter(objects.Named):
     # TODO Kalman filter has the following parameters:
     # def __init__(self, time, state_distr, process, name=None, pype=None,
     #              pype_options=frozenset(filtering.FilterPypeOptions)):
@@ -83,6 +251,7 @@ class ParticleFilter(objects.Named):
                  particle_count=1000, observation_dim=1,
                  random_state=None,
                  predicted_observation_sampler=None, outlier_threshold=None,
+                 resampling=None, resampling_threshold=None,
                  name=None, pype=None, pype_options=frozenset(filtering.FilterPypeOptions)):
         super().__init__(name)
         self._pype = pype
@@ -90,6 +259,7 @@ class ParticleFilter(objects.Named):
         if not checks.is_iterable(process): process = (process,)
         process = checks.check_iterable_over_instances(process, proc.SolvedItoProcess)
         if weighting_func is None: weighting_func = KDEWeightingFunction()
+        if resampling is None: resampling = self._create_default_resampling()
         self._time = time
         self._observation_dim = observation_dim
         self._state_distr = state_distr
@@ -100,11 +270,20 @@ class ParticleFilter(objects.Named):
         self._current_particle_idx = None
         self._random_state = rnd.random_state() if random_state is None else random_state
         self._predicted_observation_sampler = predicted_observation_sampler
+        self._resampling = checks.check_instance(resampling, Resampling)
+        # The particles are resampled after every observation if resampling_threshold is None and otherwise only when
+        # the effective sample size falls below resampling_threshold * particle_count; thus they are never resampled if
+        # it is zero. Until they are, the weights carry over from observation to observation
+        self._resampling_threshold = resampling_threshold
+        self._resample_count = 0
         
-        self._prior_particles = np.empty((self._particle_count, self._state_dim))
-        self._resampled_particles = np.empty((self._particle_count, self._state_dim))
-        self._unnormalized_weights = np.empty((self._particle_count,))
-        self._weights = np.empty((self._particle_count,))
+        self._prior_particles = self._allocate((self._particle_count, self._state_dim))
+        self._resampled_particles = self._allocate((self._particle_count, self._state_dim))
+        # The weights are kept in the log domain, and normalized with the log-sum-exp, so that they neither underflow nor
+        # overflow however sharp the observations are
+        self._log_unnormalized_weights = self._allocate((self._particle_count,))
+        self._log_weights = self._allocate((self._particle_count,))
+        self._weights = self._allocate((self._particle_count,))
         self._resampled_particles_uptodate = False
         
         self._last_observation = None
@@ -222,16 +401,23 @@ class ParticleFilter(objects.Named):
     def create_named_identity_observable(self, name, *args):
         return ParticleFilter.ParticleObservable(self, name, None, args)
             
+    # An auxiliary method of the constructor. Allocates the (float) buffers of the particles and the weights
+    def _allocate(self, shape):
+        return np.empty(shape)
+    
     # An auxiliary method of the constructor. Not called anywhere else.
     def _initialize(self):
-        # TODO Vectorize
-        for i in range(self._particle_count):
-            self._current_particle_idx = i
-            self._prior_particles[i,:] = npu.to_ndim_1(self._state_distr.sample())
-            self._resampled_particles[i,:] = self._prior_particles[i,:]
-        self._current_particle_idx = None
-        self._unnormalized_weights[:] = np.NaN
+        self._prior_particles[:] = np.reshape(self._state_distr.sample(size=self._particle_count, random_state=self._random_state),
+                (self._particle_count, self._state_dim))
+        self._resampled_particles[:] = self._prior_particles
+        self._log_unnormalized_weights[:] = np.NaN
+        self._log_weights[:] = -np.log(self._particle_count)
         self._weights[:] = 1./self._particle_count
+    
+    def _particles_distr(self, particles, weights=None):
+        # An EmpiricalDistr over read-only views of the particle buffers, rather than over copies of them. The buffers are
+        # reused, so that it only describes the filter's state until its next step
+        return EmpiricalDistr(particles=particles.view(), weights=None if weights is None else weights[:, np.newaxis], copy=False)
             
     def predict(self, time, true_value=None):
         # TODO Use true_value
@@ -240,26 +426,26 @@ class ParticleFilter(objects.Named):
         if time == self.time:
             print('Predicting the present - nothing to do')
             return
-        if not self._resampled_particles_uptodate:
-            self._resampled_particles[:] = self._prior_particles[:]
-        row = 0
-        self._prior_particles = np.empty((self._particle_count, self._state_dim))
-        for p in self._processes:
-            process_dim = p.process_dim
-            if npu.is_vectorized(p.propagate):
-                self._prior_particles[:, row:row+process_dim] = p.propagate(self._time, self._resampled_particles[:, row:row+process_dim], time)
-            else:
-                for i in range(self._particle_count):
-                    self._current_particle_idx = i
-                    self._prior_particles[i, row:row+process_dim] = npu.to_ndim_1(p.propagate(self._time, self._resampled_particles[i, row:row+process_dim], time))
-                self._current_particle_idx = None
-            row += process_dim
+        # The particles are double-buffered: the new prior particles are propagated from the resampled ones, which are
+        # equally weighted, into the other buffer. If the particles have not been resampled since the last prediction,
+        # the prior particles are propagated as they are, with their weights, so that the buffers are swapped rather
+        # than copied
+        if self._resampled_particles_uptodate:
+            self._log_weights[:] = -np.log(self._particle_count)
+            self._weights[:] = 1./self._particle_count
+        else:
+            self._prior_particles, self._resampled_particles = self._resampled_particles, self._prior_particles
+            self._cached_resampled_mean = None
+            self._cached_resampled_var = None
+        self._propagate(time)
 
         self._time = time
 
         self._resampled_particles_uptodate = False
         self._cached_prior_mean = None
         self._cached_prior_var = None
+        self._cached_posterior_mean = None
+        self._cached_posterior_var = None
         
         # TODO Vectorize
         # TODO using fft kde - assumes all weights are equal!
@@ -284,73 +470,117 @@ class ParticleFilter(objects.Named):
             #plt.show()
             self.innovationvar = np.var(self.predicted_observation_particles) + self.predicted_observation_kde.bw * self.predicted_observation_kde.bw
 
-        self._state_distr = EmpiricalDistr(particles=self._prior_particles)
+        self._state_distr = self._particles_distr(self._prior_particles, self._weights)
             
     def _weight(self, observation):
         if self._predicted_observation_sampler is not None:
             self.innovation = observation - self.predicted_observation
         
-        weight_sum = 0.
+        log_weight_sum = self._update_weights(observation)
+        if log_weight_sum is None:
+            # The weights are left as they are
+            warnings.warn('The observation has zero likelihood under all the particles')
+            self.log_likelihood = -np.inf
+        else:
+            self.log_likelihood += log_weight_sum
+        
+        self._last_observation = observation
+        
+        self._cached_posterior_mean = None
+        self._cached_posterior_var = None
 
+        self._state_distr = self._particles_distr(self._prior_particles, self._weights)
+        
+    def _propagate(self, time):
+        # Propagates the resampled particles to the time into the prior particles
+        row = 0
+        for p in self._processes:
+            process_dim = p.process_dim
+            if npu.is_vectorized(p.propagate):
+                self._prior_particles[:, row:row+process_dim] = p.propagate(self._time, self._resampled_particles[:, row:row+process_dim], time,
+                        random_state=self._random_state)
+            else:
+                for i in range(self._particle_count):
+                    self._current_particle_idx = i
+                    self._prior_particles[i, row:row+process_dim] = npu.to_ndim_1(p.propagate(self._time, self._resampled_particles[i, row:row+process_dim], time,
+                            random_state=self._random_state))
+                self._current_particle_idx = None
+            row += process_dim
+            
+    def _update_weights(self, observation):
+        # Weights the prior particles by the observation, updates the weights and the effective sample size, and returns
+        # the log of the sum of the unnormalized weights, or None (leaving the weights as they are) if it is zero
         if npu.is_vectorized(self._weighting_func):
-            self._unnormalized_weights = npu.to_ndim_1(self._weighting_func(observation, self._prior_particles, self))
-            weight_sum = np.sum(self._unnormalized_weights)
+            self._log_unnormalized_weights[:] = npu.to_ndim_1(self._weighting_func(observation, self._prior_particles, self))
         else:
             for i in range(self._particle_count):
                 self._current_particle_idx = i
-                self._unnormalized_weights[i] = npu.toscalar(self._weighting_func(observation, self._prior_particles[i,:], self))
-                weight_sum += self._unnormalized_weights[i]
+                self._log_unnormalized_weights[i] = npu.to_scalar(self._weighting_func(observation, self._prior_particles[i,:], self))
             self._current_particle_idx = None
-                
-        if weight_sum < ParticleFilter.MIN_WEIGHT_SUM:
-            warnings.warn('The sum of weights is less than MIN_WEIGHT_SUM')
-            #self._unnormalized_weights[:] = 1. / self._particle_count
-            #weight_sum = 1.
         
-        self._weights = self._unnormalized_weights / weight_sum
+        # The weights carried over from the previous observations (which are equal after resampling), so that the sum of
+        # the unnormalized weights is the likelihood of the observation
+        self._log_unnormalized_weights += self._log_weights
+        max_log_weight = np.max(self._log_unnormalized_weights)
+        if not np.isfinite(max_log_weight): return None
         
+        np.subtract(self._log_unnormalized_weights, max_log_weight, out=self._log_weights)
+        np.exp(self._log_weights, out=self._weights)
+        weight_sum = np.sum(self._weights)
+        self._weights /= weight_sum
+        self._log_weights -= np.log(weight_sum)
         self.effective_sample_size = 1. / np.sum(np.square(self._weights))
-
-        self.log_likelihood += np.log(np.sum(self._unnormalized_weights) / self._particle_count)
-        
-        self._last_observation = observation
-        
-        self._cached_posterior_mean = None
-        self._cached_posterior_var = None
-
-        self._state_distr = EmpiricalDistr(particles=self._prior_particles, weights=self._weights)
+        return max_log_weight + np.log(weight_sum)
         
+    def _create_default_resampling(self):
+        return MultinomialResampling()
+    
     def _resample(self):
-        raise NotImplementedError('Pure virtual method')
+        self._resampling(self._prior_particles, self._weights, self._random_state, out=self._resampled_particles)
+        self._state_distr = self._particles_distr(self._resampled_particles)
+
+        self._resampled_particles_uptodate = True
+        self._cached_resampled_mean = None
+        self._cached_resampled_var = None
         
     def observe(self, observation):
         if self._outlier_threshold is not None:
-            if outliers.isoutlier(self.predicted_observation_particles, self.predicted_observation_kde.bw, observation, self._outlier_threshold, 100000, self._random_state):
+            if np.any(outliers.isoutlier(self.predicted_observation_particles, self.predicted_observation_kde.bw, observation, self._outlier_threshold, weights=self._weights)):
                 print('OUTLIER!!!')
-                self._resampled_particles = np.copy(self._prior_particles)
+                # The prior particles and their weights stand
                 return False
             else:
                 # print('NOT AN OUTLIER!!!')
                 pass
         self._weight(observation)
-        self._resample()
+        if self._resampling_threshold is None or self.effective_sample_size < self._resampling_threshold * self._particle_count:
+            self._resample()
+            self._resample_count += 1
         return True
         
     @property
     def prior_particles(self):
-        return npu.immutablecopyof(self._prior_particles)
+        return npu.immutable_copy_of(self._prior_particles)
     
     @property
     def resampled_particles(self):
-        return npu.immutablecopyof(self._resampled_particles)
+        return npu.immutable_copy_of(self._resampled_particles)
+
+    @property
+    def log_unnormalized_weights(self):
+        return npu.immutable_copy_of(self._log_unnormalized_weights)
 
     @property
     def unnormalized_weights(self):
-        return npu.immutablecopyof(self._unnormalized_weights)
+        return npu.immutable_copy_of(np.exp(self._log_unnormalized_weights))
+
+    @property
+    def log_weights(self):
+        return npu.immutable_copy_of(self._log_weights)
 
     @property
     def weights(self):
-        return npu.immutablecopyof(self._weights)
+        return npu.immutable_copy_of(self._weights)
 
     @property
     def prior_mean(self):
@@ -389,10 +619,10 @@ class ParticleFilter(objects.Named):
         return self._cached_resampled_var
     
     @property
-    def mean(self): return self.resampled_mean
+    def mean(self): return self.resampled_mean if self._resampled_particles_uptodate else self.posterior_mean
     
     @property
-    def var(self): return self.resampled_var
+    def var(self): return self.resampled_var if self._resampled_particles_uptodate else self.posterior_var
     
     @property
     def last_observation(self): return self._last_observation
@@ -400,6 +630,15 @@ class ParticleFilter(objects.Named):
     @property
     def particle_count(self): return self._particle_count
     
+    @property
+    def resampling(self): return self._resampling
+    
+    @property
+    def resampling_threshold(self): return self._resampling_threshold
+    
+    @property
+    def resample_count(self): return self._resample_count
+    
     @property
     def current_particle_idx(self): return self._current_particle_idx
     
@@ -407,72 +646,454 @@ class ParticleFilter(objects.Named):
     def context(self): return self._context
     
 class MultinomialResamplingParticleFilter(ParticleFilter):
-    def _resample(self):
-        counts = self._random_state.multinomial(self._particle_count, self._weights)
-        particle_idx = 0
-        for i in range(self._particle_count):
-            for j in range(counts[i]):  # @UnusedVariable
-                self._resampled_particles[particle_idx,:] = self._prior_particles[i,:]
-                particle_idx += 1
+    def _create_default_resampling(self):
+        return MultinomialResampling()
+
+class RegularizedResamplingParticleFilter(ParticleFilter):
+    def _create_default_resampling(self):
+        return RegularizedResampling()
+            
+class SmoothResamplingParticleFilter(ParticleFilter):
+    def _create_default_resampling(self):
+        return SmoothResampling()
+
+class ParticleFilterBankObsResult(object):
+    def __init__(self, time, filter_idxs, log_likelihood, effective_sample_size, resampled):
+        self._time = time
+        self._filter_idxs = filter_idxs
+        self._log_likelihood = log_likelihood
+        self._effective_sample_size = effective_sample_size
+        self._resampled = resampled
+        self._to_string_helper_ParticleFilterBankObsResult = None
+        self._str_ParticleFilterBankObsResult = None
+
+    @property
+    def time(self):
+        return self._time
+
+    @property
+    def filter_idxs(self):
+        return self._filter_idxs
+
+    @property
+    def log_likelihood(self):
+        return self._log_likelihood
+
+    @property
+    def effective_sample_size(self):
+        return self._effective_sample_size
+
+    @property
+    def resampled(self):
+        return self._resampled
+
+    def to_string_helper(self):
+        if self._to_string_helper_ParticleFilterBankObsResult is None:
+            self._to_string_helper_ParticleFilterBankObsResult = ToStringHelper(self) \
+                    .add('time', self._time) \
+                    .add('filter_idxs', self._filter_idxs) \
+                    .add('log_likelihood', self._log_likelihood) \
+                    .add('effective_sample_size', self._effective_sample_size)
+        return self._to_string_helper_ParticleFilterBankObsResult
+
+    def __str__(self):
+        if self._str_ParticleFilterBankObsResult is None: self._str_ParticleFilterBankObsResult = self.to_string_helper().to_string()
+        return self._str_ParticleFilterBankObsResult
+
+    def __repr__(self):
+        return str(self)
+
+def _read_only_view(arg):
+    view = arg.view()
+    view.flags.writeable = False
+    return view
+
+def _bank_uniforms(resampling, row_count, count, random_state):
+    # The points, count per row, whose inverse cumulative weights are the indices of the resampled particles
+    if isinstance(resampling, SystematicResampling):
+        return (random_state.uniform(size=(row_count, 1)) + np.arange(count)) / count
+    if isinstance(resampling, StratifiedResampling):
+        return (random_state.uniform(size=(row_count, count)) + np.arange(count)) / count
+    return random_state.uniform(size=(row_count, count))
+
+def _propagate_particles(processes, time0, particles, time, random_state):
+    # Propagates the particles (the rows of a 2-dimensional array) from time0 to time in place
+    row = 0
+    for p in processes:
+        process_dim = p.process_dim
+        if npu.is_vectorized(p.propagate):
+            particles[:, row:row+process_dim] = p.propagate(time0, particles[:, row:row+process_dim], time, random_state=random_state)
+        else:
+            for i in range(len(particles)):
+                particles[i, row:row+process_dim] = npu.to_ndim_1(p.propagate(time0, particles[i, row:row+process_dim], time,
+                        random_state=random_state))
+        row += process_dim
+
+class ParticleFilterBank(objects.Named):
+    # A bank of independent particle filters, all with the same processes, weighting function and particle count, whose
+    # particles are held in a single (filter_count, particle_count, state_dim) array, so that each step is taken for all
+    # the (selected) filters at once. The processes' propagate should be vectorized; the weighting function must be. It is
+    # called on the particles of all the selected filters at once, with an observation row for each particle and None in
+    # place of the filter, so that it must not depend on the particles collectively (as KDEWeightingFunction does)
+    def __init__(self, time, state_distr, process, weighting_func,
+                 particle_count=1000, filter_count=None,
+                 random_state=None,
+                 resampling=None, resampling_threshold=None,
+                 name=None):
+        super().__init__(name)
+        if not checks.is_iterable(process): process = (process,)
+        process = checks.check_iterable_over_instances(process, proc.SolvedItoProcess)
+        self._processes = tuple(process)
+        self._state_dim = sum([p.process_dim for p in self._processes])
+        checks.check(npu.is_vectorized(weighting_func), 'The weighting function must be vectorized')
+        self._weighting_func = weighting_func
+        if resampling is None: resampling = MultinomialResampling()
+        # Only the schemes that invert the cumulative weights at uniform points can be batched
+        self._resampling = checks.check_instance(resampling, (MultinomialResampling, SystematicResampling, StratifiedResampling))
+        # As for ParticleFilter, but for each filter separately
+        self._resampling_threshold = resampling_threshold
+        self._particle_count = particle_count
+        self._random_state = rnd.random_state() if random_state is None else random_state
+        if not checks.is_iterable(state_distr):
+            if filter_count is None: filter_count = 1
+            self._filter_count = filter_count
+            self._particles = np.reshape(state_distr.sample(size=filter_count * particle_count, random_state=self._random_state),
+                    (filter_count, particle_count, self._state_dim))
+        else:
+            state_distr = list(state_distr)
+            if filter_count is None: filter_count = len(state_distr)
+            checks.check(len(state_distr) == filter_count, 'The number of state distributions does not match the filter count')
+            self._filter_count = filter_count
+            self._particles = np.array([np.reshape(d.sample(size=particle_count, random_state=self._random_state),
+                    (particle_count, self._state_dim)) for d in state_distr], dtype=float)
+        if checks.is_iterable(time) and not checks.is_string(time):
+            self._times = np.array(time)
+            checks.check(len(self._times) == filter_count, 'The number of times does not match the filter count')
+        else:
+            self._times = np.array([time] * filter_count)
+        self._log_weights = np.full((filter_count, particle_count), -np.log(particle_count))
+        self._weights = np.full((filter_count, particle_count), 1. / particle_count)
+        self._log_likelihoods = np.zeros((filter_count,))
+        self._effective_sample_sizes = np.full((filter_count,), np.NaN)
+        self._resample_counts = np.zeros((filter_count,), dtype=int)
+        self._to_string_helper_ParticleFilterBank = None
+        self._str_ParticleFilterBank = None
+
+    @property
+    def filter_count(self):
+        return self._filter_count
+
+    @property
+    def particle_count(self):
+        return self._particle_count
+
+    @property
+    def state_dim(self):
+        return self._state_dim
+
+    @property
+    def resampling(self):
+        return self._resampling
+
+    @property
+    def resampling_threshold(self):
+        return self._resampling_threshold
+
+    @property
+    def times(self):
+        return _read_only_view(self._times)
+
+    @property
+    def particles(self):
+        return _read_only_view(self._particles)
+
+    @property
+    def log_weights(self):
+        return _read_only_view(self._log_weights)
+
+    @property
+    def weights(self):
+        return _read_only_view(self._weights)
+
+    @property
+    def log_likelihoods(self):
+        return _read_only_view(self._log_likelihoods)
+
+    @property
+    def effective_sample_sizes(self):
+        return _read_only_view(self._effective_sample_sizes)
+
+    @property
+    def resample_counts(self):
+        return _read_only_view(self._resample_counts)
+
+    @property
+    def means(self):
+        return np.einsum('fp,fpd->fd', self._weights, self._particles)
+
+    @property
+    def vars(self):
+        return np.einsum('fp,fpd->fd', self._weights, (self._particles - self.means[:, np.newaxis, :])**2)
+
+    def state_distr(self, filter_idx):
+        return EmpiricalDistr(particles=self._particles[filter_idx], weights=self._weights[filter_idx][:, np.newaxis])
+
+    def _filter_idxs(self, mask):
+        if mask is None: return np.arange(self._filter_count)
+        mask = np.asarray(mask)
+        if mask.dtype == bool: return np.flatnonzero(mask)
+        return mask.astype(int)
+
+    def predict(self, time, mask=None):
+        idxs = self._filter_idxs(mask)
+        times0 = self._times[idxs]
+        if np.any(times0 > time):
+            raise ValueError('Predicting the past (prediction time=%s)' % time)
+        # The particles of the filters that last ticked at the same time are propagated together
+        unique_times0, inverse = np.unique(times0, return_inverse=True)
+        for k, time0 in enumerate(unique_times0):
+            if time0 == time: continue
+            group_idxs = idxs[inverse == k]
+            particles = np.reshape(self._particles[group_idxs], (-1, self._state_dim))
+            _propagate_particles(self._processes, time0, particles, time, self._random_state)
+            self._particles[group_idxs] = np.reshape(particles, (len(group_idxs), self._particle_count, self._state_dim))
+        self._times[idxs] = time
+
+    def _resample(self, idxs):
+        # Resamples the particles of all the given filters with a single searchsorted: the cumulative weights of the i-th
+        # filter, offset by i, and the uniforms of its particles, likewise offset, fall in [i, i + 1]
+        row_count = len(idxs)
+        offsets = np.arange(row_count)[:, np.newaxis]
+        cumulative_weights = np.cumsum(self._weights[idxs], axis=1)
+        # The last cumulative weight may fall short of 1 due to rounding
+        cumulative_weights /= cumulative_weights[:, -1:]
+        cumulative_weights += offsets
+        uniforms = _bank_uniforms(self._resampling, row_count, self._particle_count, self._random_state) + offsets
+        flat_idxs = np.searchsorted(cumulative_weights.ravel(), uniforms.ravel(), side='right')
+        flat_idxs = np.clip(flat_idxs.reshape(row_count, self._particle_count), offsets * self._particle_count,
+                (offsets + 1) * self._particle_count - 1)
+        particles = np.reshape(self._particles[idxs], (-1, self._state_dim))
+        self._particles[idxs] = particles[flat_idxs]
+        self._log_weights[idxs] = -np.log(self._particle_count)
+        self._weights[idxs] = 1. / self._particle_count
+        self._resample_counts[idxs] += 1
+
+    def observe(self, obss, time=None, mask=None):
+        idxs = self._filter_idxs(mask)
+        if time is not None: self.predict(time, idxs)
+        row_count = len(idxs)
+        obss = np.reshape(np.asarray(obss, dtype=float), (row_count, 1, -1))
+        particles = np.reshape(self._particles[idxs], (-1, self._state_dim))
+        obss = np.reshape(np.broadcast_to(obss, (row_count, self._particle_count, np.shape(obss)[2])), (len(particles), -1))
+        log_unnormalized_weights = np.reshape(self._weighting_func(obss, particles, None), (row_count, self._particle_count))
         
-        self._state_distr = EmpiricalDistr(particles=self._resampled_particles)
+        # As in ParticleFilter, the weights carry over from the previous observations and are normalized with the
+        # log-sum-exp, row by row
+        log_unnormalized_weights += self._log_weights[idxs]
+        max_log_weights = np.max(log_unnormalized_weights, axis=1)
+        log_likelihoods = np.full((row_count,), -np.inf)
+        finite = np.isfinite(max_log_weights)
+        if not np.all(finite):
+            # The weights of those filters are left as they are
+            warnings.warn('The observations have zero likelihood under all the particles of filters %s' % idxs[~finite])
+            self._log_likelihoods[idxs[~finite]] = -np.inf
+        finite_idxs, max_log_weights = idxs[finite], max_log_weights[finite]
+        log_weights = log_unnormalized_weights[finite] - max_log_weights[:, np.newaxis]
+        weights = np.exp(log_weights)
+        weight_sums = np.sum(weights, axis=1)
+        weights /= weight_sums[:, np.newaxis]
+        log_weights -= np.log(weight_sums)[:, np.newaxis]
+        self._log_weights[finite_idxs] = log_weights
+        self._weights[finite_idxs] = weights
+        log_likelihoods[finite] = max_log_weights + np.log(weight_sums)
+        self._log_likelihoods[finite_idxs] += log_likelihoods[finite]
+        self._effective_sample_sizes[finite_idxs] = 1. / np.sum(np.square(weights), axis=1)
+        
+        resampled = np.zeros((row_count,), dtype=bool)
+        if self._resampling_threshold is None: resampled[finite] = True
+        else: resampled[finite] = self._effective_sample_sizes[finite_idxs] < self._resampling_threshold * self._particle_count
+        if np.any(resampled): self._resample(idxs[resampled])
+        
+        return ParticleFilterBankObsResult(time, idxs, log_likelihoods, self._effective_sample_sizes[idxs], resampled)
 
-        self._resampled_particles_uptodate = True
-        self._cached_resampled_mean = None
-        self._cached_resampled_var = None
+    def to_string_helper(self):
+        if self._to_string_helper_ParticleFilterBank is None:
+            self._to_string_helper_ParticleFilterBank = super().to_string_helper() \
+                    .set_type(self) \
+                    .add('filter_count', self._filter_count) \
+                    .add('particle_count', self._particle_count) \
+                    .add('state_dim', self._state_dim)
+        return self._to_string_helper_ParticleFilterBank
+
+    def __str__(self):
+        if self._str_ParticleFilterBank is None: self._str_ParticleFilterBank = self.to_string_helper().to_string()
+        return self._str_ParticleFilterBank
+
+class RaoBlackwellizedParticleFilter(objects.Named):
+    # A particle filter whose linear-Gaussian sub-state is marginalized out. The particles sample the nonlinear sub-state,
+    # which follows the processes, and each carries the Normal distribution of the linear sub-state, which follows the
+    # linear processes, conditional on the particle's path. These conditional distributions are the filters of a
+    # KalmanFilterBank, one for each particle, so that they are predicted and updated in a single batched Kalman step.
+    # The observation is obs_model's observation of the linear sub-state plus obs_offset plus a Normal noise with the
+    # covariance obs_cov, either of which may be a vectorized function of the particles, returning a row or a matrix for
+    # each of them. The particles are weighted by the likelihoods of the observation under their filters
+    def __init__(self, time, state_distr, process, linear_state_distr, linear_process, obs_model, obs_cov, obs_offset=None,
+                 particle_count=1000,
+                 random_state=None,
+                 resampling=None, resampling_threshold=None,
+                 name=None):
+        super().__init__(name)
+        if not checks.is_iterable(process): process = (process,)
+        process = checks.check_iterable_over_instances(process, proc.SolvedItoProcess)
+        self._processes = tuple(process)
+        self._state_dim = sum([p.process_dim for p in self._processes])
+        self._time = time
+        self._particle_count = particle_count
+        self._random_state = rnd.random_state() if random_state is None else random_state
+        self._particles = np.reshape(state_distr.sample(size=particle_count, random_state=self._random_state),
+                (particle_count, self._state_dim))
+        self._kalman_filter_bank = kalman.KalmanFilterBank(time, linear_state_distr, linear_process, filter_count=particle_count)
+        self._obs_model = obs_model
+        self._obs_dim = npu.nrow(obs_model.obs_matrix)
+        self._obs_cov = obs_cov
+        self._obs_offset = obs_offset
+        if resampling is None: resampling = MultinomialResampling()
+        # The filters follow their particles, so the particles must be resampled by index
+        self._resampling = checks.check_instance(resampling, IndexResampling)
+        # As for ParticleFilter
+        self._resampling_threshold = resampling_threshold
+        self._resample_count = 0
+        self._log_weights = np.full((particle_count,), -np.log(particle_count))
+        self._weights = np.full((particle_count,), 1. / particle_count)
+        self.log_likelihood = 0.
+        self.effective_sample_size = np.NaN
+        self._to_string_helper_RaoBlackwellizedParticleFilter = None
+        self._str_RaoBlackwellizedParticleFilter = None
+
+    @property
+    def time(self):
+        return self._time
+
+    @property
+    def particle_count(self):
+        return self._particle_count
+
+    @property
+    def state_dim(self):
+        return self._state_dim
+
+    @property
+    def linear_state_dim(self):
+        return self._kalman_filter_bank.state_dim
+
+    @property
+    def kalman_filter_bank(self):
+        return self._kalman_filter_bank
+
+    @property
+    def resampling(self):
+        return self._resampling
+
+    @property
+    def resampling_threshold(self):
+        return self._resampling_threshold
+
+    @property
+    def resample_count(self):
+        return self._resample_count
+
+    @property
+    def particles(self):
+        return _read_only_view(self._particles)
+
+    @property
+    def linear_state_means(self):
+        return self._kalman_filter_bank.state_means[:, :, 0]
+
+    @property
+    def linear_state_covs(self):
+        return self._kalman_filter_bank.state_covs
+
+    @property
+    def log_weights(self):
+        return _read_only_view(self._log_weights)
+
+    @property
+    def weights(self):
+        return _read_only_view(self._weights)
+
+    @property
+    def mean(self):
+        # The means of the nonlinear sub-state followed by those of the linear one
+        return np.concatenate((np.average(self._particles, weights=self._weights, axis=0),
+                np.average(self.linear_state_means, weights=self._weights, axis=0)))
+
+    @property
+    def var(self):
+        # The variances of the linear sub-state are the means of the conditional variances plus the variances of the
+        # conditional means
+        linear_state_means = self.linear_state_means
+        linear_var = np.average(np.diagonal(self.linear_state_covs, axis1=1, axis2=2), weights=self._weights, axis=0) + \
+                np.average((linear_state_means - np.average(linear_state_means, weights=self._weights, axis=0))**2, weights=self._weights, axis=0)
+        return np.concatenate((np.average((self._particles - np.average(self._particles, weights=self._weights, axis=0))**2,
+                weights=self._weights, axis=0), linear_var))
+
+    def predict(self, time):
+        if time < self._time:
+            raise ValueError('Predicting the past (current time=%s, prediction time=%s)' % (self._time, time))
+        if time == self._time: return
+        _propagate_particles(self._processes, self._time, self._particles, time, self._random_state)
+        self._kalman_filter_bank.predict(time)
+        self._time = time
 
-class RegularizedResamplingParticleFilter(ParticleFilter):
     def _resample(self):
-        # TODO This only works when self._state_dim == 1
-        # TODO Vectorize
-        kde = sm.nonparametric.KDEUnivariate(self._prior_particles)
-        kde.fit(fft=False, weights=self._weights)
-        counts = self._random_state.multinomial(self._particle_count, self._weights)
-        particle_idx = 0
-        bw_factor = .5
-        for i in range(self._particle_count):
-            for j in range(counts[i]):  # @UnusedVariable
-                self._resampled_particles[particle_idx,:] = self._prior_particles[i,:]
-                particle_idx += 1
-        self._resampled_particles[:] += bw_factor * kde.bw * self._random_state.normal(size=(self._particle_count, 1))
+        idxs = self._resampling.indices(self._weights, self._particle_count, self._random_state)
+        self._particles = np.take(self._particles, idxs, axis=0)
+        self._kalman_filter_bank.resample(idxs)
+        self._log_weights[:] = -np.log(self._particle_count)
+        self._weights[:] = 1. / self._particle_count
+
+    def observe(self, obs):
+        # Updates the filters of all the particles at once and returns the KalmanFilterBankObsResult
+        obs = npu.to_ndim_1(np.asarray(obs, dtype=float))
+        if callable(self._obs_cov): obs_covs = np.reshape(self._obs_cov(self._particles), (self._particle_count, self._obs_dim, self._obs_dim))
+        else: obs_covs = self._obs_cov
+        if self._obs_offset is None: obss = np.broadcast_to(obs, (self._particle_count, self._obs_dim))
+        elif callable(self._obs_offset): obss = obs - np.reshape(self._obs_offset(self._particles), (self._particle_count, self._obs_dim))
+        else: obss = np.broadcast_to(obs - npu.to_ndim_1(self._obs_offset), (self._particle_count, self._obs_dim))
+        obs_result = self._kalman_filter_bank.observe(obss, self._obs_model, obs_covs)
         
-        self._state_distr = EmpiricalDistr(particles=self._resampled_particles)
+        # As in ParticleFilter, the weights carry over from the previous observations and are normalized with the
+        # log-sum-exp
+        log_unnormalized_weights = obs_result.log_likelihood + self._log_weights
+        max_log_weight = np.max(log_unnormalized_weights)
+        if not np.isfinite(max_log_weight):
+            # The weights are left as they are
+            warnings.warn('The observation has zero likelihood under all the particles')
+            self.log_likelihood = -np.inf
+            return obs_result
+        np.subtract(log_unnormalized_weights, max_log_weight, out=self._log_weights)
+        np.exp(self._log_weights, out=self._weights)
+        weight_sum = np.sum(self._weights)
+        self._weights /= weight_sum
+        self._log_weights -= np.log(weight_sum)
+        self.log_likelihood += max_log_weight + np.log(weight_sum)
+        self.effective_sample_size = 1. / np.sum(np.square(self._weights))
         
-        self._resampled_particles_uptodate = True
-        self._cached_resampled_mean = None
-        self._cached_resampled_var = None
-            
-class SmoothResamplingParticleFilter(ParticleFilter):
-    def _resample(self):
-        new_weights = np.empty((self._particle_count+1,))
-        new_weights[0] = .5*self._weights[0]
-        new_weights[self._particle_count] = .5*self._weights[self._particle_count-1]
-        for i in range(1, self._particle_count):
-            new_weights[i] = .5*(self._weights[i] + self._weights[i-1])
+        if self._resampling_threshold is None or self.effective_sample_size < self._resampling_threshold * self._particle_count:
+            self._resample()
+            self._resample_count += 1
+        return obs_result
 
-        uniforms = self._random_state.uniform(size=self._particle_count)
-        uniforms.sort()
-        new_uniforms = np.empty(shape=(self._particle_count,))
-        regions = np.empty(shape=(self._particle_count,), dtype=np.int)
-        s = 0
-        j = 0
-        for i in range(self._particle_count + 1):
-            s = s + new_weights[i]
-            while j < self._particle_count and uniforms[j] <= s:
-                regions[j] = i
-                new_uniforms[j] = (uniforms[j] - (s - new_weights[i])) / new_weights[i]
-                j += 1
-                
-        for i in range(self._particle_count):
-            if regions[i] == 0:
-                self._resampled_particles[i,:] = self._prior_particles[0,:]
-            if regions[i] == self._particle_count:
-                self._resampled_particles[i,:] = self._prior_particles[self._particle_count-1,:]
-            else:
-                self._resampled_particles[i,:] = (self._prior_particles[regions[i],:] - self._prior_particles[regions[i]-1,:]) * new_uniforms[i] + self._prior_particles[regions[i]-1,:]   
-            
-        self._state_distr = EmpiricalDistr(particles=self._resampled_particles)
+    def to_string_helper(self):
+        if self._to_string_helper_RaoBlackwellizedParticleFilter is None:
+            self._to_string_helper_RaoBlackwellizedParticleFilter = super().to_string_helper() \
+                    .set_type(self) \
+                    .add('particle_count', self._particle_count) \
+                    .add('state_dim', self._state_dim) \
+                    .add('linear_state_dim', self.linear_state_dim)
+        return self._to_string_helper_RaoBlackwellizedParticleFilter
 
-        self._resampled_particles_uptodate = True
-        self._cached_resampled_mean = None
-        self._cached_resampled_var = None
+    def __str__(self):
+        if self._str_RaoBlackwellizedParticleFilter is None: self._str_RaoBlackwellizedParticleFilter = self.to_string_helper().to_string()
+        return self._str_RaoBlackwellizedParticleFilter
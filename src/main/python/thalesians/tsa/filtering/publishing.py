@@ -0,0 +1,252 @@
+import datetime as dt
+
+import numpy as np
+
+import thalesians.tsa.checks as checks
+import thalesians.tsa.distrs as distrs
+from thalesians.tsa.distrs import NormalDistr as N
+import thalesians.tsa.filtering as filtering
+import thalesians.tsa.filtering.kalman as kalman
+import thalesians.tsa.numpyutils as npu
+import thalesians.tsa.objects as objects
+
+# Publishing of filters' states, observation results and true values. A FilterPublisher is passed to a filter as its
+# pype: it forwards to an underlying pype (such as a pypes.Pype) only those messages that its publishing policies let
+# through, optionally encoded as compact messages. Each policy applies to the messages of the given kinds
+# (FilterPypeOptions) only and lets the others through; the policies are applied in order, each to the messages let
+# through by the previous ones.
+#
+# A compact message is a float array with the kind (the value of the FilterPypeOptions member), the time, the
+# log-likelihood, a mean and the diagonal of a covariance: those of the state for a filter state, those of the
+# innovation (followed by the observation's mean) for an observation result, and the value for a true value. Unlike a
+# filter state or an observation result, which pickle as object graphs, it pickles into a single buffer; it carries no
+# names, so that a publisher should serve a single filter, whose observation results are treated as a single
+# observable's. The FilteringPlots in filtering.visual plot compact messages straight from their arrays
+
+def _kind(obj):
+    if isinstance(obj, filtering.FilterState):
+        return filtering.FilterPypeOptions.POSTERIOR_STATE if obj.is_posterior else filtering.FilterPypeOptions.PRIOR_STATE
+    if isinstance(obj, filtering.ObsResult): return filtering.FilterPypeOptions.OBS_RESULT
+    if isinstance(obj, filtering.TrueValue): return filtering.FilterPypeOptions.TRUE_VALUE
+    if is_compact_message(obj): return compact_message_kind(obj)
+    raise ValueError('Unable to publish a filter object: %s' % str(obj))
+
+def _time(obj):
+    if isinstance(obj, filtering.ObsResult): return obj.obs.time
+    if is_compact_message(obj): return compact_message_time(obj)
+    return obj.time
+
+def _mean(obj):
+    if isinstance(obj, filtering.FilterState): return npu.to_ndim_1(obj.state_distr.mean)
+    if isinstance(obj, filtering.ObsResult): return npu.to_ndim_1(obj.innov_distr.mean)
+    if isinstance(obj, filtering.TrueValue): return npu.to_ndim_1(np.asarray(obj.value, dtype=float))
+    return compact_message_mean(obj)
+
+class PublishingPolicy(object):
+    def __init__(self, kinds=None):
+        self._kinds = frozenset(filtering.FilterPypeOptions) if kinds is None else frozenset(kinds)
+
+    @property
+    def kinds(self):
+        return self._kinds
+
+    def publishes(self, kind, obj):
+        # Whether to publish obj, a message of the given kind; this is only called for the policy's kinds
+        raise NotImplementedError()
+
+class EveryNthPublishingPolicy(PublishingPolicy):
+    # Publishes the first of every n messages of each kind
+    def __init__(self, n, kinds=None):
+        super().__init__(kinds)
+        self._n = checks.check_int(n)
+        checks.check(n > 0, 'n must be positive')
+        self._counts = {}
+
+    @property
+    def n(self):
+        return self._n
+
+    def publishes(self, kind, obj):
+        count = self._counts.get(kind, 0)
+        self._counts[kind] = count + 1
+        return count % self._n == 0
+
+class TimeThrottledPublishingPolicy(PublishingPolicy):
+    # Publishes a message of each kind only if at least min_interval has elapsed since the last published one. The time
+    # is given by the clock, e.g. time.monotonic for the wall-clock time; by default it is the time of the message, i.e.
+    # the filter's time
+    def __init__(self, min_interval, clock=None, kinds=None):
+        super().__init__(kinds)
+        self._min_interval = min_interval
+        self._clock = clock
+        self._last_times = {}
+
+    @property
+    def min_interval(self):
+        return self._min_interval
+
+    def publishes(self, kind, obj):
+        time = _time(obj) if self._clock is None else self._clock()
+        last_time = self._last_times.get(kind)
+        if last_time is not None and time - last_time < self._min_interval: return False
+        self._last_times[kind] = time
+        return True
+
+class OnChangePublishingPolicy(PublishingPolicy):
+    # Publishes a message of each kind only if its mean (the state mean, the innovation or the true value) differs from
+    # that of the last published one by more than threshold in some component. By default this applies to the states
+    # only
+    def __init__(self, threshold, kinds=(filtering.FilterPypeOptions.PRIOR_STATE, filtering.FilterPypeOptions.POSTERIOR_STATE)):
+        super().__init__(kinds)
+        self._threshold = threshold
+        self._last_means = {}
+
+    @property
+    def threshold(self):
+        return self._threshold
+
+    def publishes(self, kind, obj):
+        mean = _mean(obj)
+        last_mean = self._last_means.get(kind)
+        if last_mean is not None and np.shape(last_mean) == np.shape(mean) and \
+                not np.any(np.abs(mean - last_mean) > self._threshold): return False
+        self._last_means[kind] = np.array(mean)
+        return True
+
+# The layout of a compact message's header
+_KIND, _TIME, _TIME_IS_DATETIME, _LOG_LIKELIHOOD, _DIM, _OBS_DIM, _HEADER_SIZE = range(7)
+
+def _compact_time(time):
+    # Datetimes as seconds since the epoch, which resolves microseconds
+    if isinstance(time, (dt.datetime, np.datetime64)): return np.datetime64(time, 'us').astype(np.int64) / 1e6, 1.
+    return float(time), 0.
+
+def _from_compact_time(time, is_datetime):
+    if is_datetime: return np.datetime64(int(round(time * 1e6)), 'us').item()
+    return time
+
+def to_compact_message(obj):
+    kind = _kind(obj)
+    if is_compact_message(obj): return obj
+    log_likelihood = np.nan
+    obs_mean = ()
+    if kind == filtering.FilterPypeOptions.OBS_RESULT:
+        time = obj.obs.time
+        mean = npu.to_ndim_1(obj.innov_distr.mean)
+        cov_diag = np.diagonal(obj.innov_distr.cov)
+        obs_mean = npu.to_ndim_1(obj.obs.distr.mean)
+        log_likelihood = npu.to_ndim_1(obj.log_likelihood)[0]
+    else:
+        time = obj.time
+        mean = _mean(obj)
+        cov_diag = np.nan if kind == filtering.FilterPypeOptions.TRUE_VALUE else np.diagonal(obj.state_distr.cov)
+    dim, obs_dim = len(mean), len(obs_mean)
+    message = np.empty(_HEADER_SIZE + 2 * dim + obs_dim)
+    message[_KIND] = kind.value
+    message[_TIME], message[_TIME_IS_DATETIME] = _compact_time(time)
+    message[_LOG_LIKELIHOOD] = log_likelihood
+    message[_DIM], message[_OBS_DIM] = dim, obs_dim
+    message[_HEADER_SIZE:_HEADER_SIZE+dim] = mean
+    message[_HEADER_SIZE+dim:_HEADER_SIZE+2*dim] = cov_diag
+    message[_HEADER_SIZE+2*dim:] = obs_mean
+    return message
+
+def is_compact_message(obj):
+    return isinstance(obj, np.ndarray) and obj.dtype == np.float64 and obj.ndim == 1 and len(obj) >= _HEADER_SIZE and \
+            len(obj) == _HEADER_SIZE + 2 * obj[_DIM] + obj[_OBS_DIM]
+
+# The fields of a compact message, read straight from the array; the mean, the covariance diagonal and the
+# observation's mean are views into it
+
+def compact_message_kind(message):
+    return filtering.FilterPypeOptions(int(message[_KIND]))
+
+def compact_message_time(message):
+    return _from_compact_time(message[_TIME], message[_TIME_IS_DATETIME])
+
+def compact_message_log_likelihood(message):
+    return message[_LOG_LIKELIHOOD]
+
+def compact_message_mean(message):
+    return message[_HEADER_SIZE:_HEADER_SIZE+int(message[_DIM])]
+
+def compact_message_cov_diag(message):
+    dim = int(message[_DIM])
+    return message[_HEADER_SIZE+dim:_HEADER_SIZE+2*dim]
+
+def compact_message_obs_mean(message):
+    return message[_HEADER_SIZE+2*int(message[_DIM]):]
+
+def from_compact_message(message):
+    # The filter state, observation result or true value encoded by the compact message. The covariances are diagonal,
+    # an observation result has no gain, and its predicted observation and observation are Dirac deltas at their means
+    kind = compact_message_kind(message)
+    time = compact_message_time(message)
+    mean = npu.col(*compact_message_mean(message))
+    cov = np.diag(compact_message_cov_diag(message))
+    if kind == filtering.FilterPypeOptions.TRUE_VALUE:
+        return filtering.TrueValue(None, time, mean)
+    if kind == filtering.FilterPypeOptions.OBS_RESULT:
+        obs_mean = npu.col(*compact_message_obs_mean(message))
+        obs = filtering.Obs(None, time, distrs.DiracDeltaDistr(obs_mean))
+        predicted_obs = filtering.PredictedObs(None, time, distrs.DiracDeltaDistr(obs_mean - mean), None)
+        innov_distr = N(mean=mean, cov=cov, copy=False)
+        return kalman.KalmanObsResult(True, obs, predicted_obs, innov_distr, npu.to_ndim_2(compact_message_log_likelihood(message)), None)
+    return kalman.KalmanFilterState(None, time, kind == filtering.FilterPypeOptions.POSTERIOR_STATE, N(mean=mean, cov=cov, copy=False))
+
+class FilterPublisher(objects.Named):
+    def __init__(self, pype, policies=None, compact=False, name=None):
+        super().__init__(name)
+        self._pype = pype
+        if policies is None: policies = ()
+        elif not checks.is_iterable(policies): policies = (policies,)
+        self._policies = tuple([checks.check_instance(p, PublishingPolicy) for p in policies])
+        self._compact = compact
+        self._sent_count = 0
+        self._dropped_count = 0
+        self._to_string_helper_FilterPublisher = None
+        self._str_FilterPublisher = None
+
+    @property
+    def pype(self):
+        return self._pype
+
+    @property
+    def policies(self):
+        return self._policies
+
+    @property
+    def compact(self):
+        return self._compact
+
+    @property
+    def sent_count(self):
+        return self._sent_count
+
+    @property
+    def dropped_count(self):
+        return self._dropped_count
+
+    def send(self, obj):
+        kind = _kind(obj)
+        for policy in self._policies:
+            if kind in policy.kinds and not policy.publishes(kind, obj):
+                self._dropped_count += 1
+                return None
+        self._sent_count += 1
+        return self._pype.send(to_compact_message(obj) if self._compact else obj)
+
+    def close(self):
+        self._pype.close()
+
+    def to_string_helper(self):
+        if self._to_string_helper_FilterPublisher is None:
+            self._to_string_helper_FilterPublisher = super().to_string_helper() \
+                    .set_type(self) \
+                    .add('pype', self._pype) \
+                    .add('compact', self._compact)
+        return self._to_string_helper_FilterPublisher
+
+    def __str__(self):
+        if self._str_FilterPublisher is None: self._str_FilterPublisher = self.to_string_helper().to_string()
+        return self._str_FilterPublisher
@@ -0,0 +1,165 @@
+import collections
+
+import numpy as np
+from scipy.linalg import block_diag
+
+import thalesians.tsa.checks as checks
+from thalesians.tsa.distrs import NormalDistr as N
+import thalesians.tsa.filtering as filtering
+import thalesians.tsa.filtering.kalman as kalman
+import thalesians.tsa.numpyutils as npu
+from thalesians.tsa.strings import ToStringHelper
+
+def _transition_matrix(processes, time0, time):
+    return block_diag(*[p.transition_matrix(time0, time) for p in processes])
+
+def _transition_matrices(processes, times):
+    # The transition matrices between consecutive times; the processes are time-homogeneous, so regularly spaced times
+    # need a single matrix
+    state_dim = sum([p.process_dim for p in processes])
+    transitions = np.empty((max(len(times) - 1, 0), state_dim, state_dim))
+    cache = {}
+    for k in range(1, len(times)):
+        time_delta = times[k] - times[k-1]
+        transition = cache.get(time_delta)
+        if transition is None:
+            transition = _transition_matrix(processes, times[k-1], times[k])
+            cache[time_delta] = transition
+        transitions[k-1] = transition
+    return transitions
+
+def _rts_backward(posterior_state_means, posterior_state_covs, prior_state_means, prior_state_covs, transitions):
+    # The Rauch-Tung-Striebel recursion over stacked moments: posterior_state_*[k] are the filtered moments at step k,
+    # prior_state_*[k] the predicted moments at step k given the data up to step k - 1 and transitions[k - 1] the
+    # transition matrix from step k - 1 to step k. The smoother gains G_k = P_{k|k} F_{k+1}^T P_{k+1|k}^{-1} do not
+    # depend on the smoothed moments and are computed for all the steps at once
+    gains = np.swapaxes(np.linalg.solve(prior_state_covs[1:], np.matmul(transitions, posterior_state_covs[:-1])), 1, 2)
+    smoothed_state_means = np.array(posterior_state_means, dtype=float)
+    smoothed_state_covs = np.array(posterior_state_covs, dtype=float)
+    for k in range(len(smoothed_state_means) - 2, -1, -1):
+        gain = gains[k]
+        smoothed_state_means[k] += np.dot(gain, smoothed_state_means[k+1] - prior_state_means[k+1])
+        smoothed_state_covs[k] += np.dot(np.dot(gain, smoothed_state_covs[k+1] - prior_state_covs[k+1]), gain.T)
+    return smoothed_state_means, smoothed_state_covs, gains
+
+class SmoothingResult(object):
+    def __init__(self, times, state_means, state_covs, gains):
+        self._times = times
+        self._state_means = state_means
+        self._state_covs = state_covs
+        self._gains = gains
+        self._to_string_helper_SmoothingResult = None
+        self._str_SmoothingResult = None
+
+    @property
+    def times(self):
+        return self._times
+
+    @property
+    def state_means(self):
+        return self._state_means
+
+    @property
+    def state_covs(self):
+        return self._state_covs
+
+    @property
+    def gains(self):
+        return self._gains
+
+    def state_distr(self, idx):
+        return N(mean=npu.col(*self._state_means[idx]), cov=self._state_covs[idx])
+
+    def to_string_helper(self):
+        if self._to_string_helper_SmoothingResult is None:
+            self._to_string_helper_SmoothingResult = ToStringHelper(self) \
+                    .add('times', self._times) \
+                    .add('state_means', self._state_means)
+        return self._to_string_helper_SmoothingResult
+
+    def __str__(self):
+        if self._str_SmoothingResult is None: self._str_SmoothingResult = self.to_string_helper().to_string()
+        return self._str_SmoothingResult
+
+    def __repr__(self):
+        return str(self)
+
+def rts_smooth(kalman_filter, run_result):
+    # Smooths the states of a filtering.run of the given Kalman filter, using the prior and posterior moments that the
+    # run recorded (return_df=True). The first row is that of the initial state
+    checks.check_instance(kalman_filter, kalman.KalmanFilter)
+    arrays = run_result.arrays
+    checks.check(arrays is not None, 'The run result does not contain the state moments; run the filter with return_df=True')
+    checks.check(arrays['posterior_state_mean'].dtype == float, 'The recorded state moments are not numeric')
+    times = arrays['time']
+    transitions = _transition_matrices(kalman_filter._processes, times)
+    state_means, state_covs, gains = _rts_backward(
+            arrays['posterior_state_mean'], arrays['posterior_state_cov'],
+            arrays['prior_state_mean'], arrays['prior_state_cov'], transitions)
+    return SmoothingResult(times, state_means, state_covs, gains)
+
+class FixedLagSmoother(object):
+    # Observes through a Kalman filter and, once lag + 1 observations have been made, emits the state at the time of
+    # the observation lag steps back smoothed on all the observations so far. Only the moments of the last lag + 1 steps
+    # are kept
+    def __init__(self, kalman_filter, lag):
+        self._filter = checks.check_instance(kalman_filter, kalman.KalmanFilter)
+        self._lag = checks.check_int(lag)
+        checks.check(lag >= 0, 'The lag must be non-negative')
+        # Each entry holds the time, the transition from the previous entry, and the prior and posterior moments
+        self._window = collections.deque(maxlen=lag + 1)
+        self._last_obs_result = None
+        self._to_string_helper_FixedLagSmoother = None
+        self._str_FixedLagSmoother = None
+
+    @property
+    def filter(self):
+        return self._filter
+
+    @property
+    def lag(self):
+        return self._lag
+
+    @property
+    def last_obs_result(self):
+        return self._last_obs_result
+
+    def observe(self, observable, obs, time=None, true_value=None):
+        checks.check(observable.filter is self._filter, 'The observable does not belong to the smoother\'s filter')
+        time, _ = filtering._time_and_obs_distr(obs, time, self._filter.time)
+        previous_time = self._window[-1][0] if len(self._window) > 0 else None
+        predicted_obs = observable.predict(time=time, true_value=true_value)
+        prior_state_distr = self._filter.state.state_distr
+        self._last_obs_result = observable.observe(obs=obs, time=time, true_value=true_value, predicted_obs=predicted_obs)
+        posterior_state_distr = self._filter.state.state_distr
+        transition = None if previous_time is None else _transition_matrix(self._filter._processes, previous_time, time)
+        self._window.append((time, transition,
+                             npu.to_ndim_1(prior_state_distr.mean), prior_state_distr.cov,
+                             npu.to_ndim_1(posterior_state_distr.mean), posterior_state_distr.cov))
+        if len(self._window) < self._lag + 1: return None
+        return self.flush()[0]
+
+    def flush(self):
+        # The states at the times of the observations in the window, smoothed on all the observations so far
+        if len(self._window) == 0: return []
+        times, transitions, prior_state_means, prior_state_covs, posterior_state_means, posterior_state_covs = zip(*self._window)
+        state_dim = len(posterior_state_means[0])
+        state_means, state_covs, _ = _rts_backward(
+                np.array(posterior_state_means), np.array(posterior_state_covs),
+                np.array(prior_state_means), np.array(prior_state_covs),
+                np.reshape(np.array(transitions[1:]), (len(times) - 1, state_dim, state_dim)))
+        return [(t, N(mean=npu.col(*m), cov=c, copy=False)) for t, m, c in zip(times, state_means, state_covs)]
+
+    def to_string_helper(self):
+        if self._to_string_helper_FixedLagSmoother is None:
+            self._to_string_helper_FixedLagSmoother = ToStringHelper(self) \
+                    .add('filter', self._filter) \
+                    .add('lag', self._lag)
+        return self._to_string_helper_FixedLagSmoother
+
+    def __str__(self):
+        if self._str_FixedLagSmoother is None: self._str_FixedLagSmoother = self.to_string_helper().to_string()
+        return self._str_FixedLagSmoother
+
+    def __repr__(self):
+        return str(self)
@@ -0,0 +1,112 @@
+import numpy as np
+from scipy.linalg import block_diag
+
+import thalesians.tsa.checks as checks
+from thalesians.tsa.distrs import NormalDistr as N
+import thalesians.tsa.filtering as filtering
+import thalesians.tsa.filtering.kalman as kalman
+import thalesians.tsa.numpyutils as npu
+import thalesians.tsa.processes as proc
+
+def _sqrt(cov):
+    # A square root S of the covariance, S S^T = cov, which may be singular
+    try:
+        return np.linalg.cholesky(cov)
+    except np.linalg.LinAlgError:
+        eigenvalues, eigenvectors = np.linalg.eigh(cov)
+        return eigenvectors * np.sqrt(np.maximum(eigenvalues, 0.))
+
+class UnscentedKalmanFilter(kalman.KalmanFilter):
+    # A Kalman filter for nonlinear processes and observation models (such as kalman.NonlinearObsModel) that propagates
+    # the 2 n + 1 sigma points of the unscented transform with the scaling parameters alpha, beta and kappa. In the
+    # prediction the state is augmented with the processes' noises, so that the noise need not be additive, and all
+    # the sigma points are propagated through each process in a single call if its propagate is vectorized (see
+    # npu.vectorized); likewise for the observation function
+    def __init__(self, time, state_distr, process, alpha=1., beta=2., kappa=0.,
+                 update_method=kalman.KalmanFilterUpdateMethod.CHOLESKY,
+                 name=None, pype=None, pype_options=frozenset(filtering.FilterPypeOptions)):
+        if not checks.is_iterable(process): process = (process,)
+        process = tuple(checks.check_iterable_over_instances(process, proc.SolvedItoProcess))
+        super().__init__(time, state_distr, process, update_method=update_method, name=name, pype=pype, pype_options=pype_options)
+        self._alpha = alpha
+        self._beta = beta
+        self._kappa = kappa
+        # The columns of the processes' variates in the augmented state, following the state
+        self._noise_slices = []
+        col = self._state_distr.dim
+        for p in self._processes:
+            self._noise_slices.append(slice(col, col + p.noise_dim))
+            col += p.noise_dim
+        self._to_string_helper_UnscentedKalmanFilter = None
+        self._str_UnscentedKalmanFilter = None
+
+    @property
+    def alpha(self):
+        return self._alpha
+
+    @property
+    def beta(self):
+        return self._beta
+
+    @property
+    def kappa(self):
+        return self._kappa
+
+    def _sigma_points(self, mean, vol):
+        # The sigma points (rows) and the weights of the mean and of the covariance
+        dim = len(mean)
+        lambda_ = self._alpha * self._alpha * (dim + self._kappa) - dim
+        offsets = np.sqrt(dim + lambda_) * vol.T
+        points = np.vstack((mean, mean + offsets, mean - offsets))
+        mean_weights = np.full((2 * dim + 1,), .5 / (dim + lambda_))
+        mean_weights[0] = lambda_ / (dim + lambda_)
+        cov_weights = np.array(mean_weights)
+        cov_weights[0] += 1. - self._alpha * self._alpha + self._beta
+        return points, mean_weights, cov_weights
+
+    def predict(self, time, true_value=None):
+        if time < self._time:
+            raise ValueError('Predicting the past (current time=%s, prediction time=%s)' % (self._time, time))
+        if true_value is not None and filtering.FilterPypeOptions.TRUE_VALUE in self._pype_options:
+            self._pype.send(filtering.TrueValue(self, self._time, true_value))
+        if time == self._time: return
+        self._time_delta = time - self._time
+        state_dim = self._state_distr.dim
+        noise_dim = self._noise_slices[-1].stop - state_dim
+        points, mean_weights, cov_weights = self._sigma_points(
+                np.concatenate((npu.to_ndim_1(self._state_distr.mean), np.zeros(noise_dim))),
+                block_diag(_sqrt(self._state_distr.cov), np.eye(noise_dim)))
+        propagated_points = np.empty((len(points), state_dim))
+        for p, s, ns in zip(self._processes, self._process_slices, self._noise_slices):
+            propagated_points[:, s] = kalman._propagate_rows(p, self._time, points[:, s], time, points[:, ns])
+        state_mean = np.dot(mean_weights, propagated_points)
+        deviations = propagated_points - state_mean
+        state_cov = np.dot(deviations.T * cov_weights, deviations)
+        self._state_distr = N(mean=npu.col(*state_mean), cov=.5 * (state_cov + state_cov.T), copy=False)
+        self._is_posterior = False
+        self._time = time
+        if filtering.FilterPypeOptions.PRIOR_STATE in self._pype_options: self._pype.send(self.state)
+
+    def _predict_obs(self, obs_model, time, state_distr, observable):
+        if not isinstance(obs_model, kalman.NonlinearObsModel): return super()._predict_obs(obs_model, time, state_distr, observable)
+        state_mean = npu.to_ndim_1(state_distr.mean)
+        points, mean_weights, cov_weights = self._sigma_points(state_mean, _sqrt(state_distr.cov))
+        obs_points = kalman._apply_to_rows(obs_model.obs_function, points)
+        obs_mean = np.dot(mean_weights, obs_points)
+        obs_deviations = (obs_points - obs_mean).T * cov_weights
+        obs_cov = np.dot(obs_deviations, obs_points - obs_mean)
+        cross_cov = np.dot(obs_deviations, points - state_mean)
+        return filtering.PredictedObs(observable, time, N(mean=npu.col(*obs_mean), cov=.5 * (obs_cov + obs_cov.T), copy=False), cross_cov)
+
+    def to_string_helper(self):
+        if self._to_string_helper_UnscentedKalmanFilter is None:
+            self._to_string_helper_UnscentedKalmanFilter = super().to_string_helper() \
+                    .set_type(self) \
+                    .add('alpha', self._alpha) \
+                    .add('beta', self._beta) \
+                    .add('kappa', self._kappa)
+        return self._to_string_helper_UnscentedKalmanFilter
+
+    def __str__(self):
+        if self._str_UnscentedKalmanFilter is None: self._str_UnscentedKalmanFilter = self.to_string_helper().to_string()
+        return self._str_UnscentedKalmanFilter
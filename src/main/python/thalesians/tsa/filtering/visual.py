@@ -4,6 +4,8 @@ import thalesians.tsa.checks as checks
 from thalesians.tsa.distrs import NormalDistr as N
 import thalesians.tsa.filtering as filtering
 import thalesians.tsa.filtering.kalman as kalman
+import thalesians.tsa.filtering.publishing as publishing
+import thalesians.tsa.numpyutils as npu
 import thalesians.tsa.stats as stats
 import thalesians.tsa.visual
 
@@ -11,6 +13,79 @@ _default_state_colours = ['#95c3e8', '#89b4d6', '#769ab8', '#3e5161', '#242f38',
 _default_true_value_colours = ['#60617f', '#8f91bf', '#bfc2ff', '#303040', '#acaee5', '#405173', '#8a9cbf', '#a9b9d9', '#402924', '#8c6c6c']
 _default_obs_colours = ['#900c3f', '#c70039', '#ff5733', '#907163', '#379683', '#5d001e', '#e3e2df', '#e3afbc', '#9a1750', '#ee4c7c']
 
+# The views below give the plots the values that they need from a filter state, a true value or an observation result,
+# reading them either from the object or straight from the array of a compact message (see filtering.publishing), which
+# is not decoded. The covariances are read only if a plot needs them
+
+class _FilterStateView(object):
+    def __init__(self, obj):
+        self._obj = obj
+        self._compact = publishing.is_compact_message(obj)
+
+    @property
+    def time(self):
+        return publishing.compact_message_time(self._obj) if self._compact else self._obj.time
+
+    @property
+    def mean(self):
+        return publishing.compact_message_mean(self._obj) if self._compact else npu.to_ndim_1(self._obj.state_distr.mean)
+
+    @property
+    def cov_diag(self):
+        return publishing.compact_message_cov_diag(self._obj) if self._compact else np.diagonal(self._obj.state_distr.cov)
+
+class _TrueValueView(object):
+    def __init__(self, obj):
+        self._obj = obj
+        self._compact = publishing.is_compact_message(obj)
+
+    @property
+    def time(self):
+        return publishing.compact_message_time(self._obj) if self._compact else self._obj.time
+
+    @property
+    def value(self):
+        return publishing.compact_message_mean(self._obj) if self._compact else npu.to_ndim_1(self._obj.value)
+
+class _ObsResultView(object):
+    # A compact message's observation result has no observable name and no gain
+    def __init__(self, obj):
+        self._obj = obj
+        self._compact = publishing.is_compact_message(obj)
+
+    @property
+    def time(self):
+        return publishing.compact_message_time(self._obj) if self._compact else self._obj.obs.time
+
+    @property
+    def observable_name(self):
+        return None if self._compact else self._obj.obs.observable_name
+
+    @property
+    def obs_mean(self):
+        return publishing.compact_message_obs_mean(self._obj) if self._compact else npu.to_ndim_1(self._obj.obs.distr.mean)
+
+    @property
+    def predicted_obs_mean(self):
+        if self._compact: return self.obs_mean - self.innov_mean
+        return npu.to_ndim_1(self._obj.predicted_obs.distr.mean)
+
+    @property
+    def innov_mean(self):
+        return publishing.compact_message_mean(self._obj) if self._compact else npu.to_ndim_1(self._obj.innov_distr.mean)
+
+    @property
+    def innov_cov_diag(self):
+        return publishing.compact_message_cov_diag(self._obj) if self._compact else np.diagonal(self._obj.innov_distr.cov)
+
+    @property
+    def log_likelihood(self):
+        return publishing.compact_message_log_likelihood(self._obj) if self._compact else self._obj.log_likelihood
+
+    @property
+    def gain(self):
+        return None if self._compact else getattr(self._obj, 'gain', None)
+
 class FilteringPlot(thalesians.tsa.visual.LivePlot):
     def __init__(self, fig, ax, auto_refresh, title, filter_name,
                  process_prior_filter_states, process_posterior_filter_states, process_true_values, process_obs_results,
@@ -116,12 +191,12 @@ class FilteringPlot(thalesians.tsa.visual.LivePlot):
     def _init_state_and_true_value_plots_for_state_index(self, plot_offset, state_index, state_label, state_colour, true_value_colour):
         raise NotImplementedError
 
-    def _init_obs_plots_info(self, obs):
-        if not obs.observable_name in self._actual_observable_names:
-            for i in range(np.size(obs.distr.mean)):
-                self._actual_observable_names.append(obs.observable_name)
+    def _init_obs_plots_info(self, obs_result):
+        if not obs_result.observable_name in self._actual_observable_names:
+            for i in range(np.size(obs_result.obs_mean)):
+                self._actual_observable_names.append(obs_result.observable_name)
                 self._actual_obs_indices.append(i)
-                self._actual_obs_labels.append('%s %d' % (obs.observable_name, i))
+                self._actual_obs_labels.append('%s %d' % ('obs' if obs_result.observable_name is None else obs_result.observable_name, i))
         
     def _init_obs_plots(self):
         for plot_offset in range(self._inited_obs_index_count, len(self._actual_observable_names)):
@@ -135,7 +210,7 @@ class FilteringPlot(thalesians.tsa.visual.LivePlot):
     
     def _process_filter_state(self, filter_state):
         if not self._state_and_true_value_plots_inited:
-            self._init_state_and_true_value_plots_info(filter_state.state_distr.mean)
+            self._init_state_and_true_value_plots_info(filter_state.mean)
             self._init_state_and_true_value_plots()
             
         for plot_offset, state_index in enumerate(self._state_indices):
@@ -160,33 +235,48 @@ class FilteringPlot(thalesians.tsa.visual.LivePlot):
         raise NotImplementedError
 
     def _process_obs_result(self, obs_result):
-        obs = obs_result.obs        
-
         if not self._obs_plots_inited:
-            self._init_obs_plots_info(obs)
+            self._init_obs_plots_info(obs_result)
             self._init_obs_plots()
             
         for plot_offset, (observable_name, obs_index) in enumerate(zip(self._actual_observable_names, self._actual_obs_indices)):
-            if obs.observable_name == observable_name:
+            if obs_result.observable_name == observable_name:
                 self._process_obs_result_for_obs_index(obs_result, plot_offset, observable_name, obs_index)
                 
         if self._auto_refresh: self.refresh()
         
     def _process_obs_result_for_obs_index(self, obs_result, plot_offset, observable_name, obs_index):
-        obs = obs_result.obs        
-        self.append(obs.time, obs.distr.mean[obs_index], self._obs_plot_indices[plot_offset], refresh=False)
-        
+        self.append(obs_result.time, obs_result.obs_mean[obs_index], self._obs_plot_indices[plot_offset], refresh=False)
+        
+    def _process_compact_message(self, message):
+        # Compact messages carry no names, so they cannot be selected by the filter's or the observables' names
+        if self._filter_name is not None:
+            raise ValueError('Unable to select a compact message by filter name, as it carries none')
+        kind = publishing.compact_message_kind(message)
+        if kind == filtering.FilterPypeOptions.PRIOR_STATE and self._process_prior_filter_states:
+            self._process_filter_state(_FilterStateView(message))
+        elif kind == filtering.FilterPypeOptions.POSTERIOR_STATE and self._process_posterior_filter_states:
+            self._process_filter_state(_FilterStateView(message))
+        elif kind == filtering.FilterPypeOptions.TRUE_VALUE and self._process_true_values:
+            self._process_true_value(_TrueValueView(message))
+        elif kind == filtering.FilterPypeOptions.OBS_RESULT and self._process_obs_results:
+            if self._observable_names:
+                raise ValueError('Unable to select a compact message by observable name, as it carries none')
+            self._process_obs_result(_ObsResultView(message))
+
     def process_filter_object(self, obj, raise_value_error=False):
-        if self._filter_name is None or self._filter_name == obj.filter_name:
+        if publishing.is_compact_message(obj):
+            self._process_compact_message(obj)
+        elif self._filter_name is None or self._filter_name == obj.filter_name:
             if isinstance(obj, filtering.FilterState):
                 if self._process_prior_filter_states and (not obj.is_posterior):
-                    self._process_filter_state(obj)
+                    self._process_filter_state(_FilterStateView(obj))
                 elif self._process_posterior_filter_states and obj.is_posterior:
-                    self._process_filter_state(obj)
+                    self._process_filter_state(_FilterStateView(obj))
             elif isinstance(obj, filtering.TrueValue) and self._process_true_values:
-                self._process_true_value(obj)
+                self._process_true_value(_TrueValueView(obj))
             elif isinstance(obj, filtering.ObsResult) and self._process_obs_results:
-                self._process_obs_result(obj)
+                self._process_obs_result(_ObsResultView(obj))
             elif raise_value_error: raise ValueError('Unable to process a filter object: %s' % str(obj))
 
     def process_run_df(self, df):
@@ -278,8 +368,8 @@ class StatePlot(FilteringPlot):
         self.ax.plot([], [], color=obs_colour, marker='x', linestyle='None', label=obs_label)
     
     def _process_filter_state_for_state_index(self, filter_state, plot_offset, state_index):
-        mean = filter_state.state_distr.mean[state_index]
-        sd = np.sqrt(filter_state.state_distr.cov[state_index, state_index])
+        mean = filter_state.mean[state_index]
+        sd = np.sqrt(filter_state.cov_diag[state_index])
         self.append(filter_state.time, mean, self._state_mean_plot_indices[plot_offset], refresh=False)
         self.append(filter_state.time, mean - sd, self._state_mean_minus_sd_plot_indices[plot_offset], refresh=False)
         self.append(filter_state.time, mean + sd, self._state_mean_plus_sd_plot_indices[plot_offset], refresh=False)
@@ -288,8 +378,7 @@ class StatePlot(FilteringPlot):
         self.append(true_value.time, true_value.value[state_index], self._true_value_plot_indices[plot_offset], refresh=False)
 
     def _process_obs_result_for_obs_index(self, obs_result, plot_offset, observable_name, obs_index):
-        obs = obs_result.obs
-        self.append(obs.time, obs.distr.mean[obs_index], self._obs_plot_indices[plot_offset], refresh=False)
+        self.append(obs_result.time, obs_result.obs_mean[obs_index], self._obs_plot_indices[plot_offset], refresh=False)
         
 class ErrorPlot(FilteringPlot):
     def __init__(self, fig=None, ax=None, auto_refresh=True,
@@ -335,7 +424,7 @@ class ErrorPlot(FilteringPlot):
             if self._last_true_value is not true_value: self._last_true_value = true_value
 
     def _process_error_for_state_index(self, true_value, filter_state, plot_offset, state_index):
-        error = true_value.value[state_index] - filter_state.state_distr.mean[state_index]
+        error = true_value.value[state_index] - filter_state.mean[state_index]
         if self._rms_calculator is not None:
             self._rms_calculator.add(error)
             error = self._rms_calculator.rms
@@ -378,11 +467,9 @@ class ObsPlot(FilteringPlot):
     
     def _process_obs_result_for_obs_index(self, obs_result, plot_offset, observable_name, obs_index):
         if self._plot_actual:
-            obs = obs_result.obs
-            self.append(obs.time, obs.distr.mean[obs_index], self._obs_plot_indices[plot_offset], refresh=False)
+            self.append(obs_result.time, obs_result.obs_mean[obs_index], self._obs_plot_indices[plot_offset], refresh=False)
         if self._plot_predicted:
-            predicted_obs = obs_result.predicted_obs
-            self.append(predicted_obs.time, predicted_obs.distr.mean[obs_index], self._predicted_obs_plot_indices[plot_offset], refresh=False)
+            self.append(obs_result.time, obs_result.predicted_obs_mean[obs_index], self._predicted_obs_plot_indices[plot_offset], refresh=False)
         
 class InnovPlot(FilteringPlot):
     def __init__(self, fig=None, ax=None, auto_refresh=True,
@@ -417,12 +504,12 @@ class InnovPlot(FilteringPlot):
         self.ax.plot([], [], color=obs_colour, linestyle='dashed')
     
     def _process_obs_result_for_obs_index(self, obs_result, plot_offset, observable_name, obs_index):
-        sd = np.sqrt(obs_result.innov_distr.cov[obs_index, obs_index])
-        innov = obs_result.innov_distr.mean[obs_index]
+        sd = np.sqrt(obs_result.innov_cov_diag[obs_index])
+        innov = obs_result.innov_mean[obs_index]
         if self._standardize: innov /= sd
-        self.append(obs_result.obs.time, innov, self._innov_plot_indices[plot_offset], refresh=False)
-        self.append(obs_result.obs.time, -sd, self._minus_sd_plot_indices[plot_offset], refresh=False)
-        self.append(obs_result.obs.time, sd, self._plus_sd_plot_indices[plot_offset], refresh=False)
+        self.append(obs_result.time, innov, self._innov_plot_indices[plot_offset], refresh=False)
+        self.append(obs_result.time, -sd, self._minus_sd_plot_indices[plot_offset], refresh=False)
+        self.append(obs_result.time, sd, self._plus_sd_plot_indices[plot_offset], refresh=False)
         
 class CUSUMPlot(FilteringPlot):
     def __init__(self, fig=None, ax=None, auto_refresh=True,
@@ -449,11 +536,11 @@ class CUSUMPlot(FilteringPlot):
         self.ax.plot([], [], color=obs_colour, linestyle='solid', label=obs_label)
     
     def _process_obs_result_for_obs_index(self, obs_result, plot_offset, observable_name, obs_index):
-        sd = np.sqrt(obs_result.innov_distr.cov[obs_index, obs_index])
-        innov = obs_result.innov_distr.mean[obs_index]
+        sd = np.sqrt(obs_result.innov_cov_diag[obs_index])
+        innov = obs_result.innov_mean[obs_index]
         standardized_innov = innov / sd
         self._cusums[plot_offset] += standardized_innov
-        self.append(obs_result.obs.time, self._cusums[plot_offset], self._cusum_plot_indices[plot_offset], refresh=False)
+        self.append(obs_result.time, self._cusums[plot_offset], self._cusum_plot_indices[plot_offset], refresh=False)
         
 class LogLikelihoodPlot(FilteringPlot):
     def __init__(self, fig=None, ax=None, auto_refresh=True,
@@ -496,7 +583,7 @@ class LogLikelihoodPlot(FilteringPlot):
                     self._log_likelihood += obs_result.log_likelihood
             else:
                 self._log_likelihood = obs_result.log_likelihood
-            self.append(obs_result.obs.time, self._log_likelihood, self._plot_index, refresh=False)
+            self.append(obs_result.time, self._log_likelihood, self._plot_index, refresh=False)
             self._last_obs_result = obs_result
         
 class GainPlot(FilteringPlot):
@@ -554,15 +641,15 @@ class GainPlot(FilteringPlot):
 
     def _process_obs_result_for_obs_index(self, obs_result, plot_offset, observable_name, obs_index):
         if self._last_obs_result is not obs_result:
-            if hasattr(obs_result, 'gain') and obs_result.gain is not None:
+            if obs_result.gain is not None:
                 if not self._matrix_norm:
                     obs_plot_index = self._obs_plot_indices[plot_offset]
                     for spp in self._state_plot_properties:
-                        self.append(obs_result.obs.time, obs_result.gain[spp['state_index'], obs_index], obs_plot_index, refresh=False)
+                        self.append(obs_result.time, obs_result.gain[spp['state_index'], obs_index], obs_plot_index, refresh=False)
                         obs_plot_index += 1
                 else:
                     gain = np.linalg.norm(obs_result.gain)
-                    self.append(obs_result.obs.time, gain, self._plot_index, refresh=False)
+                    self.append(obs_result.time, gain, self._plot_index, refresh=False)
                 self._last_obs_result = obs_result
         
 class InnovationQQPlot(thalesians.tsa.visual.LivePlot):
@@ -1,17 +1,33 @@
 import numpy as np
+import scipy.special as special
 import statsmodels.api as sm
 
-def problessthan(sample, bw, value, count, random_state):
-    sample = sample.flatten()
-    idxs = random_state.randint(0, len(sample), size=count)
-    epsilons = random_state.normal(size=count)
-    lessthanflags = sample[idxs] + bw * epsilons < value
-    return float(np.sum(lessthanflags))/float(count)
+import thalesians.tsa.numpyutils as npu
 
-def isoutlier(sample, bw, value, threshold, count, random_state):
-    plt = problessthan(sample, bw, value, count, random_state)
+def _binned(sample, weights, bin_count):
+    # The centres of bin_count equal bins spanning the sample and the total weights of the sample points in them
+    weights, edges = np.histogram(sample, bins=bin_count, weights=weights)
+    return .5 * (edges[:-1] + edges[1:]), weights
+
+def problessthan(sample, bw, value, *, weights=None, bin_count=None):
+    # The probability that a draw from the Gaussian kernel density estimate of the (weighted) sample with the bandwidth
+    # bw is less than value, i.e. the weighted mean of norm.cdf((value - sample) / bw). The value may be an array of
+    # values, for which the probabilities are computed at once. If bin_count is given, the sample is first binned into
+    # bin_count equal bins, which bounds the cost for large samples at the expense of an error of the order of the bin
+    # width divided by bw. The weights and bin_count are keyword-only, as these positions used to take the count and the
+    # random_state of the Monte Carlo estimate that this replaces
+    sample = npu.to_ndim_1(sample)
+    if bin_count is not None: sample, weights = _binned(sample, weights, bin_count)
+    if weights is None: weights = np.full(len(sample), 1. / len(sample))
+    else: weights = npu.to_ndim_1(weights) / np.sum(weights)
+    values = np.asarray(value, dtype=float)
+    probs = np.dot(special.ndtr((values.reshape(-1, 1) - sample) / bw), weights)
+    return probs.reshape(np.shape(values)) if np.ndim(values) > 0 else probs[0]
+
+def isoutlier(sample, bw, value, threshold, *, weights=None, bin_count=None):
+    plt = problessthan(sample, bw, value, weights=weights, bin_count=bin_count)
     pgt = 1. - plt
-    return plt <= threshold or pgt <= threshold
+    return np.logical_or(plt <= threshold, pgt <= threshold)
 
 if __name__ == '__main__':
     random_state = np.random.RandomState(seed=42)
@@ -20,4 +36,4 @@ if __name__ == '__main__':
     kde = sm.nonparametric.KDEUnivariate(np.random.normal(size=nobs))
     kde.fit()
     value=1.
-    print(isoutlier(sample, kde.bw, value, threshold=.1, count=10000, random_state=random_state))
+    print(isoutlier(sample, kde.bw, value, threshold=.1))
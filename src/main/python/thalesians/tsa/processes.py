@@ -1,4 +1,6 @@
+import collections
 import datetime as dt
+import math
 
 import numpy as np
 import scipy.linalg as la
@@ -96,7 +98,16 @@ class SolvedItoProcess(ItoProcess):
         if self._str_SolvedItoProcess is None: self._str_SolvedItoProcess = self.to_string_helper().to_string()
         return self._str_SolvedItoProcess
 
+def _quantized_time_delta(time_delta):
+    # Time deltas that agree to 40 bits of the mantissa (about 12 significant digits) share a key, so that nominally
+    # equal time deltas computed from different times are treated as equal
+    mantissa, exponent = math.frexp(time_delta)
+    return int(round(mantissa * 2**40)), exponent
+
 class MarkovProcess(Process):
+    # The number of (quantized) time deltas for which the transition matrices, offsets and noise covariances are kept
+    TRANSITION_CACHE_SIZE = 256
+    
     def __init__(self, process_dim, time_unit=dt.timedelta(days=1), **kwargs):
         self._process_dim = checks.check_int(process_dim)
         self._time_unit = time_unit
@@ -106,20 +117,28 @@ class MarkovProcess(Process):
         self._cached_distr0 = None
         self._cached_distr = None
         
+        # A least recently used cache of the transition matrices, offsets and noise covariances by quantized time delta
+        self._transition_cache = collections.OrderedDict()
+        
         self._to_string_helper_MarkovProcess = None
         self._str_MarkovProcess = None
         
         super(MarkovProcess, self).__init__(process_dim=process_dim, **kwargs)
         
+    def _time_delta(self, time0, time):
+        time_delta = time - time0
+        if isinstance(time_delta, np.timedelta64):
+            time_delta = time_delta.item()
+        if isinstance(time_delta, dt.timedelta):
+            time_delta = time_delta.total_seconds() / self._time_unit.total_seconds()
+        return time_delta
+        
     def propagate_distr(self, time0, distr0, time, assume_distr=False):
         if time == time0: return distr0
-        if self._cached_time is None or self._cached_time != time or self._cached_time0 != time0 or self._cached_distr0 != distr0:
-            time_delta = time - time0
-            if isinstance(time_delta, np.timedelta64):
-                time_delta = time_delta.item()
-            if isinstance(time_delta, dt.timedelta):
-                time_delta = time_delta.total_seconds() / self._time_unit.total_seconds()
-            self._cached_distr = self._propagate_distr_impl(distr0, time_delta, assume_distr)
+        # The distributions are compared by identity: comparing their means and covariances costs about as much as
+        # propagating them
+        if self._cached_time is None or self._cached_time != time or self._cached_time0 != time0 or self._cached_distr0 is not distr0:
+            self._cached_distr = self._propagate_distr_impl(distr0, self._time_delta(time0, time), assume_distr)
             self._cached_time = time
             self._cached_time0 = time0
             self._cached_distr0 = distr0
@@ -128,6 +147,41 @@ class MarkovProcess(Process):
     def _propagate_distr_impl(self, distr0, time_delta, assume_distr=False):
         raise NotImplementedError()
     
+    # For processes whose value at time given the value x0 at time0 is Normal with mean F x0 + c and covariance Q, the
+    # transition matrix F, the transition offset c and the noise covariance Q
+    
+    def _cached(self, name, impl, time_delta):
+        key = (name, _quantized_time_delta(time_delta))
+        value = self._transition_cache.get(key)
+        if value is None:
+            value = npu.immutable_copy_of(npu.to_ndim_2(impl(time_delta), ndim_1_to_col=True, copy=False))
+            self._transition_cache[key] = value
+            if len(self._transition_cache) > self.TRANSITION_CACHE_SIZE: self._transition_cache.popitem(last=False)
+        else:
+            self._transition_cache.move_to_end(key)
+        return value
+    
+    def transition_matrix(self, time0, time):
+        if time == time0: return np.eye(self._process_dim)
+        return self._cached('transition_matrix', self._transition_matrix_impl, self._time_delta(time0, time))
+    
+    def _transition_matrix_impl(self, time_delta):
+        raise NotImplementedError()
+    
+    def transition_offset(self, time0, time):
+        if time == time0: return np.zeros((self._process_dim, 1))
+        return self._cached('transition_offset', self._transition_offset_impl, self._time_delta(time0, time))
+    
+    def _transition_offset_impl(self, time_delta):
+        raise NotImplementedError()
+    
+    def noise_cov(self, time0, time):
+        if time == time0: return np.zeros((self._process_dim, self._process_dim))
+        return self._cached('noise_cov', self._noise_cov_impl, self._time_delta(time0, time))
+    
+    def _noise_cov_impl(self, time_delta):
+        raise NotImplementedError()
+    
     def to_string_helper(self):
         if self._to_string_helper_MarkovProcess:
             self._to_string_helper_MarkovProcess = super().to_string_helper() \
@@ -159,6 +213,21 @@ class SolvedItoMarkovProcess(MarkovProcess, SolvedItoProcess):
         distr = self.propagate_distr(time, time0, distrs.DiracDeltaDistr.create(value0), assume_distr=True)
         return distr.mean + np.dot(np.linalg.cholesky(distr.cov), variate)
     
+    def _to_rows(self, value0, variate, random_state):
+        # The vectorized (see npu.vectorized) propagate methods of the subclasses accept either a single value, a column,
+        # or several values stacked as rows, which are propagated in one go with the variates stacked as rows. Returns the
+        # values and the variates as rows, and whether the values were given as rows
+        value0 = np.asarray(value0)
+        is_rows = value0.ndim == 2 and npu.ncol(value0) == self.process_dim and (self.process_dim > 1 or npu.nrow(value0) > 1)
+        values0 = value0 if is_rows else npu.to_ndim_2(value0, ndim_1_to_col=True, copy=False).T
+        count = npu.nrow(values0)
+        if variate is None:
+            if random_state is None: random_state = rnd.random_state()
+            variates = random_state.normal(size=(count, self.noise_dim))
+        else:
+            variates = np.reshape(variate, (count, self.noise_dim))
+        return values0, variates, is_rows
+    
     def to_string_helper(self):
         if self._to_string_helper_SolvedItoMarkovProcess is None:
             self._to_string_helper_SolvedItoMarkovProcess = ToStringHelper(self) \
@@ -235,19 +304,13 @@ class WienerProcess(SolvedItoMarkovProcess):
     def cov(self):
         return self._cov
     
+    @npu.vectorized
     def propagate(self, time0, value0, time, variate=None, state0=None, random_state=None):
         if time == time0: return npu.to_ndim_2(value0, ndim_1_to_col=True, copy=True)
-        value0 = npu.to_ndim_2(value0, ndim_1_to_col=True, copy=False)
-        if variate is None:
-            if random_state is None: random_state = rnd.random_state()
-            variate = random_state.normal(size=self.noise_dim)
-        variate = npu.to_ndim_2(variate, ndim_1_to_col=True, copy=False)
-        time_delta = time - time0
-        if isinstance(time_delta, np.timedelta64):
-            time_delta = time_delta.item()
-        if isinstance(time_delta, dt.timedelta):
-            time_delta = time_delta.total_seconds() / self._time_unit.total_seconds()
-        return value0 + self._mean * time_delta + np.dot(self._vol, np.sqrt(time_delta) * variate)
+        values0, variates, is_rows = self._to_rows(value0, variate, random_state)
+        time_delta = self._time_delta(time0, time)
+        values = values0 + self._mean.T * time_delta + np.dot(np.sqrt(time_delta) * variates, self._vol.T)
+        return values if is_rows else values.T
     
     def _propagate_distr_impl(self, distr0, time_delta, assume_distr=False):
         if not isinstance(distr0, distrs.NormalDistr) and not assume_distr:
@@ -255,6 +318,15 @@ class WienerProcess(SolvedItoMarkovProcess):
         mean = distr0.mean + self._mean * time_delta
         cov = distr0.cov + time_delta * self._cov
         return distrs.NormalDistr(mean=mean, cov=cov)
+    
+    def _transition_matrix_impl(self, time_delta):
+        return np.eye(self.process_dim)
+    
+    def _transition_offset_impl(self, time_delta):
+        return self._mean * time_delta
+    
+    def _noise_cov_impl(self, time_delta):
+        return time_delta * self._cov
         
     def __eq__(self, other):
         if isinstance(other, self.__class__):
@@ -333,21 +405,15 @@ class GeometricBrownianMotion(SolvedItoMarkovProcess):
     def pct_cov(self):
         return self._pct_cov
     
+    @npu.vectorized
     def propagate(self, time0, value0, time, variate=None, state0=None, random_state=None):
         if time == time0: return npu.to_ndim_2(value0, ndim_1_to_col=True, copy=True)
-        value0 = npu.to_ndim_2(value0, ndim_1_to_col=True, copy=False)
-        if variate is None:
-            if random_state is None: random_state = rnd.random_state()
-            variate = random_state.normal(size=self.noise_dim)
-        variate = npu.to_ndim_2(variate, ndim_1_to_col=True, copy=False)
-        time_delta = time - time0
-        if isinstance(time_delta, np.timedelta64):
-            time_delta = time_delta.item()
-        if isinstance(time_delta, dt.timedelta):
-            time_delta = time_delta.total_seconds() / self._time_unit.total_seconds()
-        return value0 * np.exp(
-                (self._pct_drift - .5 * npu.col(*np.sum(self._pct_vol**2, axis=1))) * time_delta + \
-                np.dot(self._pct_vol, np.sqrt(time_delta) * variate))
+        values0, variates, is_rows = self._to_rows(value0, variate, random_state)
+        time_delta = self._time_delta(time0, time)
+        values = values0 * np.exp(
+                (self._pct_drift.T - .5 * np.sum(self._pct_vol**2, axis=1)) * time_delta + \
+                np.dot(np.sqrt(time_delta) * variates, self._pct_vol.T))
+        return values if is_rows else values.T
     
     def _propagate_distr_impl(self, distr0, time_delta, assume_distr=False):
         if not isinstance(distr0, distrs.LogNormalDistr) and not assume_distr:
@@ -599,34 +665,34 @@ class OrnsteinUhlenbeckProcess(SolvedItoMarkovProcess):
         eye_minus_mrf_squared = np.eye(self.process_dim * self.process_dim) - mrf_squared
         return npu.unvec(np.dot(np.dot(self._transition_x_2_inverse, eye_minus_mrf_squared), self._cov_vec), self.process_dim)
         
+    @npu.vectorized
     def propagate(self, time0, value0, time, variate=None, state0=None, random_state=None):
         if time == time0: return npu.to_ndim_2(value0, ndim_1_to_col=True, copy=True)
-        value0 = npu.to_ndim_2(value0, ndim_1_to_col=True, copy=False)
-        if variate is None:
-            if random_state is None: random_state = rnd.random_state()
-            variate = random_state.normal(size=self.noise_dim)
-        variate = npu.to_ndim_2(variate, ndim_1_to_col=True, copy=False)
-        time_delta = time - time0
-        if isinstance(time_delta, np.timedelta64):
-            time_delta = time_delta.item()
-        if isinstance(time_delta, dt.timedelta):
-            time_delta = time_delta.total_seconds() / self._time_unit.total_seconds()
-        mrf = self.mean_reversion_factor(time_delta)
-        eye_minus_mrf = np.eye(self.process_dim) - mrf
-        m = np.dot(mrf, value0) + np.dot(eye_minus_mrf, self._mean)
-        c = self.noise_covariance(time_delta)
-        return m + np.dot(np.linalg.cholesky(c), variate)
+        values0, variates, is_rows = self._to_rows(value0, variate, random_state)
+        mrf = self.transition_matrix(time0, time)
+        m = np.dot(values0, mrf.T) + self.transition_offset(time0, time).T
+        c = self.noise_cov(time0, time)
+        values = m + np.dot(variates, np.linalg.cholesky(c).T)
+        return values if is_rows else values.T
         
     def _propagate_distr_impl(self, distr0, time_delta, assume_distr=False):
         if not isinstance(distr0, distrs.NormalDistr) and not assume_distr:
             raise ValueError('Do not know how to propagate a distribution that is not normal')
         value0 = distr0.mean
-        mrf = self.mean_reversion_factor(time_delta)
-        eye_minus_mrf = np.eye(self.process_dim) - mrf
-        m = np.dot(mrf, value0) + np.dot(eye_minus_mrf, self._mean)
-        c = np.dot(np.dot(mrf, distr0.cov), mrf.T) + self.noise_covariance(time_delta)
+        mrf = self._cached('transition_matrix', self._transition_matrix_impl, time_delta)
+        m = np.dot(mrf, value0) + self._cached('transition_offset', self._transition_offset_impl, time_delta)
+        c = np.dot(np.dot(mrf, distr0.cov), mrf.T) + self._cached('noise_cov', self._noise_cov_impl, time_delta)
         return distrs.NormalDistr(mean=m, cov=c)
     
+    def _transition_matrix_impl(self, time_delta):
+        return self.mean_reversion_factor(time_delta)
+    
+    def _transition_offset_impl(self, time_delta):
+        return np.dot(np.eye(self.process_dim) - self.mean_reversion_factor(time_delta), self._mean)
+    
+    def _noise_cov_impl(self, time_delta):
+        return self.noise_covariance(time_delta)
+    
     def __eq__(self, other):
         if isinstance(other, self.__class__):
             return self._mean == other._mean and self._vol == other._vol
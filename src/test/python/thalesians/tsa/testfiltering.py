@@ -1,11 +1,25 @@
 import datetime as dt
+import os
+import tempfile
 import unittest
 
 import numpy as np
 import numpy.testing as npt
+import scipy.stats as stats
 
 from thalesians.tsa.distrs import NormalDistr as N
+import thalesians.tsa.filtering as filtering
+import thalesians.tsa.filtering.checkpoint as checkpoint
+import thalesians.tsa.filtering.ensemble as ensemble
+import thalesians.tsa.filtering.estimation as estimation
+import thalesians.tsa.filtering.extended as extended
+import thalesians.tsa.filtering.information as information
 import thalesians.tsa.filtering.kalman as kalman
+import thalesians.tsa.filtering.parallel as parallel
+import thalesians.tsa.filtering.particle as particle
+import thalesians.tsa.filtering.publishing as publishing
+import thalesians.tsa.filtering.smoothing as smoothing
+import thalesians.tsa.filtering.unscented as unscented
 import thalesians.tsa.numpyutils as npu
 import thalesians.tsa.processes as proc
 
@@ -184,15 +198,1072 @@ class TestFiltering(unittest.TestCase):
         predicted_obs3_posterior0 = coord0_observable.predict(t3)
         npt.assert_almost_equal(predicted_obs3_posterior0.distr.mean, 102.990681374)
         npt.assert_almost_equal(predicted_obs3_posterior0.distr.cov, 39.319665849)
-        npt.assert_almost_equal(predicted_obs3_posterior0.cross_cov, npu.row(39.319665849, 0.0, 0.0))
+        # The sum observation correlates the processes, so the observables of either have cross-covariances with both
+        npt.assert_almost_equal(predicted_obs3_posterior0.cross_cov, npu.row(39.319665849, -2.050000666, -33.147025754))
         predicted_obs3_posterior1 = coord1_observable.predict(t3)
         npt.assert_almost_equal(predicted_obs3_posterior1.distr.mean, 125.332643059)
         npt.assert_almost_equal(predicted_obs3_posterior1.distr.cov, 4.541349469)
-        npt.assert_almost_equal(predicted_obs3_posterior1.cross_cov, npu.row(0.0, 4.541349469, -2.237058941))
+        npt.assert_almost_equal(predicted_obs3_posterior1.cross_cov, npu.row(-2.050000666, 4.541349469, -2.237058941))
         predicted_obs3_posterior2 = coord2_observable.predict(t3)
         npt.assert_almost_equal(predicted_obs3_posterior2.distr.mean, 136.356670319)
         npt.assert_almost_equal(predicted_obs3_posterior2.distr.cov, 39.495767563)
-        npt.assert_almost_equal(predicted_obs3_posterior2.cross_cov, npu.row(0.0, -2.237058941, 39.495767563))
+        npt.assert_almost_equal(predicted_obs3_posterior2.cross_cov, npu.row(-33.147025754, -2.237058941, 39.495767563))
+
+    def test_kalman_filter_bank(self):
+        t0 = dt.datetime(2017, 5, 12, 16, 18, 25, 204000)
+        
+        process1 = proc.WienerProcess.create_from_cov(mean=3., cov=25.)
+        process2 = proc.OrnsteinUhlenbeckProcess.create_from_cov(transition=[[2., 0.], [.5, 1.]], mean=[1., 2.], cov=[[4., 1.], [1., 3.]])
+        state_distr = N(mean=[100., 1., 2.], cov=[[250., 0., 0.], [0., 5., 0.], [0., 0., 6.]])
+        obs_model = kalman.LinearGaussianObsModel.create(1., npu.row(1., 0.))
+        
+        filter_count = 4
+        bank = kalman.KalmanFilterBank(t0, state_distr, (process1, process2), filter_count=filter_count)
+        kfs = [kalman.KalmanFilter(t0, state_distr=state_distr, process=(process1, process2)) for _ in range(filter_count)]
+        observables = [kf.create_observable(obs_model, process1, process2) for kf in kfs]
+        
+        t1 = t0 + dt.timedelta(hours=1)
+        mask = np.array([True, False, True, True])
+        obss = np.array([[100.35, 1.1], [99.5, .9], [101., 1.3]])
+        obs_result = bank.observe(obss, obs_model, obs_covs=np.eye(2), time=t1, mask=mask)
+        npt.assert_equal(obs_result.filter_idxs, [0, 2, 3])
+        for i, filter_idx in enumerate(obs_result.filter_idxs):
+            kf_obs_result = observables[filter_idx].observe(time=t1, obs=N(mean=obss[i], cov=np.eye(2)))
+            npt.assert_almost_equal(obs_result.log_likelihood[i], kf_obs_result.log_likelihood)
+            npt.assert_almost_equal(obs_result.innov_mean[i], kf_obs_result.innov_distr.mean)
+            npt.assert_almost_equal(obs_result.innov_cov[i], kf_obs_result.innov_distr.cov)
+        
+        t2 = t1 + dt.timedelta(hours=2)
+        bank.predict(t2)
+        for filter_idx, kf in enumerate(kfs):
+            kf.predict(t2)
+            npt.assert_almost_equal(bank.state_means[filter_idx], kf.state.state_distr.mean)
+            npt.assert_almost_equal(bank.state_covs[filter_idx], kf.state.state_distr.cov)
+
+    def test_kalman_filter_update_methods(self):
+        process1 = proc.WienerProcess.create_from_cov(mean=3., cov=25.)
+        process2 = proc.OrnsteinUhlenbeckProcess.create_from_cov(transition=[[2., 0.], [.5, 1.]], mean=[1., 2.], cov=[[4., 1.], [1., 3.]])
+        state_distr = N(mean=[100., 1., 2.], cov=[[250., 0., 0.], [0., 5., 0.], [0., 0., 6.]])
+        obs_model = kalman.LinearGaussianObsModel.create(np.array([[1., 1., 1.], [2., 0., -3.]]))
+        
+        results = {}
+        for update_method in kalman.KalmanFilterUpdateMethod:
+            kf = kalman.KalmanFilter(0., state_distr=state_distr, process=(process1, process2), update_method=update_method)
+            observable = kf.create_observable(obs_model, process1, process2)
+            log_likelihoods = []
+            for i, obs in enumerate([[103.5, 195.], [104.25, 193.5], [102.75, 196.]]):
+                obs_result = observable.observe(time=.1 * (i + 1), obs=N(mean=obs, cov=[[2., .5], [.5, 1.]]))
+                log_likelihoods.append(obs_result.log_likelihood)
+            results[update_method] = (kf.state.state_distr.mean, kf.state.state_distr.cov, obs_result.gain, log_likelihoods)
+        
+        for update_method in (kalman.KalmanFilterUpdateMethod.CHOLESKY, kalman.KalmanFilterUpdateMethod.SQUARE_ROOT):
+            for actual, expected in zip(results[update_method], results[kalman.KalmanFilterUpdateMethod.INVERSE]):
+                npt.assert_almost_equal(actual, expected)
+        
+        # The default is the explicit inverse, which (unlike a Cholesky factorization) does not need the innovation
+        # covariance to be positive definite; neither does the whole-array run path for it
+        wiener_process = proc.WienerProcess.create_from_cov(mean=0., cov=1.)
+        kf = kalman.KalmanFilter(0., state_distr=N(mean=0., cov=1.), process=wiener_process)
+        self.assertEqual(kf.update_method, kalman.KalmanFilterUpdateMethod.INVERSE)
+        observable = kf.create_identity_observable(wiener_process)
+        with np.errstate(invalid='ignore'):
+            obs_result = observable.observe(time=0., obs=N(mean=1., cov=-1.5))
+        npt.assert_almost_equal(obs_result.gain, [[-2.]])
+        npt.assert_almost_equal(kf.state.state_distr.mean, [[-2.]])
+        kf = kalman.KalmanFilter(0., state_distr=N(mean=0., cov=1.), process=wiener_process)
+        observable = kf.create_identity_observable(wiener_process)
+        with np.errstate(invalid='ignore'):
+            run_result = filtering.run(observable, obss=np.array([1.]), times=np.array([0.]), obs_covs=np.array([-1.5]))
+        npt.assert_almost_equal(run_result.last_obs_result.gain, [[-2.]])
+        cholesky_kf = kalman.KalmanFilter(0., state_distr=N(mean=0., cov=1.), process=wiener_process, update_method=kalman.KalmanFilterUpdateMethod.CHOLESKY)
+        with self.assertRaises(np.linalg.LinAlgError):
+            cholesky_kf.create_identity_observable(wiener_process).observe(time=0., obs=N(mean=1., cov=-1.5))
+
+    def test_kalman_filter_sequential_update(self):
+        process1 = proc.WienerProcess.create_from_cov(mean=3., cov=25.)
+        process2 = proc.OrnsteinUhlenbeckProcess.create_from_cov(transition=[[2., 0.], [.5, 1.]], mean=[1., 2.], cov=[[4., 1.], [1., 3.]])
+        state_distr = N(mean=[100., 1., 2.], cov=[[250., 0., 0.], [0., 5., 0.], [0., 0., 6.]])
+        obs_matrix = np.array([[1., 1., 1.], [2., 0., -3.], [0., 1., 0.]])
+        obs_cov = np.diag([2., 1., .5])
+        obss = [[103.5, 195., 1.], [104.25, np.nan, 1.5], [102.75, 196., np.nan]]
+        
+        kf = kalman.KalmanFilter(0., state_distr=state_distr, process=(process1, process2))
+        sequential_kf = kalman.KalmanFilter(0., state_distr=state_distr, process=(process1, process2),
+                                            update_method=kalman.KalmanFilterUpdateMethod.SEQUENTIAL)
+        sequential_observable = sequential_kf.create_observable(kalman.LinearGaussianObsModel.create(obs_matrix), process1, process2)
+        for i, obs in enumerate(obss):
+            # The missing components are skipped, which is the same as observing the others only
+            present = ~np.isnan(obs)
+            observable = kf.create_observable(kalman.LinearGaussianObsModel.create(obs_matrix[present]), process1, process2)
+            obs_result = observable.observe(time=.1 * (i + 1), obs=N(mean=np.array(obs)[present], cov=obs_cov[np.ix_(present, present)]))
+            sequential_kf.predict(.1 * (i + 1))
+            prior_state_distr = sequential_kf.state.state_distr
+            sequential_obs_result = sequential_observable.observe(time=.1 * (i + 1), obs=N(mean=obs, cov=obs_cov))
+            # The predictions are those of each component given the preceding ones, formed by the update itself
+            predicted_obs = sequential_obs_result.predicted_obs
+            npt.assert_almost_equal(predicted_obs.distr.mean[present] + sequential_obs_result.innov_distr.mean[present], npu.col(*np.array(obs)[present]))
+            npt.assert_almost_equal(np.diag(predicted_obs.distr.cov)[present] + np.diag(obs_cov)[present], np.diag(sequential_obs_result.innov_distr.cov)[present])
+            npt.assert_almost_equal(predicted_obs.distr.mean[0], np.dot(obs_matrix[0], prior_state_distr.mean))
+            npt.assert_almost_equal(predicted_obs.cross_cov[0], np.dot(obs_matrix[0], prior_state_distr.cov))
+            npt.assert_almost_equal(sequential_kf.state.state_distr.mean, kf.state.state_distr.mean)
+            npt.assert_almost_equal(sequential_kf.state.state_distr.cov, kf.state.state_distr.cov)
+            npt.assert_almost_equal(sequential_obs_result.log_likelihood, obs_result.log_likelihood)
+            self.assertEqual(np.shape(sequential_obs_result.gain), (3, 3))
+            npt.assert_almost_equal(sequential_obs_result.gain[:, ~present], 0.)
+            # The gains of the components applied to their innovations make up the update of the mean
+            npt.assert_almost_equal(np.dot(sequential_obs_result.gain[:, present], sequential_obs_result.innov_distr.mean[present]),
+                                    np.dot(obs_result.gain, obs_result.innov_distr.mean))
+
+    def test_kalman_filter_steady_state(self):
+        process = proc.OrnsteinUhlenbeckProcess.create_from_cov(transition=[[2., 0.], [.5, 1.]], mean=[1., 2.], cov=[[4., 1.], [1., 3.]])
+        state_distr = N(mean=[1., 2.], cov=[[5., 0.], [0., 6.]])
+        obs_model = kalman.LinearGaussianObsModel.create(npu.row(1., 0.))
+        obs_cov = np.array([[.5]])
+        obss = np.sin(np.arange(300) / 10.)
+        
+        kf = kalman.KalmanFilter(0., state_distr=state_distr, process=process)
+        observable = kf.create_observable(obs_model, process)
+        steady_state_kf = kalman.KalmanFilter(0., state_distr=state_distr, process=process, steady_state_tol=1e-10)
+        steady_state_observable = steady_state_kf.create_observable(obs_model, process)
+        steady_state_count = 0
+        for i, obs in enumerate(obss):
+            # An irregular time step in the middle of the run forces a full update
+            time = .1 * (i + 1) if i != 150 else .1 * (i + 1) - .05
+            obs_result = observable.observe(time=time, obs=N(mean=obs, cov=obs_cov))
+            steady_state_obs_result = steady_state_observable.observe(time=time, obs=N(mean=obs, cov=obs_cov))
+            npt.assert_almost_equal(steady_state_obs_result.log_likelihood, obs_result.log_likelihood)
+            npt.assert_almost_equal(steady_state_kf.state.state_distr.mean, kf.state.state_distr.mean)
+            # The reported (in the steady state, frozen) innovation covariance is the one that the log-likelihood uses
+            innov_distr = steady_state_obs_result.innov_distr
+            npt.assert_almost_equal(steady_state_obs_result.log_likelihood, -.5 * (np.log(2. * np.pi * innov_distr.cov) + innov_distr.mean**2 / innov_distr.cov))
+            if i == 150: self.assertFalse(steady_state_kf.is_steady_state)
+            if steady_state_kf.is_steady_state: steady_state_count += 1
+        self.assertTrue(steady_state_kf.is_steady_state)
+        self.assertGreater(steady_state_count, 100)
+        # In the steady state only the mean is propagated; the prior covariance is the frozen one
+        frozen_innov_cov = steady_state_obs_result.innov_distr.cov
+        kf.predict(30.1); steady_state_kf.predict(30.1)
+        npt.assert_almost_equal(steady_state_kf.state.state_distr.mean, kf.state.state_distr.mean)
+        npt.assert_almost_equal(steady_state_kf.state.state_distr.cov, kf.state.state_distr.cov)
+        steady_state_obs_result = steady_state_observable.observe(time=30.1, obs=N(mean=0., cov=obs_cov))
+        self.assertIs(steady_state_obs_result.innov_distr.cov, frozen_innov_cov)
+        npt.assert_almost_equal(steady_state_obs_result.gain, observable.observe(time=30.1, obs=N(mean=0., cov=obs_cov)).gain)
+        
+        dare_kf = kalman.KalmanFilter(0., state_distr=state_distr, process=process, steady_state_tol=1e-10)
+        dare_observable = dare_kf.create_observable(obs_model, process)
+        dare_kf.solve_steady_state(.1, dare_observable, obs_cov)
+        # Solving leaves the state as it is; the next update in the regime applies the steady state
+        self.assertFalse(dare_kf.is_steady_state)
+        self.assertFalse(dare_kf.state.is_posterior)
+        npt.assert_almost_equal(dare_kf.state.state_distr.cov, state_distr.cov)
+        dare_observable.observe(time=.1, obs=N(mean=obss[0], cov=obs_cov))
+        self.assertTrue(dare_kf.is_steady_state)
+        npt.assert_almost_equal(dare_kf.state.state_distr.cov, steady_state_kf.state.state_distr.cov)
+        
+    def test_kalman_filter_run_fast_path(self):
+        wiener_process = proc.WienerProcess.create_from_cov(mean=3., cov=25.)
+        ou_process = proc.OrnsteinUhlenbeckProcess.create_from_cov(transition=2., mean=1., cov=4.)
+        state_distr = N(mean=[1., 2.], cov=[[4., 1.], [1., 3.]])
+        obs_model = kalman.LinearGaussianObsModel.create(npu.row(1., .5))
+        times = .1 * np.arange(1, 101) + .05 * np.sin(np.arange(100))
+        obss = np.cos(np.arange(100) / 7.)
+        obs_covs = 1. + .5 * np.sin(np.arange(100) / 3.)
+        
+        kf = kalman.KalmanFilter(0., state_distr=state_distr, process=(wiener_process, ou_process))
+        observable = kf.create_observable(obs_model, wiener_process, ou_process)
+        run_result = filtering.run(observable, obss=obss, times=times, obs_covs=obs_covs, return_df=True)
+        self.assertIsNotNone(run_result.arrays)
+        
+        # A non-trivial fun forces the generic per-observation loop
+        slow_kf = kalman.KalmanFilter(0., state_distr=state_distr, process=(wiener_process, ou_process))
+        slow_observable = slow_kf.create_observable(obs_model, wiener_process, ou_process)
+        slow_run_result = filtering.run(slow_observable, obss=obss, times=times, obs_covs=obs_covs, fun=lambda x: x, return_df=True)
+        
+        npt.assert_almost_equal(np.squeeze(run_result.cumulative_log_likelihood), np.squeeze(slow_run_result.cumulative_log_likelihood))
+        npt.assert_almost_equal(kf.state.state_distr.mean, slow_kf.state.state_distr.mean)
+        npt.assert_almost_equal(kf.state.state_distr.cov, slow_kf.state.state_distr.cov)
+        npt.assert_almost_equal(run_result.last_obs_result.gain, slow_run_result.last_obs_result.gain)
+        self.assertEqual(len(run_result.df), len(slow_run_result.df))
+        for column in ('obs_mean', 'innov_mean', 'innov_cov', 'prior_state_mean', 'prior_state_cov', 'posterior_state_mean', 'posterior_state_cov', 'log_likelihood'):
+            for value, slow_value in zip(run_result.df[column][1:], slow_run_result.df[column][1:]):
+                npt.assert_almost_equal(np.squeeze(value), np.squeeze(slow_value))
+        npt.assert_almost_equal(run_result.arrays['posterior_state_mean'][-1], np.squeeze(kf.state.state_distr.mean))
+        for column in ('innov_mean', 'posterior_state_mean', 'posterior_state_cov', 'log_likelihood', 'gain'):
+            npt.assert_almost_equal(run_result.arrays[column], slow_run_result.arrays[column])
+        
+    def test_kalman_filter_run_paths_agree(self):
+        # The whole-array path and the generic loop return the same FilterRunResult, with or without the recorded steps
+        process = proc.OrnsteinUhlenbeckProcess.create_from_cov(transition=2., mean=1., cov=4.)
+        obs_model = kalman.LinearGaussianObsModel.create(1.)
+        times = .1 * np.arange(1, 21)
+        obss = np.cos(np.arange(20) / 7.)
+        obs_covs = np.full(20, .5)
+        for return_df in (False, True):
+            run_results = []
+            for fun in (None, lambda x: x):
+                kf = kalman.KalmanFilter(0., state_distr=N(mean=0., cov=1.), process=process, name='kf')
+                observable = kf.create_named_observable('obs', obs_model, process)
+                run_results.append(filtering.run(observable, obss=obss, times=times, obs_covs=obs_covs, fun=fun, return_df=return_df))
+            run_result, slow_run_result = run_results
+            self.assertIs(type(run_result.cumulative_log_likelihood), type(slow_run_result.cumulative_log_likelihood))
+            self.assertEqual(np.shape(run_result.cumulative_log_likelihood), np.shape(slow_run_result.cumulative_log_likelihood))
+            npt.assert_almost_equal(run_result.cumulative_log_likelihood, slow_run_result.cumulative_log_likelihood)
+            last_obs_result, slow_last_obs_result = run_result.last_obs_result, slow_run_result.last_obs_result
+            self.assertEqual(last_obs_result.obs.time, slow_last_obs_result.obs.time)
+            npt.assert_almost_equal(last_obs_result.log_likelihood, slow_last_obs_result.log_likelihood)
+            npt.assert_almost_equal(last_obs_result.gain, slow_last_obs_result.gain)
+            npt.assert_almost_equal(last_obs_result.innov_distr.mean, slow_last_obs_result.innov_distr.mean)
+            npt.assert_almost_equal(last_obs_result.innov_distr.cov, slow_last_obs_result.innov_distr.cov)
+            npt.assert_almost_equal(last_obs_result.predicted_obs.distr.mean, slow_last_obs_result.predicted_obs.distr.mean)
+            npt.assert_almost_equal(last_obs_result.predicted_obs.cross_cov, slow_last_obs_result.predicted_obs.cross_cov)
+            if not return_df:
+                self.assertIsNone(run_result.arrays)
+                self.assertIsNone(run_result.df)
+                self.assertIsNone(slow_run_result.df)
+                continue
+            self.assertEqual(run_result.df.columns.tolist(), slow_run_result.df.columns.tolist())
+            for column, array in run_result.arrays.items():
+                slow_array = slow_run_result.arrays[column]
+                if array is None or slow_array is None:
+                    self.assertIs(array, slow_array)
+                elif array.dtype == float:
+                    npt.assert_almost_equal(array, slow_array)
+                else:
+                    self.assertEqual(list(array), list(slow_array))
+        
+    def test_filter_run_result_arrays(self):
+        process = proc.OrnsteinUhlenbeckProcess.create_from_cov(transition=[[2., 0.], [.5, 1.]], mean=[1., 2.], cov=[[4., 1.], [1., 3.]])
+        kf = kalman.KalmanFilter(0., state_distr=N(mean=[1., 2.], cov=[[5., 0.], [0., 6.]]), process=process)
+        observable = kf.create_observable(kalman.LinearGaussianObsModel.create(npu.row(1., 0.)), process)
+        obss = [N(mean=np.sin(i / 10.), cov=.5) for i in range(100)]
+        run_result = filtering.run(observable, obss=obss, times=.1 * np.arange(1, 101), return_df=True)
+        
+        arrays = run_result.arrays
+        # The first row is that of the initial state
+        self.assertEqual(arrays['posterior_state_mean'].shape, (101, 2))
+        self.assertEqual(arrays['posterior_state_cov'].shape, (101, 2, 2))
+        self.assertEqual(arrays['log_likelihood'].shape, (101,))
+        self.assertTrue(np.isnan(arrays['innov_mean'][0, 0]))
+        npt.assert_almost_equal(arrays['posterior_state_mean'][0], [1., 2.])
+        npt.assert_almost_equal(arrays['posterior_state_mean'][-1], np.squeeze(kf.state.state_distr.mean))
+        npt.assert_almost_equal(np.nansum(arrays['log_likelihood']), np.squeeze(run_result.cumulative_log_likelihood))
+        
+        df = run_result.df
+        self.assertEqual(len(df), 101)
+        self.assertIsNone(df['gain'][0])
+        npt.assert_almost_equal(df['posterior_state_mean'][0], npu.col(1., 2.))
+        npt.assert_almost_equal(df['posterior_state_mean'][100], kf.state.state_distr.mean)
+        
+        wide_df = run_result.to_df(wide=True)
+        self.assertIn('posterior_state_cov_0_1', wide_df.columns)
+        self.assertNotIn('posterior_state_mean', wide_df.columns)
+        self.assertEqual(wide_df['posterior_state_mean_1'].dtype, np.float64)
+        npt.assert_almost_equal(wide_df['posterior_state_mean_1'].values, arrays['posterior_state_mean'][:, 1])
+        npt.assert_almost_equal(wide_df['innov_mean'].values[1:], arrays['innov_mean'][1:, 0])
+        
+        # A run result may still be constructed from a DataFrame
+        df_run_result = filtering.FilterRunResult(run_result.last_obs_result, run_result.cumulative_log_likelihood, df)
+        self.assertIs(df_run_result.df, df)
+        self.assertIsNone(df_run_result.arrays)
+        
+    def test_filter_run_result_nan_values(self):
+        # Values that are NaN, such as a missing component of the true value, are kept, whereas the rows without a value
+        # are None
+        process = proc.OrnsteinUhlenbeckProcess.create_from_cov(transition=2., mean=1., cov=4.)
+        obs_model = kalman.LinearGaussianObsModel.create(1.)
+        times = .1 * np.arange(1, 6)
+        true_values = np.array([[1., 2.], [np.nan, np.nan], [3., np.nan], [4., 5.], [6., 7.]])
+        for fun in (None, lambda x: x):
+            kf = kalman.KalmanFilter(0., state_distr=N(mean=0., cov=1.), process=process)
+            observable = kf.create_observable(obs_model, process)
+            run_result = filtering.run(observable, obss=np.ones(5), times=times, obs_covs=np.full(5, .5),
+                                       true_values=true_values, fun=fun, return_df=True)
+            df = run_result.df
+            self.assertIsNone(df['true_value'][0])
+            self.assertIsNotNone(df['true_value'][2])
+            self.assertTrue(np.all(np.isnan(df['true_value'][2])))
+            self.assertTrue(np.isnan(df['true_value'][3][1, 0]))
+            npt.assert_almost_equal(df['true_value'][4], npu.col(4., 5.))
+        
+    def test_kalman_filter_cross_covariance_between_processes(self):
+        # Two stacked independent processes are equivalent to a single two-dimensional process with a block-diagonal
+        # transition and covariance; observing their sum correlates them, which the prediction must preserve
+        wiener_process = proc.WienerProcess.create_from_cov(mean=1., cov=4.)
+        ou_process = proc.OrnsteinUhlenbeckProcess.create_from_cov(transition=2., mean=1., cov=3.)
+        ou_process_2d = proc.OrnsteinUhlenbeckProcess.create_from_cov(transition=[[2., 0.], [0., .5]], mean=[1., 0.], cov=[[3., 0.], [0., 2.]])
+        other_ou_process = proc.OrnsteinUhlenbeckProcess.create_from_cov(transition=.5, mean=0., cov=2.)
+        state_distr = N(mean=[1., 2.], cov=[[5., 0.], [0., 6.]])
+        
+        kf = kalman.KalmanFilter(0., state_distr=state_distr, process=(ou_process, other_ou_process))
+        observable = kf.create_observable(kalman.LinearGaussianObsModel.create(npu.row(1., 1.)), ou_process, other_ou_process)
+        kf_2d = kalman.KalmanFilter(0., state_distr=state_distr, process=ou_process_2d)
+        observable_2d = kf_2d.create_observable(kalman.LinearGaussianObsModel.create(npu.row(1., 1.)), ou_process_2d)
+        for time, obs in zip((.5, 1., 1.7, 2.), (.3, -.2, .8, 1.1)):
+            obs_result = observable.observe(time=time, obs=N(mean=obs, cov=.5))
+            obs_result_2d = observable_2d.observe(time=time, obs=N(mean=obs, cov=.5))
+            npt.assert_almost_equal(obs_result.log_likelihood, obs_result_2d.log_likelihood)
+            npt.assert_almost_equal(kf.state.state_distr.cov, kf_2d.state.state_distr.cov)
+        self.assertNotAlmostEqual(kf.state.state_distr.cov[0, 1], 0.)
+        kf.predict(3.); kf_2d.predict(3.)
+        npt.assert_almost_equal(kf.state.state_distr.mean, kf_2d.state.state_distr.mean)
+        npt.assert_almost_equal(kf.state.state_distr.cov, kf_2d.state.state_distr.cov)
+        
+        # A Wiener process has an identity transition, so its cross-covariance only picks up the other process's
+        kf = kalman.KalmanFilter(0., state_distr=N(mean=[1., 2.], cov=[[5., 1.], [1., 6.]]), process=(wiener_process, ou_process))
+        observable = kf.create_identity_observable(wiener_process)
+        kf.predict(1.)
+        npt.assert_almost_equal(kf.state.state_distr.cov[0, 1], ou_process.mean_reversion_factor(1.)[0, 0])
+        
+        # Observing the Wiener process updates the other process through the cross-covariance, as the full-matrix update
+        kf.predict(2.)
+        prior_mean, prior_cov = np.copy(kf.state.state_distr.mean), np.copy(kf.state.state_distr.cov)
+        obs_matrix = npu.row(1., 0.)
+        innov_cov = obs_matrix.dot(prior_cov).dot(obs_matrix.T) + 1.
+        gain = prior_cov.dot(obs_matrix.T).dot(np.linalg.inv(innov_cov))
+        npt.assert_almost_equal(observable.predict(2.).cross_cov, obs_matrix.dot(prior_cov))
+        nonlinear_observable = kf.create_observable(kalman.NonlinearObsModel.create(lambda x: 2. * x), wiener_process)
+        npt.assert_almost_equal(nonlinear_observable.predict(2.).cross_cov, 2. * obs_matrix.dot(prior_cov))
+        observable.observe(time=2., obs=N(mean=1., cov=1.))
+        npt.assert_almost_equal(kf.state.state_distr.mean, prior_mean + gain.dot(1. - obs_matrix.dot(prior_mean)))
+        npt.assert_almost_equal(kf.state.state_distr.cov, prior_cov - gain.dot(innov_cov).dot(gain.T))
+        npt.assert_almost_equal(kf.state.state_distr.cov[0, 1], prior_cov[0, 1] - prior_cov[0, 0] * prior_cov[0, 1] / innov_cov[0, 0])
+        self.assertNotAlmostEqual(kf.state.state_distr.mean[1, 0], prior_mean[1, 0])
+        
+    def test_kalman_filter_observe_batch(self):
+        # Bid, ask and trade prices observing a mid-price and a spread
+        mid_process = proc.WienerProcess.create_from_cov(mean=0., cov=4.)
+        spread_process = proc.OrnsteinUhlenbeckProcess.create_from_cov(transition=2., mean=1., cov=.25)
+        state_distr = N(mean=[100., 1.], cov=[[10., 0.], [0., 1.]])
+        def create_filter(update_method=kalman.KalmanFilterUpdateMethod.CHOLESKY):
+            kf = kalman.KalmanFilter(0., state_distr=state_distr, process=(mid_process, spread_process), update_method=update_method)
+            bid = kf.create_named_observable('bid', kalman.LinearGaussianObsModel.create(npu.row(1., -.5)), mid_process, spread_process)
+            ask = kf.create_named_observable('ask', kalman.LinearGaussianObsModel.create(npu.row(1., .5)), mid_process, spread_process)
+            trade = kf.create_named_observable('trade', kalman.LinearGaussianObsModel.create(1.), mid_process)
+            quote = kf.create_named_observable('quote', kalman.LinearGaussianObsModel.create(np.array([[1., -.5], [1., .5]])), mid_process, spread_process)
+            return kf, bid, ask, trade, quote
+        
+        results = []
+        for update_method in kalman.KalmanFilterUpdateMethod:
+            for sequential in (False, True):
+                kf, bid, ask, trade, _ = create_filter(update_method)
+                for time, (bid_price, ask_price, trade_price) in zip((1., 2.), ((99.5, 100.7, 100.1), (100.2, 101.4, 101.3))):
+                    obs_result = kf.observe_batch(((bid, N(mean=bid_price, cov=.01)), (ask, N(mean=ask_price, cov=.01)), (trade, N(mean=trade_price, cov=.25))),
+                                                  time=time, sequential=sequential)
+                    self.assertEqual(obs_result.obs.observable_name, ('bid', 'ask', 'trade'))
+                    self.assertEqual(obs_result.gain.shape, (2, 3))
+                results.append((kf.state.state_distr, obs_result))
+        
+        # A single observable that observes the bid and ask jointly gives the same joint likelihood
+        kf, _, _, trade, quote = create_filter()
+        quote.observe(time=1., obs=N(mean=[99.5, 100.7], cov=[[.01, 0.], [0., .01]]))
+        trade.observe(time=1., obs=N(mean=100.1, cov=.25))
+        for state_distr, obs_result in results:
+            npt.assert_almost_equal(state_distr.mean, results[0][0].mean)
+            npt.assert_almost_equal(state_distr.cov, results[0][0].cov)
+            npt.assert_almost_equal(obs_result.log_likelihood, results[0][1].log_likelihood)
+        kf.predict(2.)
+        kf_prior_mean = kf.state.state_distr.mean
+        quote_obs_result = quote.observe(time=2., obs=N(mean=[100.2, 101.4], cov=[[.01, 0.], [0., .01]]))
+        trade_obs_result = trade.observe(time=2., obs=N(mean=101.3, cov=.25))
+        npt.assert_almost_equal(kf.state.state_distr.mean, results[0][0].mean)
+        npt.assert_almost_equal(quote_obs_result.log_likelihood + trade_obs_result.log_likelihood, results[0][1].log_likelihood)
+        # For both the joint and the sequential updates, the gain maps the innovation to the update of the mean
+        for _, obs_result in results[0:2]:
+            npt.assert_almost_equal(kf_prior_mean + np.dot(obs_result.gain, obs_result.innov_distr.mean), results[0][0].mean)
+        
+        kf, bid, ask, _, _ = create_filter()
+        with self.assertRaises(ValueError):
+            kf.observe_batch(((bid, filtering.Obs(bid, 1., N(mean=99.5, cov=.01))), (ask, filtering.Obs(ask, 2., N(mean=100.7, cov=.01)))))
+        
+        # With a process that is observed by neither observable, the sequential update must still carry the correlations
+        # with it, giving the joint update's posterior and log-likelihood
+        processes = [proc.WienerProcess.create_from_cov(mean=0., cov=1.) for _ in range(3)]
+        results = []
+        for sequential in (False, True):
+            kf = kalman.KalmanFilter(0., state_distr=N(mean=[0., 0., 0.], cov=[[1., .5, .2], [.5, 1., .3], [.2, .3, 1.]]), process=processes)
+            observable1 = kf.create_identity_observable(processes[0])
+            observable2 = kf.create_identity_observable(processes[1])
+            obs_result = kf.observe_batch(((observable1, N(mean=1., cov=1.)), (observable2, N(mean=-1., cov=1.))), time=0., sequential=sequential)
+            results.append((kf.state.state_distr, obs_result))
+        npt.assert_almost_equal(results[0][0].mean, npu.col(1. / 3., -1. / 3., -1. / 15.))
+        npt.assert_almost_equal(results[1][0].mean, results[0][0].mean)
+        npt.assert_almost_equal(results[1][0].cov, results[0][0].cov)
+        npt.assert_almost_equal(results[1][1].log_likelihood, results[0][1].log_likelihood)
+        
+    def test_rts_and_fixed_lag_smoothing(self):
+        # For a random walk observed with noise, the smoothed states are the conditional moments of the (jointly
+        # Normal) states given all the observations
+        process = proc.WienerProcess.create_from_cov(mean=0., cov=2.)
+        times = np.array([.5, 1., 1.7, 2., 3.1, 3.5, 4.2, 5.])
+        obss = np.array([.3, -.2, .8, 1.1, .4, -.6, .1, .9])
+        obs_cov = .7
+        kf = kalman.KalmanFilter(0., state_distr=N(mean=1., cov=3.), process=process)
+        observable = kf.create_observable(kalman.LinearGaussianObsModel.create(1.), process)
+        run_result = filtering.run(observable, obss=obss, times=times, obs_covs=np.full(len(obss), obs_cov), return_df=True)
+        smoothing_result = smoothing.rts_smooth(kf, run_result)
+        
+        all_times = np.concatenate(([0.], times))
+        cov = 3. + 2. * np.minimum.outer(all_times, all_times)
+        obs_matrix = np.eye(len(all_times))[1:]
+        gain = np.linalg.solve(np.dot(np.dot(obs_matrix, cov), obs_matrix.T) + obs_cov * np.eye(len(obss)), np.dot(obs_matrix, cov)).T
+        npt.assert_almost_equal(smoothing_result.state_means[:, 0], 1. + np.dot(gain, obss - 1.))
+        npt.assert_almost_equal(smoothing_result.state_covs[:, 0, 0], np.diag(cov - np.dot(np.dot(gain, obs_matrix), cov)))
+        npt.assert_almost_equal(smoothing_result.state_distr(-1).mean, kf.state.state_distr.mean)
+        
+        process = proc.OrnsteinUhlenbeckProcess.create_from_cov(transition=[[2., 0.], [.5, 1.]], mean=[1., 2.], cov=[[4., 1.], [1., 3.]])
+        npt.assert_almost_equal(process.transition_matrix(1., 1.5), process.mean_reversion_factor(.5))
+        state_distr = N(mean=[1., 2.], cov=[[5., 0.], [0., 6.]])
+        obs_model = kalman.LinearGaussianObsModel.create(npu.row(1., 0.))
+        lag = 3
+        kf = kalman.KalmanFilter(0., state_distr=state_distr, process=process)
+        observable = kf.create_observable(obs_model, process)
+        fixed_lag_smoother = smoothing.FixedLagSmoother(kf, lag)
+        smoothed = [fixed_lag_smoother.observe(observable, N(mean=obs, cov=obs_cov), time) for time, obs in zip(times, obss)]
+        self.assertTrue(all([s is None for s in smoothed[0:lag]]))
+        for count in (lag + 1, len(obss)):
+            # With the observations up to count, the fixed-lag estimate is the RTS estimate lag steps back
+            kf = kalman.KalmanFilter(0., state_distr=state_distr, process=process)
+            observable = kf.create_observable(obs_model, process)
+            run_result = filtering.run(observable, obss=obss[0:count], times=times[0:count], obs_covs=np.full(count, obs_cov), return_df=True)
+            smoothing_result = smoothing.rts_smooth(kf, run_result)
+            time, smoothed_state_distr = smoothed[count - 1]
+            self.assertEqual(time, times[count - 1 - lag])
+            npt.assert_almost_equal(smoothed_state_distr.mean, smoothing_result.state_distr(count - lag).mean)
+            npt.assert_almost_equal(smoothed_state_distr.cov, smoothing_result.state_distr(count - lag).cov)
+        self.assertEqual(len(fixed_lag_smoother.flush()), lag + 1)
+
+
+    def test_information_filter(self):
+        wiener_process = proc.WienerProcess.create_from_cov(mean=3., cov=25.)
+        ou_process = proc.OrnsteinUhlenbeckProcess.create_from_cov(transition=[[2., 0.], [.5, 1.]], mean=[1., 2.], cov=[[4., 1.], [1., 3.]])
+        state_distr = N(mean=[100., 1., 2.], cov=[[250., 0., 0.], [0., 5., 0.], [0., 0., 6.]])
+        rng = np.random.RandomState(0)
+        obs_matrix = rng.normal(size=(20, 3))
+        diagonal_obs_cov = np.diag(rng.uniform(.5, 2., size=20))
+        full_obs_cov = diagonal_obs_cov + .25
+        
+        kf = kalman.KalmanFilter(0., state_distr=state_distr, process=(wiener_process, ou_process))
+        observable = kf.create_observable(kalman.LinearGaussianObsModel.create(obs_matrix), wiener_process, ou_process)
+        inf = information.InformationFilter(0., state_distr=state_distr, process=(wiener_process, ou_process))
+        information_observable = inf.create_observable(kalman.LinearGaussianObsModel.create(obs_matrix), wiener_process, ou_process)
+        for i in range(6):
+            obs_cov = diagonal_obs_cov if i % 2 == 0 else full_obs_cov
+            obs = N(mean=rng.normal(size=20), cov=obs_cov)
+            obs_result = observable.observe(time=.1 * (i + 1), obs=obs)
+            information_obs_result = information_observable.observe(time=.1 * (i + 1), obs=obs)
+            # The m x m covariances of the predicted observation and the innovation are only computed when read
+            self.assertIsNone(information_obs_result.innov_distr._cov)
+            self.assertIsNone(information_obs_result.predicted_obs.distr._cov)
+            npt.assert_almost_equal(information_obs_result.innov_distr.cov, obs_result.innov_distr.cov)
+            npt.assert_almost_equal(information_obs_result.predicted_obs.distr.cov, obs_result.predicted_obs.distr.cov)
+            npt.assert_almost_equal(information_obs_result.predicted_obs.distr.mean, obs_result.predicted_obs.distr.mean)
+            npt.assert_almost_equal(information_obs_result.log_likelihood, obs_result.log_likelihood)
+            npt.assert_almost_equal(information_obs_result.gain, obs_result.gain)
+            npt.assert_almost_equal(inf.state.state_distr.mean, kf.state.state_distr.mean)
+            npt.assert_almost_equal(inf.state.state_distr.cov, kf.state.state_distr.cov)
+        npt.assert_almost_equal(inf.info_matrix, np.linalg.inv(kf.state.state_distr.cov))
+        npt.assert_almost_equal(inf.info_vector, np.dot(inf.info_matrix, kf.state.state_distr.mean))
+        
+        # Several observations at the same time accumulate in the information form
+        inf.predict(1.)
+        kf.predict(1.)
+        for obs in (1., 2., 4.):
+            information_observable.observe(time=1., obs=N(mean=obs * np.ones(20), cov=diagonal_obs_cov))
+            observable.observe(time=1., obs=N(mean=obs * np.ones(20), cov=diagonal_obs_cov))
+        npt.assert_almost_equal(inf.state.state_distr.mean, kf.state.state_distr.mean)
+        
+        # The information filter plugs into filtering.run
+        process = proc.OrnsteinUhlenbeckProcess.create_from_cov(transition=2., mean=1., cov=4.)
+        obs_model = kalman.LinearGaussianObsModel.create(npu.row(1.))
+        times = .1 * np.arange(1, 51)
+        obss = np.cos(np.arange(50) / 7.)
+        kf = kalman.KalmanFilter(0., state_distr=N(mean=1., cov=2.), process=process)
+        inf = information.InformationFilter(0., state_distr=N(mean=1., cov=2.), process=process)
+        run_result = filtering.run(kf.create_observable(obs_model, process), obss=obss, times=times, obs_covs=.5, return_df=True)
+        information_run_result = filtering.run(inf.create_observable(obs_model, process), obss=obss, times=times, obs_covs=.5, return_df=True)
+        npt.assert_almost_equal(information_run_result.cumulative_log_likelihood, run_result.cumulative_log_likelihood)
+        npt.assert_almost_equal(information_run_result.arrays['posterior_state_mean'], run_result.arrays['posterior_state_mean'])
+
+
+    def test_extended_and_unscented_kalman_filters(self):
+        wiener_process = proc.WienerProcess.create_from_cov(mean=3., cov=25.)
+        ou_process = proc.OrnsteinUhlenbeckProcess.create_from_cov(transition=[[2., 0.], [.5, 1.]], mean=[1., 2.], cov=[[4., 1.], [1., 3.]])
+        state_distr = N(mean=[100., 1., 2.], cov=[[250., 0., 0.], [0., 5., 0.], [0., 0., 6.]])
+        obs_matrix = np.array([[1., 1., 1.], [2., 0., -3.]])
+        obss = [[103.5, 195.], [104.25, 193.5], [102.75, 196.]]
+        
+        # On linear-Gaussian models both coincide with the Kalman filter
+        results = []
+        for filter_type, obs_model in ((kalman.KalmanFilter, kalman.LinearGaussianObsModel.create(obs_matrix)),
+                                       (extended.ExtendedKalmanFilter, kalman.NonlinearObsModel.create(npu.vectorized(lambda x: np.dot(x, obs_matrix.T)))),
+                                       (unscented.UnscentedKalmanFilter, kalman.NonlinearObsModel.create(lambda x: np.dot(obs_matrix, x)))):
+            kf = filter_type(0., state_distr=state_distr, process=(wiener_process, ou_process))
+            observable = kf.create_observable(obs_model, wiener_process, ou_process)
+            log_likelihoods = [observable.observe(time=.1 * (i + 1), obs=N(mean=obs, cov=[[2., .5], [.5, 1.]])).log_likelihood for i, obs in enumerate(obss)]
+            results.append((kf.state.state_distr.mean, kf.state.state_distr.cov, log_likelihoods))
+        for result in results[1:]:
+            for actual, expected in zip(result, results[0]):
+                npt.assert_almost_equal(actual, expected)
+        
+        # A geometric Brownian motion: the unscented transform captures the log-normal moments to second order, while the
+        # linearization gives the propagated median
+        process = proc.GeometricBrownianMotion(pct_drift=.1, pct_vol=.2)
+        ekf = extended.ExtendedKalmanFilter(0., state_distr=N(mean=100., cov=0.), process=process)
+        ekf.predict(1.)
+        npt.assert_almost_equal(ekf.state.state_distr.mean, [[100. * np.exp(.1 - .5 * .04)]])
+        ukf = unscented.UnscentedKalmanFilter(0., state_distr=N(mean=100., cov=0.), process=process)
+        ukf.predict(1.)
+        self.assertAlmostEqual(ukf.state.state_distr.mean[0, 0], 100. * np.exp(.1), delta=.01)
+        self.assertAlmostEqual(ukf.state.state_distr.cov[0, 0], 100. ** 2 * np.exp(.2) * (np.exp(.04) - 1.), delta=5.)
+        
+        # A nonlinear observation of the level, with the Jacobian given or by central differences
+        obs_function = lambda x: np.log(x)
+        results = []
+        for obs_model in (kalman.NonlinearObsModel.create(obs_function, lambda x: 1. / x), kalman.NonlinearObsModel.create(obs_function)):
+            ekf = extended.ExtendedKalmanFilter(0., state_distr=N(mean=100., cov=4.), process=process)
+            obs_result = ekf.create_observable(obs_model, process).observe(time=1., obs=N(mean=np.log(105.), cov=.01))
+            npt.assert_almost_equal(obs_result.predicted_obs.distr.mean, [[.08 + np.log(100.)]])
+            npt.assert_almost_equal(obs_result.gain, obs_result.predicted_obs.cross_cov.T / obs_result.innov_distr.cov)
+            results.append((obs_result.predicted_obs.distr.cov, ekf.state.state_distr.mean, ekf.state.state_distr.cov))
+        for actual, expected in zip(results[1], results[0]):
+            npt.assert_allclose(actual, expected, rtol=1e-6)
+        ukf = unscented.UnscentedKalmanFilter(0., state_distr=N(mean=100., cov=4.), process=process)
+        run_result = filtering.run(ukf.create_observable(kalman.NonlinearObsModel.create(obs_function), process),
+                                   obss=np.log(100.) + .1 * np.arange(1, 11), times=np.arange(1., 11.), obs_covs=.01)
+        self.assertGreater(npu.to_ndim_1(ukf.state.state_distr.mean)[0], 250.)
+        self.assertTrue(np.isfinite(run_result.cumulative_log_likelihood))
+
+
+    def test_ensemble_kalman_filter(self):
+        wiener_process = proc.WienerProcess.create_from_cov(mean=3., cov=25.)
+        ou_process = proc.OrnsteinUhlenbeckProcess.create_from_cov(transition=[[2., 0.], [.5, 1.]], mean=[1., 2.], cov=[[4., 1.], [1., 3.]])
+        state_distr = N(mean=[100., 1., 2.], cov=[[250., 0., 0.], [0., 5., 0.], [0., 0., 6.]])
+        obs_model = kalman.LinearGaussianObsModel.create(np.array([[1., 1., 1.], [2., 0., -3.]]))
+        
+        kf = kalman.KalmanFilter(0., state_distr=state_distr, process=(wiener_process, ou_process))
+        observable = kf.create_observable(obs_model, wiener_process, ou_process)
+        enkf = ensemble.EnsembleKalmanFilter(0., state_distr=state_distr, process=(wiener_process, ou_process), member_count=20000,
+                                             random_state=np.random.RandomState(1))
+        ensemble_observable = enkf.create_observable(obs_model, wiener_process, ou_process)
+        for i, obs in enumerate([[103.5, 195.], [104.25, 193.5], [102.75, 196.]]):
+            obs_result = observable.observe(time=.1 * (i + 1), obs=N(mean=obs, cov=[[2., .5], [.5, 1.]]))
+            ensemble_obs_result = ensemble_observable.observe(time=.1 * (i + 1), obs=N(mean=obs, cov=[[2., .5], [.5, 1.]]))
+            npt.assert_allclose(ensemble_obs_result.log_likelihood, obs_result.log_likelihood, rtol=1e-2)
+        self.assertEqual(enkf.members.shape, (20000, 3))
+        npt.assert_allclose(enkf.state.state_distr.mean, kf.state.state_distr.mean, atol=.05)
+        npt.assert_allclose(enkf.state.state_distr.cov, kf.state.state_distr.cov, atol=.05)
+        
+        # With localization, observations do not affect the state components beyond the tapers' support
+        state_dim = 100
+        processes = [proc.WienerProcess.create_from_cov(mean=0., cov=1.) for _ in range(state_dim)]
+        obs_idxs = np.arange(0, state_dim, 10)
+        enkf = ensemble.EnsembleKalmanFilter(0., state_distr=N(mean=np.zeros(state_dim), cov=np.eye(state_dim)), process=processes,
+                                             member_count=20, random_state=np.random.RandomState(0))
+        localization = (ensemble.gaspari_cohn(np.arange(state_dim)[:, np.newaxis] - obs_idxs, 1.),
+                        ensemble.gaspari_cohn(obs_idxs[:, np.newaxis] - obs_idxs, 1.))
+        ensemble_observable = enkf.create_observable(kalman.LinearGaussianObsModel.create(np.eye(state_dim)[obs_idxs]), *processes,
+                                                     localization=localization)
+        obs_result = ensemble_observable.observe(time=1., obs=N(mean=np.ones(len(obs_idxs)), cov=.1 * np.eye(len(obs_idxs))))
+        self.assertEqual(obs_result.gain.shape, (state_dim, len(obs_idxs)))
+        npt.assert_equal(obs_result.gain[np.abs(np.arange(state_dim)[:, np.newaxis] - obs_idxs) >= 2], 0.)
+        npt.assert_equal(np.diag(obs_result.gain[obs_idxs]) > .5, True)
+        
+    def test_maximum_likelihood_estimation(self):
+        def create_model(params):
+            log_transition, mean, log_vol, log_obs_vol = params
+            process = proc.OrnsteinUhlenbeckProcess(transition=np.exp(log_transition), mean=mean, vol=np.exp(log_vol))
+            kf = kalman.KalmanFilter(0., state_distr=N(mean=0., cov=1.), process=process)
+            return kf.create_identity_observable(process), np.exp(2. * log_obs_vol)
+        
+        true_params = np.array([np.log(2.), 1., np.log(.5), np.log(.1)])
+        random_state = np.random.RandomState(1)
+        count = 3000
+        times = .01 * np.arange(1, count + 1)
+        phi = np.exp(-2. * .01)
+        state = 0.
+        obss = np.empty(count)
+        for i in range(count):
+            state = 1. + phi * (state - 1.) + .5 * np.sqrt((1. - phi * phi) / 4.) * random_state.normal()
+            obss[i] = state + .1 * random_state.normal()
+        
+        # The log-likelihood agrees with that of filtering.run and the score with its finite differences
+        params = true_params + np.array([.2, -.3, .1, .1])
+        log_likelihood, score = estimation.log_likelihood_and_score(create_model, params, obss, times)
+        observable, obs_cov = create_model(params)
+        run_result = filtering.run(observable, obss, times, obs_covs=np.full(count, obs_cov))
+        npt.assert_allclose(log_likelihood, run_result.cumulative_log_likelihood, rtol=1e-8)
+        steps = 1e-5 * np.eye(len(params))
+        finite_differences = [(estimation.log_likelihood_and_score(create_model, params + step, obss, times)[0] -
+                estimation.log_likelihood_and_score(create_model, params - step, obss, times)[0]) / 2e-5 for step in steps]
+        npt.assert_allclose(score, finite_differences, rtol=1e-5, atol=1e-4)
+        
+        # Likewise for irregularly spaced observations with their own noise covariances
+        irregular_times = np.cumsum(random_state.choice([.005, .01, .02], size=500))
+        obs_covs = np.full(500, .01)
+        create_model_without_obs_cov = lambda params: (create_model(params)[0], None)
+        log_likelihood, score = estimation.log_likelihood_and_score(create_model_without_obs_cov, params, obss[:500], irregular_times, obs_covs)
+        run_result = filtering.run(create_model(params)[0], obss[:500], irregular_times, obs_covs=obs_covs)
+        npt.assert_allclose(log_likelihood, run_result.cumulative_log_likelihood, rtol=1e-8)
+        finite_differences = [(estimation.log_likelihood_and_score(create_model_without_obs_cov, params + step, obss[:500], irregular_times, obs_covs)[0] -
+                estimation.log_likelihood_and_score(create_model_without_obs_cov, params - step, obss[:500], irregular_times, obs_covs)[0]) / 2e-5
+                for step in steps]
+        npt.assert_allclose(score, finite_differences, rtol=1e-5, atol=1e-4)
+        self.assertEqual(score[3], 0.)
+        
+        # The parameter vectors of a batch are evaluated together
+        params_batch = [true_params, params, true_params - .1]
+        npt.assert_allclose(estimation.log_likelihoods(create_model, params_batch, obss, times),
+                [estimation.log_likelihood_and_score(create_model, p, obss, times)[0] for p in params_batch], rtol=1e-8)
+        
+        fit_result = estimation.fit(create_model, params, obss, times)
+        self.assertTrue(fit_result.success)
+        npt.assert_allclose(fit_result.x[[1, 3]], true_params[[1, 3]], atol=.1)
+        self.assertLess(fit_result.fun, -estimation.log_likelihood_and_score(create_model, true_params, obss, times)[0])
+        
+    def test_checkpoint(self):
+        process = proc.OrnsteinUhlenbeckProcess.create_from_cov(transition=[[2., 0.], [.5, 1.]], mean=[1., 2.], cov=[[4., 1.], [1., 3.]])
+        obs_model = kalman.LinearGaussianObsModel.create(np.eye(2))
+        kfs = [kalman.KalmanFilter(dt.datetime(2017, 1, 3), state_distr=N(mean=[i, 0.], cov=np.eye(2)), process=process) for i in range(10)]
+        for i, kf in enumerate(kfs[::2]):
+            kf.create_observable(obs_model, process).observe(time=dt.datetime(2017, 1, 3, 12), obs=N(mean=[i, 1.], cov=np.eye(2)))
+        
+        record = checkpoint.save_state(kfs[0])
+        self.assertEqual(record.dtype, checkpoint.kalman_filter_state_dtype(2, 'datetime64[us]'))
+        kf = kalman.KalmanFilter(dt.datetime(2017, 1, 1), state_distr=N(mean=[0., 0.], cov=np.eye(2)), process=process)
+        checkpoint.load_state(kf, record)
+        self.assertEqual(kf.time, dt.datetime(2017, 1, 3, 12))
+        self.assertTrue(kf.state.is_posterior)
+        npt.assert_array_equal(kf.state.state_distr.mean, kfs[0].state.state_distr.mean)
+        npt.assert_array_equal(kf.state.state_distr.cov, kfs[0].state.state_distr.cov)
+        
+        path = os.path.join(tempfile.mkdtemp(), 'states.npy')
+        checkpoint.save_states(kfs, path)
+        restored_kfs = [kalman.KalmanFilter(dt.datetime(2017, 1, 1), state_distr=N(mean=[0., 0.], cov=np.eye(2)), process=process) for _ in range(10)]
+        records = checkpoint.load_states(restored_kfs, path)
+        self.assertEqual(len(records), 10)
+        for kf, restored_kf in zip(kfs, restored_kfs):
+            self.assertEqual(restored_kf.time, kf.time)
+            self.assertEqual(restored_kf.state.is_posterior, kf.state.is_posterior)
+            npt.assert_array_equal(restored_kf.state.state_distr.mean, kf.state.state_distr.mean)
+            npt.assert_array_equal(restored_kf.state.state_distr.cov, kf.state.state_distr.cov)
+        # The restored filters carry on as the original ones
+        for kf in (kfs[3], restored_kfs[3]):
+            kf.create_observable(obs_model, process).observe(time=dt.datetime(2017, 1, 4), obs=N(mean=[3., 1.], cov=np.eye(2)))
+        npt.assert_allclose(restored_kfs[3].state.state_distr.mean, kfs[3].state.state_distr.mean)
+        
+        bank = kalman.KalmanFilterBank(0., N(mean=[1., 2.], cov=np.eye(2)), process, filter_count=100)
+        bank.observe(np.arange(200.).reshape(100, 2), obs_model, np.eye(2), time=1.)
+        checkpoint.save_states(bank, path)
+        restored_bank = kalman.KalmanFilterBank(0., N(mean=[0., 0.], cov=np.eye(2)), process, filter_count=100)
+        checkpoint.load_states(restored_bank, path)
+        npt.assert_array_equal(restored_bank.times, bank.times)
+        npt.assert_array_equal(restored_bank.state_means, bank.state_means)
+        npt.assert_array_equal(restored_bank.state_covs, bank.state_covs)
+        with self.assertRaises(AssertionError): checkpoint.load_states(kfs[:1], path)
+        
+        # A particle filter's record includes the state of its random number generator
+        wiener_process = proc.WienerProcess.create_from_cov(mean=0., cov=1.)
+        weighting_func = npu.vectorized(lambda obs, particles, pf: -.5 * np.sum((particles - obs)**2, axis=1))
+        create_pf = lambda: particle.MultinomialResamplingParticleFilter(0., N(mean=0., cov=1.), wiener_process, weighting_func=weighting_func,
+                particle_count=100, random_state=np.random.RandomState(1))
+        pf = create_pf()
+        pf.predict(1.)
+        pf.observe(np.array([.5]))
+        record = checkpoint.save_state(pf)
+        restored_pf = create_pf()
+        checkpoint.load_state(restored_pf, record)
+        self.assertEqual(restored_pf.time, 1.)
+        npt.assert_array_equal(restored_pf.weights, pf.weights)
+        npt.assert_array_equal(restored_pf.resampled_particles, pf.resampled_particles)
+        npt.assert_array_equal(restored_pf.mean, pf.mean)
+        self.assertEqual(restored_pf.log_likelihood, pf.log_likelihood)
+        npt.assert_array_equal(restored_pf._random_state.uniform(size=10), pf._random_state.uniform(size=10))
+        
+    def test_particle_filter(self):
+        process = proc.OrnsteinUhlenbeckProcess.create_from_cov(transition=1., mean=0., cov=1.)
+        weighting_func = particle.GaussianWeightingFunction(.25)
+        pf = particle.MultinomialResamplingParticleFilter(0., N(mean=0., cov=1.), process, weighting_func=weighting_func,
+                particle_count=20000, random_state=np.random.RandomState(1))
+        kf = kalman.KalmanFilter(0., state_distr=N(mean=0., cov=1.), process=process)
+        observable = kf.create_identity_observable(process)
+        npt.assert_allclose(pf.prior_mean, [0.], atol=.05)
+        npt.assert_allclose(pf.prior_var, [1.], atol=.05)
+        
+        # The particles are kept in two preallocated buffers, which are reused at every step
+        buffer_ids = {id(pf._prior_particles), id(pf._resampled_particles)}
+        for i in range(10):
+            time = .5 * (i + 1)
+            obs = np.sin(time)
+            pf.predict(time)
+            # Without an observation, the prior particles are propagated as they are
+            if i % 3 == 2: pf.predict(time + .25)
+            else: pf.observe(np.array([obs]))
+            observable.observe(time=pf.time, obs=N(mean=obs, cov=.25) if i % 3 != 2 else N(mean=0., cov=1e10))
+            self.assertEqual({id(pf._prior_particles), id(pf._resampled_particles)}, buffer_ids)
+            mean, var = (pf.mean, pf.var) if i % 3 != 2 else (pf.prior_mean, pf.prior_var)
+            npt.assert_allclose(mean, kf.state.state_distr.mean[0], atol=.05)
+            npt.assert_allclose(var, kf.state.state_distr.cov[0], atol=.05)
+        
+    def test_resampling(self):
+        random_state = np.random.RandomState(1)
+        particle_count = 1000
+        particles = npu.col(*np.arange(particle_count, dtype=float))
+        weights = random_state.exponential(size=particle_count)**3
+        weights /= np.sum(weights)
+        out = np.empty((particle_count, 1))
+        for resampling in (particle.MultinomialResampling(), particle.SystematicResampling(), particle.StratifiedResampling(),
+                           particle.ResidualResampling()):
+            counts = np.zeros(particle_count)
+            for _ in range(200):
+                resampling(particles, weights, random_state, out=out)
+                counts += np.bincount(out[:, 0].astype(int), minlength=particle_count)
+            # Each particle is copied particle_count * weight times in expectation...
+            self.assertTrue(np.all(np.abs(counts / 200. - particle_count * weights) < 5. * np.sqrt(particle_count * weights / 200.) + .05))
+            # ...and, under systematic and residual resampling, at least floor(particle_count * weight) times
+            idxs = resampling.indices(weights, particle_count, random_state)
+            self.assertEqual(len(idxs), particle_count)
+            if isinstance(resampling, (particle.SystematicResampling, particle.ResidualResampling)):
+                self.assertTrue(np.all(np.bincount(idxs, minlength=particle_count) >= np.floor(particle_count * weights)))
+        
+        # Smooth resampling draws from the piecewise linear approximation of the distribution function
+        resampled = particle.SmoothResampling()(particles, np.full(particle_count, 1. / particle_count), random_state, out=out)
+        self.assertIs(resampled, out)
+        self.assertTrue(np.all(out >= 0.) and np.all(out <= particle_count - 1))
+        npt.assert_allclose(np.mean(out), (particle_count - 1) / 2., rtol=.05)
+        
+        # A particle filter with any of the schemes
+        process = proc.OrnsteinUhlenbeckProcess.create_from_cov(transition=1., mean=0., cov=1.)
+        weighting_func = particle.GaussianWeightingFunction(.25)
+        for resampling in (particle.SystematicResampling(), particle.StratifiedResampling(), particle.ResidualResampling()):
+            pf = particle.ParticleFilter(0., N(mean=0., cov=1.), process, weighting_func=weighting_func, particle_count=20000,
+                    random_state=np.random.RandomState(1), resampling=resampling)
+            self.assertIs(pf.resampling, resampling)
+            kf = kalman.KalmanFilter(0., state_distr=N(mean=0., cov=1.), process=process)
+            observable = kf.create_identity_observable(process)
+            for i in range(5):
+                pf.predict(i + 1.)
+                pf.observe(np.array([np.sin(i + 1.)]))
+                observable.observe(time=i + 1., obs=N(mean=np.sin(i + 1.), cov=.25))
+                npt.assert_allclose(pf.mean, kf.state.state_distr.mean[0], atol=.05)
+                npt.assert_allclose(pf.var, kf.state.state_distr.cov[0], atol=.05)
+        
+    def test_adaptive_resampling(self):
+        process = proc.OrnsteinUhlenbeckProcess.create_from_cov(transition=1., mean=0., cov=1.)
+        weighting_func = particle.GaussianWeightingFunction(.25)
+        kf = kalman.KalmanFilter(0., state_distr=N(mean=0., cov=1.), process=process)
+        observable = kf.create_identity_observable(process)
+        kf_means, kf_vars, kf_log_likelihood = [], [], 0.
+        for i in range(8):
+            obs_result = observable.observe(time=.25 * (i + 1), obs=N(mean=np.sin(i), cov=.25))
+            kf_means.append(kf.state.state_distr.mean[0, 0])
+            kf_vars.append(kf.state.state_distr.cov[0, 0])
+            kf_log_likelihood += obs_result.log_likelihood[0, 0]
+        
+        resample_counts = []
+        for resampling_threshold in (None, .5, 0.):
+            pf = particle.ParticleFilter(0., N(mean=0., cov=1.), process, weighting_func=weighting_func, particle_count=50000,
+                    random_state=np.random.RandomState(1), resampling=particle.SystematicResampling(),
+                    resampling_threshold=resampling_threshold)
+            self.assertEqual(pf.resampling_threshold, resampling_threshold)
+            for i in range(8):
+                pf.predict(.25 * (i + 1))
+                pf.observe(np.array([np.sin(i)]))
+                # Whether or not the particles have been resampled, the weighted particles approximate the posterior
+                npt.assert_allclose(pf.mean, kf_means[i], atol=.03)
+                npt.assert_allclose(pf.var, kf_vars[i], atol=.03)
+            # So does the product of the observations' likelihoods, whose weights carry over until the resampling
+            self.assertAlmostEqual(pf.log_likelihood, kf_log_likelihood, delta=.05)
+            resample_counts.append(pf.resample_count)
+        self.assertEqual(resample_counts[0], 8)
+        self.assertTrue(0 < resample_counts[1] < 8)
+        self.assertEqual(resample_counts[2], 0)
+        
+    def test_weighting_functions(self):
+        random_state = np.random.RandomState(1)
+        particles = random_state.normal(size=(1000, 2))
+        obs = np.array([.5, -1.])
+        obs_cov = np.array([[1., .3], [.3, .5]])
+        npt.assert_allclose(particle.GaussianWeightingFunction(obs_cov)(obs, particles),
+                [stats.multivariate_normal.logpdf(obs, mean=p, cov=obs_cov) for p in particles])
+        npt.assert_allclose(particle.StudentTWeightingFunction(obs_cov, 3.)(obs, particles),
+                [stats.multivariate_t.logpdf(obs, loc=p, shape=obs_cov, df=3.) for p in particles])
+        obs_function = npu.vectorized(lambda particles: particles[:, 0:1] + particles[:, 1:2])
+        npt.assert_allclose(particle.GaussianWeightingFunction(2., obs_function=obs_function)(obs[0:1], particles),
+                stats.norm.logpdf(.5, loc=particles[:, 0] + particles[:, 1], scale=np.sqrt(2.)))
+        self.assertEqual(np.shape(particle.KDEWeightingFunction()(obs, particles)), (1000,))
+        
+        # The weights are normalized in the log domain, so that a sharp observation far from the particles, under which
+        # their likelihoods underflow, still weights them
+        process = proc.WienerProcess.create_from_cov(mean=0., cov=1.)
+        pf = particle.ParticleFilter(0., N(mean=0., cov=1.), process, weighting_func=particle.GaussianWeightingFunction(1e-6),
+                particle_count=1000, random_state=np.random.RandomState(1))
+        pf.predict(1.)
+        pf.observe(np.array([20.]))
+        self.assertTrue(np.all(np.isfinite(pf.weights)))
+        self.assertAlmostEqual(np.sum(pf.weights), 1.)
+        self.assertTrue(np.all(pf.unnormalized_weights == 0.))
+        self.assertTrue(np.isfinite(pf.log_likelihood))
+        npt.assert_allclose(pf.mean, [np.max(pf.prior_particles)])
+        
+    def test_regularized_resampling(self):
+        # The resampled particles are jittered with the kernel of the weighted particles' kernel density estimate, whose
+        # covariance is that of the particles scaled by the square of the bandwidth factor
+        random_state = np.random.RandomState(1)
+        particle_count = 100000
+        cov = np.array([[1., .5, 0.], [.5, 2., .3], [0., .3, .5]])
+        particles = random_state.multivariate_normal(np.zeros(3), cov, size=particle_count)
+        weights = np.full(particle_count, 1. / particle_count)
+        out = np.empty_like(particles)
+        for bw_method, bw_factor in ((None, particle_count**(-1. / 7.)), ('silverman', (particle_count * 5. / 4.)**(-1. / 7.)), (.5, .5)):
+            particle.RegularizedResampling(particle.SystematicResampling(), bw_method=bw_method)(particles, weights, random_state, out=out)
+            self.assertEqual(len(np.unique(out[:, 0])), particle_count)
+            npt.assert_allclose(np.cov(out, rowvar=False), cov * (1. + bw_factor**2), atol=.05)
+        
+        # Particles that are degenerate in some directions are not jittered in them
+        degenerate_particles = np.hstack([particles[:, 0:1], particles[:, 0:1], particles[:, 1:2]])
+        particle.RegularizedResampling()(degenerate_particles, weights, random_state, out=out)
+        npt.assert_allclose(out[:, 0], out[:, 1], atol=1e-6)
+        
+        # A regularized resampling particle filter in two dimensions
+        process = proc.OrnsteinUhlenbeckProcess.create_from_cov(transition=np.eye(2), mean=np.zeros(2), cov=np.array([[1., .5], [.5, 1.]]))
+        pf = particle.RegularizedResamplingParticleFilter(0., N(mean=np.zeros(2), cov=np.eye(2)), process,
+                weighting_func=particle.GaussianWeightingFunction(.25 * np.eye(2)), particle_count=20000, random_state=np.random.RandomState(1))
+        self.assertIsInstance(pf.resampling, particle.RegularizedResampling)
+        kf = kalman.KalmanFilter(0., state_distr=N(mean=np.zeros(2), cov=np.eye(2)), process=process)
+        observable = kf.create_identity_observable(process)
+        for i in range(5):
+            obs = np.array([np.sin(i), np.cos(i)])
+            pf.predict(i + 1.)
+            pf.observe(obs)
+            observable.observe(time=i + 1., obs=N(mean=obs, cov=.25 * np.eye(2)))
+            npt.assert_allclose(pf.posterior_mean, kf.state.state_distr.mean[:, 0], atol=.05)
+            npt.assert_allclose(pf.mean, kf.state.state_distr.mean[:, 0], atol=.05)
+        
+    def test_parallel_particle_filter(self):
+        process = proc.OrnsteinUhlenbeckProcess.create_from_cov(transition=1., mean=0., cov=1.)
+        kf = kalman.KalmanFilter(0., state_distr=N(mean=0., cov=1.), process=process)
+        observable = kf.create_identity_observable(process)
+        kf_means, kf_vars, kf_log_likelihood = [], [], 0.
+        for i in range(5):
+            obs_result = observable.observe(time=i + 1., obs=N(mean=np.sin(i), cov=.25))
+            kf_means.append(kf.state.state_distr.mean[0, 0])
+            kf_vars.append(kf.state.state_distr.cov[0, 0])
+            kf_log_likelihood += obs_result.log_likelihood[0, 0]
+        
+        def run(resampling, worker_count=3):
+            pf = parallel.ParallelParticleFilter(0., N(mean=0., cov=1.), process, weighting_func=particle.GaussianWeightingFunction(.25),
+                    particle_count=20000, random_state=np.random.RandomState(1), resampling=resampling, worker_count=worker_count)
+            self.assertEqual(pf.worker_count, worker_count)
+            means = []
+            for i in range(5):
+                pf.predict(i + 1.)
+                pf.observe(np.array([np.sin(i)]))
+                npt.assert_allclose(pf.mean, kf_means[i], atol=.05)
+                npt.assert_allclose(pf.var, kf_vars[i], atol=.05)
+                means.append(pf.mean[0])
+            self.assertAlmostEqual(pf.log_likelihood, kf_log_likelihood, delta=.05)
+            return pf, means
+        
+        for resampling in (particle.MultinomialResampling(), particle.SystematicResampling(), particle.StratifiedResampling(),
+                           particle.SmoothResampling()):
+            pf, means = run(resampling)
+            pf.close()
+        
+        # The results are reproducible for a given random state and worker count
+        pf, means = run(particle.SystematicResampling())
+        other_pf, other_means = run(particle.SystematicResampling())
+        self.assertEqual(means, other_means)
+        other_pf.close()
+        
+        # Once closed, the filter runs in this process
+        pf.close()
+        mean = pf.mean
+        pf.predict(6.)
+        npt.assert_allclose(pf.prior_mean, mean * np.exp(-1.), atol=.05)
+        pf.observe(np.array([0.]))
+        self.assertEqual(pf.resample_count, 6)
+        pf.close()
+        
+        # With the default KDEWeightingFunction, whose kernel depends on all the particles, the weights of the same
+        # (initial) particles are those of a ParticleFilter, whatever the worker count
+        serial_pf = particle.ParticleFilter(0., N(mean=0., cov=1.), process, particle_count=2000, random_state=np.random.RandomState(1))
+        serial_pf.observe(np.array([.5]))
+        for worker_count in (1, 3):
+            pf = parallel.ParallelParticleFilter(0., N(mean=0., cov=1.), process, particle_count=2000,
+                    random_state=np.random.RandomState(1), worker_count=worker_count)
+            pf.observe(np.array([.5]))
+            npt.assert_allclose(pf.weights, serial_pf.weights)
+            self.assertAlmostEqual(pf.log_likelihood, serial_pf.log_likelihood)
+            pf.close()
+        
+    def test_particle_filter_bank(self):
+        process = proc.OrnsteinUhlenbeckProcess.create_from_cov(transition=1., mean=0., cov=1.)
+        filter_count = 4
+        obs_model = kalman.LinearGaussianObsModel.create(1.)
+        for resampling, resampling_threshold in ((particle.MultinomialResampling(), None), (particle.SystematicResampling(), .5),
+                                                 (particle.StratifiedResampling(), None)):
+            kf_bank = kalman.KalmanFilterBank(0., N(mean=0., cov=1.), process, filter_count=filter_count)
+            pf_bank = particle.ParticleFilterBank(0., N(mean=0., cov=1.), process, particle.GaussianWeightingFunction(.25),
+                    particle_count=20000, filter_count=filter_count, random_state=np.random.RandomState(1), resampling=resampling,
+                    resampling_threshold=resampling_threshold)
+            self.assertEqual(pf_bank.particles.shape, (filter_count, 20000, 1))
+            kf_log_likelihoods = np.zeros(filter_count)
+            for i in range(5):
+                obss = np.sin(i + np.arange(filter_count))
+                kf_obs_result = kf_bank.observe(obss, obs_model, .25, time=i + 1.)
+                kf_log_likelihoods += kf_obs_result.log_likelihood
+                obs_result = pf_bank.observe(obss, time=i + 1.)
+                npt.assert_array_equal(obs_result.filter_idxs, np.arange(filter_count))
+                npt.assert_allclose(obs_result.log_likelihood, kf_obs_result.log_likelihood, atol=.05)
+                npt.assert_allclose(pf_bank.means, kf_bank.state_means[:, :, 0], atol=.05)
+                npt.assert_allclose(pf_bank.vars, kf_bank.state_covs[:, :, 0], atol=.05)
+                self.assertTrue(np.all(obs_result.effective_sample_size <= 20000))
+            npt.assert_allclose(pf_bank.log_likelihoods, kf_log_likelihoods, atol=.1)
+            if resampling_threshold is None: npt.assert_array_equal(pf_bank.resample_counts, 5)
+            else: self.assertTrue(np.all(pf_bank.resample_counts < 5))
+        
+        # Only the selected filters step; the others keep their particles, weights and times
+        particles = np.array(pf_bank.particles)
+        obs_result = pf_bank.observe([0., 0.], time=6., mask=[False, True, False, True])
+        npt.assert_array_equal(obs_result.filter_idxs, [1, 3])
+        npt.assert_array_equal(pf_bank.times, [5., 6., 5., 6.])
+        npt.assert_array_equal(pf_bank.particles[[0, 2]], particles[[0, 2]])
+        pf_bank.predict(6.)
+        npt.assert_array_equal(pf_bank.times, 6.)
+        
+        # The batched systematic resampling copies each particle floor(particle_count * weight) or one more times
+        weights = np.random.RandomState(1).dirichlet(np.ones(10), size=3)
+        pf_bank = particle.ParticleFilterBank(0., N(mean=0., cov=1.), process,
+                npu.vectorized(lambda obs, particles, filter: np.log(weights.ravel())), particle_count=10, filter_count=3,
+                random_state=np.random.RandomState(1), resampling=particle.SystematicResampling())
+        pf_bank.predict(1.)
+        particles = np.array(pf_bank.particles)
+        pf_bank.observe(np.zeros(3))
+        for f in range(3):
+            counts = np.array([np.sum(pf_bank.particles[f, :, 0] == p) for p in particles[f, :, 0]])
+            self.assertTrue(np.all(counts >= np.floor(10 * weights[f])))
+            self.assertTrue(np.all(counts <= np.floor(10 * weights[f]) + 1))
+        
+    def test_rao_blackwellized_particle_filter(self):
+        process = proc.OrnsteinUhlenbeckProcess.create_from_cov(transition=1., mean=0., cov=1.)
+        linear_process = proc.OrnsteinUhlenbeckProcess.create_from_cov(transition=.5, mean=1., cov=.5)
+        obs_model = kalman.LinearGaussianObsModel.create(1.)
+        
+        # If the observation does not depend on the particles, every particle carries the Kalman filter's distribution
+        rbpf = particle.RaoBlackwellizedParticleFilter(0., N(mean=0., cov=1.), process, N(mean=0., cov=1.), linear_process,
+                obs_model, .25, particle_count=100, random_state=np.random.RandomState(1))
+        kf = kalman.KalmanFilter(0., state_distr=N(mean=0., cov=1.), process=linear_process)
+        observable = kf.create_identity_observable(linear_process)
+        kf_log_likelihood = 0.
+        for i in range(5):
+            rbpf.predict(i + 1.)
+            rbpf.observe(np.sin(i))
+            kf_log_likelihood += observable.observe(time=i + 1., obs=N(mean=np.sin(i), cov=.25)).log_likelihood[0, 0]
+            npt.assert_allclose(rbpf.linear_state_means, np.tile(kf.state.state_distr.mean[:, 0], (100, 1)))
+            npt.assert_allclose(rbpf.linear_state_covs, np.tile(kf.state.state_distr.cov, (100, 1, 1)))
+            npt.assert_allclose(rbpf.weights, .01)
+        self.assertAlmostEqual(rbpf.log_likelihood, kf_log_likelihood)
+        
+        # If the observation is the sum of the two sub-states (plus noise), the model is linear-Gaussian, so the Kalman
+        # filter of the whole state gives the exact posterior
+        rbpf = particle.RaoBlackwellizedParticleFilter(0., N(mean=0., cov=1.), process, N(mean=0., cov=1.), linear_process,
+                obs_model, .25, obs_offset=npu.vectorized(lambda particles: particles), particle_count=5000,
+                random_state=np.random.RandomState(1), resampling=particle.SystematicResampling(), resampling_threshold=.5)
+        self.assertEqual(rbpf.particles.shape, (5000, 1))
+        self.assertEqual(rbpf.linear_state_dim, 1)
+        kf = kalman.KalmanFilter(0., state_distr=N(mean=[0., 0.], cov=np.eye(2)), process=(process, linear_process))
+        observable = kf.create_observable(kalman.LinearGaussianObsModel(np.array([[1., 1.]])), process, linear_process)
+        kf_log_likelihood = 0.
+        for i in range(8):
+            rbpf.predict(i + 1.)
+            rbpf.observe(np.sin(i))
+            kf_log_likelihood += observable.observe(time=i + 1., obs=N(mean=np.sin(i), cov=.25)).log_likelihood[0, 0]
+            npt.assert_allclose(rbpf.mean, kf.state.state_distr.mean[:, 0], atol=.05)
+            npt.assert_allclose(rbpf.var, np.diag(kf.state.state_distr.cov), atol=.05)
+        self.assertAlmostEqual(rbpf.log_likelihood, kf_log_likelihood, delta=.1)
+        self.assertTrue(0 < rbpf.resample_count < 8)
+        
+        # The observation noise may depend on the particles, as in stochastic volatility models
+        rbpf = particle.RaoBlackwellizedParticleFilter(0., N(mean=0., cov=1.), process, N(mean=0., cov=1.), linear_process,
+                obs_model, npu.vectorized(lambda particles: np.exp(particles)), particle_count=1000, random_state=np.random.RandomState(1),
+                resampling_threshold=0.)
+        rbpf.predict(1.)
+        obs_result = rbpf.observe(1.)
+        innov_vars = obs_result.innov_cov[:, 0, 0] - np.exp(rbpf.particles[:, 0])
+        npt.assert_allclose(innov_vars, innov_vars[0])
+        self.assertTrue(np.isfinite(rbpf.log_likelihood))
+        self.assertEqual(rbpf.resample_count, 0)
+        
+        # Resampling a Kalman filter bank copies its filters
+        bank = kalman.KalmanFilterBank(0., [N(mean=float(i), cov=float(i + 1)) for i in range(3)], linear_process)
+        bank.resample([2, 0, 0])
+        npt.assert_array_equal(bank.state_means[:, 0, 0], [2., 0., 0.])
+        npt.assert_array_equal(bank.state_covs[:, 0, 0], [3., 1., 1.])
+        
+    def test_filter_publisher(self):
+        class ListPype(object):
+            def __init__(self):
+                self.objs = []
+            def send(self, obj):
+                self.objs.append(obj)
+        
+        process = proc.OrnsteinUhlenbeckProcess.create_from_cov(transition=2., mean=1., cov=4.)
+        def run(*args, **kwargs):
+            pype = ListPype()
+            kf = kalman.KalmanFilter(0., state_distr=N(mean=0., cov=1.), process=process, pype=publishing.FilterPublisher(pype, *args, **kwargs))
+            observable = kf.create_identity_observable(process)
+            for i in range(10):
+                observable.observe(time=.5 * (i + 1), obs=N(mean=i % 3, cov=.5), true_value=1.)
+            return pype.objs
+        
+        # The initial prior state and, for each observation, the true value (sent on prediction and on observation), the
+        # prior and posterior states and the result
+        all_objs = run()
+        self.assertEqual(len(all_objs), 51)
+        
+        objs = run(publishing.EveryNthPublishingPolicy(3, kinds=[filtering.FilterPypeOptions.OBS_RESULT]))
+        obs_results = [o for o in objs if isinstance(o, filtering.ObsResult)]
+        self.assertEqual([o.obs.time for o in obs_results], [.5, 2., 3.5, 5.])
+        self.assertEqual(len(objs), 51 - 6)
+        
+        objs = run(publishing.TimeThrottledPublishingPolicy(1.2))
+        self.assertEqual([o.time for o in objs if isinstance(o, filtering.TrueValue)], [0., 1.5, 3., 4.5])
+        
+        objs = run(publishing.OnChangePublishingPolicy(.5, kinds=[filtering.FilterPypeOptions.POSTERIOR_STATE]))
+        posterior_states = [o for o in all_objs if isinstance(o, filtering.FilterState) and o.is_posterior]
+        published_posterior_states = [o for o in objs if isinstance(o, filtering.FilterState) and o.is_posterior]
+        self.assertLess(len(published_posterior_states), len(posterior_states))
+        for previous, current in zip(published_posterior_states[:-1], published_posterior_states[1:]):
+            self.assertGreater(np.max(np.abs(current.state_distr.mean - previous.state_distr.mean)), .5)
+        
+        # Compact messages encode the times, means, covariance diagonals and log-likelihoods
+        messages = run(compact=True)
+        self.assertEqual(len(messages), len(all_objs))
+        for message, obj in zip(messages, all_objs):
+            self.assertTrue(publishing.is_compact_message(message))
+            decoded = publishing.from_compact_message(message)
+            self.assertIs(type(decoded), type(obj))
+            if isinstance(obj, filtering.ObsResult):
+                self.assertEqual(decoded.obs.time, obj.obs.time)
+                npt.assert_allclose(decoded.log_likelihood, obj.log_likelihood)
+                npt.assert_allclose(decoded.innov_distr.mean, obj.innov_distr.mean)
+                npt.assert_allclose(decoded.innov_distr.cov, obj.innov_distr.cov)
+                npt.assert_allclose(decoded.predicted_obs.distr.mean, obj.predicted_obs.distr.mean)
+            elif isinstance(obj, filtering.FilterState):
+                self.assertEqual(decoded.time, obj.time)
+                self.assertEqual(decoded.is_posterior, obj.is_posterior)
+                npt.assert_allclose(decoded.state_distr.mean, obj.state_distr.mean)
+                npt.assert_allclose(np.diag(decoded.state_distr.cov), np.diag(obj.state_distr.cov))
+        message = publishing.to_compact_message(kalman.KalmanFilterState(None, dt.datetime(2017, 1, 3, 9, 30, 0, 250), True, N(mean=[1., 2.], cov=np.eye(2))))
+        self.assertEqual(publishing.from_compact_message(message).time, dt.datetime(2017, 1, 3, 9, 30, 0, 250))
+        
+        # The fields of a compact message can be read straight from the array, without decoding it
+        self.assertEqual(publishing.compact_message_kind(message), filtering.FilterPypeOptions.POSTERIOR_STATE)
+        self.assertEqual(publishing.compact_message_time(message), dt.datetime(2017, 1, 3, 9, 30, 0, 250))
+        npt.assert_array_equal(publishing.compact_message_mean(message), [1., 2.])
+        npt.assert_array_equal(publishing.compact_message_cov_diag(message), [1., 1.])
+        self.assertEqual(len(publishing.compact_message_obs_mean(message)), 0)
+        self.assertIs(publishing.compact_message_mean(message).base, message)
         
 if __name__ == '__main__':
     unittest.main()
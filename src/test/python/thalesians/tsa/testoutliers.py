@@ -0,0 +1,51 @@
+import unittest
+
+import numpy as np
+import numpy.testing as npt
+from scipy import stats
+
+import thalesians.tsa.outliers as outliers
+
+class TestOutliers(unittest.TestCase):
+    def test_problessthan(self):
+        random_state = np.random.RandomState(42)
+        sample = random_state.normal(size=1000)
+        bw = .3
+        
+        # The distribution function of the kernel density estimate...
+        self.assertAlmostEqual(outliers.problessthan(sample, bw, .5), np.mean(stats.norm.cdf((.5 - sample) / bw)))
+        # ...for many values at once...
+        values = np.linspace(-4., 4., 17)
+        probs = outliers.problessthan(sample, bw, values)
+        self.assertEqual(np.shape(probs), (17,))
+        npt.assert_allclose(probs, [outliers.problessthan(sample, bw, v) for v in values])
+        self.assertTrue(np.all(np.diff(probs) > 0.))
+        # ...which is close to that of the sample's distribution when the bandwidth is small
+        npt.assert_allclose(outliers.problessthan(sample, .01, values), stats.norm.cdf(values), atol=.05)
+        
+        # Weighted samples
+        weights = random_state.uniform(size=1000)
+        npt.assert_allclose(outliers.problessthan(sample, bw, values, weights=weights),
+                [np.sum(weights * stats.norm.cdf((v - sample) / bw)) / np.sum(weights) for v in values])
+        
+        # The binned approximation
+        npt.assert_allclose(outliers.problessthan(sample, bw, values, bin_count=1000), probs, atol=1e-3)
+        npt.assert_allclose(outliers.problessthan(sample, bw, values, weights=weights, bin_count=1000),
+                outliers.problessthan(sample, bw, values, weights=weights), atol=1e-3)
+    
+    def test_isoutlier(self):
+        random_state = np.random.RandomState(42)
+        sample = random_state.normal(size=1000)
+        self.assertFalse(outliers.isoutlier(sample, .3, 0., .05))
+        self.assertTrue(outliers.isoutlier(sample, .3, 3., .05))
+        self.assertTrue(outliers.isoutlier(sample, .3, -3., .05))
+        npt.assert_array_equal(outliers.isoutlier(sample, .3, [-3., -1., 0., 1., 3.], .05), [True, False, False, False, True])
+        
+        # The former positional count and random_state are not taken as the weights and bin_count
+        with self.assertRaises(TypeError):
+            outliers.problessthan(sample, .3, 0., 10000, random_state)
+        with self.assertRaises(TypeError):
+            outliers.isoutlier(sample, .3, 0., .05, 10000, random_state)
+        
+if __name__ == '__main__':
+    unittest.main()
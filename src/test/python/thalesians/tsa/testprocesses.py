@@ -25,6 +25,23 @@ class TestProcesses(unittest.TestCase):
         p = proc.OrnsteinUhlenbeckProcess(3., 3., 5.)
         self.assertEqual(str(p), 'OrnsteinUhlenbeckProcess(process_dim=1, noise_dim=1, transition=[[ 3.]], mean=[[ 3.]], vol=[[ 5.]])')
 
+    def test_transition_cache(self):
+        p = proc.OrnsteinUhlenbeckProcess.create_from_cov(transition=[[2., 0.], [.5, 1.]], mean=[1., 2.], cov=[[4., 1.], [1., 3.]])
+        transition_matrix = p.transition_matrix(0., .003)
+        npt.assert_almost_equal(transition_matrix, p.mean_reversion_factor(.003))
+        npt.assert_almost_equal(p.noise_cov(0., .003), p.noise_covariance(.003))
+        # Nominally equal time deltas between different times hit the cache
+        self.assertIs(p.transition_matrix(.001, .004), transition_matrix)
+        self.assertFalse(transition_matrix.flags.writeable)
+        self.assertIsNot(p.transition_matrix(0., .004), transition_matrix)
+        for i in range(proc.MarkovProcess.TRANSITION_CACHE_SIZE + 10): p.noise_cov(0., .001 * (i + 1))
+        self.assertEqual(len(p._transition_cache), proc.MarkovProcess.TRANSITION_CACHE_SIZE)
+        
+        distr0 = distrs.NormalDistr(mean=[1., 2.], cov=[[1., 0.], [0., 1.]])
+        distr = p.propagate_distr(0., distr0, .003)
+        self.assertIs(p.propagate_distr(0., distr0, .003), distr)
+        npt.assert_almost_equal(distr.mean, np.dot(transition_matrix, distr0.mean) + p.transition_offset(0., .003))
+
 if __name__ == '__main__':
     unittest.main()
     
\ No newline at end of file